@@ -5,15 +5,23 @@ import matplotlib.pyplot as plt
 
 class GeneralStat:
     def __init__(self, result_file_path):
-        self.sim_result = SimResult.from_file(result_file_path)
-
-    def find_stat(self,species_name):
-        allspecies_names = [sp['name'] for sp in self.sim_result.inputs['species']]
+        # an in memory SimResult (e.g. from the python driver) can be analyzed directly
+        if isinstance(result_file_path, SimResult):
+            self.sim_result = result_file_path
+        else:
+            self.sim_result = SimResult.from_file(result_file_path)
+        self.species_names = [sp['name'] for sp in self.sim_result.inputs['species']]
+        self.species_index = {name: idx for idx, name in enumerate(self.species_names)}
+
+    def _species_idx(self, species_name, label='Species'):
         try:
-            species_idx = allspecies_names.index(species_name)
-        except ValueError:
+            return self.species_index[species_name]
+        except KeyError:
             raise ValueError(
-                f'Species {species_name} NOT found, please choose from {allspecies_names}')
+                f'{label} {species_name} NOT found, please choose from {self.species_names}')
+
+    def find_stat(self,species_name):
+        species_idx = self._species_idx(species_name)
         cmat_final_n = self.sim_result.concentration_tsn[-1,species_idx]
         cmat_initial_n = self.sim_result.concentration_tsn[0,species_idx]
         concentration_max = max(cmat_final_n)
@@ -41,6 +49,61 @@ class GeneralStat:
         max_deri_pos = np.argmax(cmat_n_deri) * self.sim_result.inputs['domainLen']/self.sim_result.inputs['numGrids']
         return max_deri_pos
 
+    def _window_mask(self, win_pos, win_width):
+        # same grid points as the window slices of DNA_Analysis.find_nondime_fom
+        grid_per_length = self.sim_result.inputs['numGrids'] / self.sim_result.inputs['domainLen']
+        mask_n = np.zeros(self.sim_result.inputs['numGrids'])
+        mask_n[int((win_pos - win_width/2) * grid_per_length):
+               int((win_pos + win_width/2) * grid_per_length)] = 1.
+        return mask_n
+
+    def time_series(self, windows=(), chunk_size=256):
+        """
+        statistics of all species at all time slices, computed in a single vectorized pass
+        that streams over chunks of time slices
+
+        Args:
+            windows:    (position, width) windows to integrate the amount of every species in
+            chunk_size: number of time slices processed at once
+
+        Returns:
+            dictionary of [t, s] arrays
+                'max value', 'peak position', 'amount', 'mean', 'std', 'skewness',
+                'max derivative position', 'min derivative position'
+            where the moments are taken from the concentration normalized by the amount, as
+            well as the [t, s, w] 'amount in window' and the [t] 'time'
+        """
+        length_per_grid = self.sim_result.inputs['domainLen'] / self.sim_result.inputs['numGrids']
+        x_n = np.arange(self.sim_result.inputs['numGrids']) * length_per_grid
+        mask_nw = np.array([self._window_mask(win_pos, win_width)
+                            for win_pos, win_width in windows]).reshape(
+            len(windows), self.sim_result.inputs['numGrids']).T
+
+        chunks = []
+        for _, chunk in self.sim_result.iter_time_chunks(chunk_size):
+            cmat_tsn = np.asarray(chunk.concentration_tsn, dtype=np.float64)
+            amount_ts = np.sum(cmat_tsn, axis=-1) * length_per_grid
+            with np.errstate(divide='ignore', invalid='ignore'):
+                p_tsn = cmat_tsn * length_per_grid / amount_ts[..., None]
+                miu_ts = np.sum(p_tsn * x_n, axis=-1)
+                dx_tsn = x_n - miu_ts[..., None]
+                std_ts = np.sqrt(np.sum(p_tsn * dx_tsn**2, axis=-1))
+                skewness_ts = np.sum(p_tsn * (dx_tsn / std_ts[..., None])**3, axis=-1)
+            cmat_deri_tsn = np.gradient(cmat_tsn, axis=-1)
+            chunks.append({
+                'time': np.asarray(chunk.time_t),
+                'max value': np.max(cmat_tsn, axis=-1),
+                'peak position': np.argmax(cmat_tsn, axis=-1) * length_per_grid,
+                'amount': amount_ts,
+                'mean': miu_ts,
+                'std': std_ts,
+                'skewness': skewness_ts,
+                'max derivative position': np.argmax(cmat_deri_tsn, axis=-1) * length_per_grid,
+                'min derivative position': np.argmin(cmat_deri_tsn, axis=-1) * length_per_grid,
+                'amount in window': cmat_tsn @ mask_nw * length_per_grid,
+            })
+        return {key: np.concatenate([chunk[key] for chunk in chunks]) for key in chunks[0]}
+
 
 class DNA_Analysis(GeneralStat):
     def __init__(self,result_file_path):
@@ -51,17 +114,8 @@ class DNA_Analysis(GeneralStat):
         concentration_tsn = self.sim_result.concentration_tsn
         i_win = self._calculate_time_idx(win_pos,DNA_name)
 
-        allspecies_names = [sp['name'] for sp in self.sim_result.inputs['species']]
-        try:
-            DNA_idx = allspecies_names.index(DNA_name)
-        except ValueError:
-            raise ValueError(
-                f'DNA {species_name} NOT found, please choose from {allspecies_names}')
-        try:
-            imp_idx = allspecies_names.index(imp_name)
-        except ValueError:
-            raise ValueError(
-                f'impurity {species_name} NOT found, please choose from {allspecies_names}')
+        DNA_idx = self._species_idx(DNA_name, 'DNA')
+        imp_idx = self._species_idx(imp_name, 'impurity')
 
         length_per_grid = self.sim_result.inputs['domainLen'] / self.sim_result.inputs['numGrids']
         grid_per_length = self.sim_result.inputs['numGrids'] / self.sim_result.inputs['domainLen']
@@ -85,6 +139,35 @@ class DNA_Analysis(GeneralStat):
         imp_total = np.sum(cmat_win_imp_n) * length_per_grid
         beta = imp_inwindow/imp_total
 
+        gamma = self._calculate_gamma(win_pos,win_width,DNA_idx,imp_idx)
+        return {
+        'Limp*': Limp_star,
+        'alpha' : alpha,
+        'beta' : beta,
+        'gamma' : gamma
+        }
+
+    def nondime_fom_series(self, win_pos, win_width, DNA_name, imp_name, chunk_size=256):
+        """
+        same non-dimensional FOMs as find_nondime_fom, but evaluated at every time slice
+        from a single streaming pass of time_series
+
+        Returns:
+            dictionary of [t] arrays 'time', 'Limp*', 'alpha', 'beta' and the scalar 'gamma'
+        """
+        DNA_idx = self._species_idx(DNA_name, 'DNA')
+        imp_idx = self._species_idx(imp_name, 'impurity')
+        stats = self.time_series(windows=[(win_pos, win_width)], chunk_size=chunk_size)
+        in_window_ts = stats['amount in window'][..., 0]
+        return {
+            'time': stats['time'],
+            'Limp*': ((win_pos - win_width/2) - stats['min derivative position'][:, imp_idx]) / win_width,
+            'alpha': in_window_ts[:, DNA_idx] / stats['amount'][:, DNA_idx],
+            'beta': in_window_ts[:, imp_idx] / stats['amount'][:, imp_idx],
+            'gamma': self._calculate_gamma(win_pos, win_width, DNA_idx, imp_idx),
+        }
+
+    def _calculate_gamma(self,win_pos,win_width,DNA_idx,imp_idx):
         #gamma = Linj / (Linj + Ls + Lw)
         imp_inj_left = self.sim_result.inputs['species'][imp_idx]['injectionLoc'] - 1/2 * self.sim_result.inputs['species'][imp_idx]['injectionWidth']
         imp_inj_right = self.sim_result.inputs['species'][imp_idx]['injectionLoc'] + 1/2 * self.sim_result.inputs['species'][imp_idx]['injectionWidth']
@@ -95,81 +178,197 @@ class DNA_Analysis(GeneralStat):
         Linj_right = max(imp_inj_right,dna_inj_right)
         Linj = Linj_right-Linj_left
         Ltotal = win_pos + 1/2 * win_width - Linj_left
-        gamma = Linj / Ltotal
-        return {
-        'Limp*': Limp_star,
-        'alpha' : alpha,
-        'beta' : beta,
-        'gamma' : gamma
-        }
+        return Linj / Ltotal
 
-    def _calculate_time_idx(self,win_pos,species_name):
-        concentration_tsn = self.sim_result.concentration_tsn
+    def _calculate_time_idx(self,win_pos,species_name,chunk_size=256):
         length_per_grid = self.sim_result.inputs['domainLen'] / self.sim_result.inputs['numGrids']
-        grid_per_length = self.sim_result.inputs['numGrids'] / self.sim_result.inputs['domainLen']
-
-        allspecies_names = [sp['name'] for sp in self.sim_result.inputs['species']]
-        try:
-            species_idx = allspecies_names.index(species_name)
-        except ValueError:
-            raise ValueError(
-                f'Species {species_name} NOT found, please choose from {allspecies_names}')
-        i_win = None
-        for i,concentration_sn in enumerate(concentration_tsn):
-            if np.argmax(concentration_sn[species_idx]) * length_per_grid >= win_pos:
-                i_win = i
+        species_idx = self._species_idx(species_name)
+        # first time slice whose peak reached the window, stops reading at the first hit
+        for start, chunk in self.sim_result.iter_time_chunks(chunk_size):
+            peak_pos_t = np.argmax(chunk.concentration_tsn[:, species_idx], axis=-1) * length_per_grid
+            i_hit_t = np.flatnonzero(peak_pos_t >= win_pos)
+            if len(i_hit_t):
+                return start + int(i_hit_t[0])
+        return None
+
+class MinMaxPyramid:
+    """ level of detail pyramid of a [q, t, n] field (q images over time and grid)
+
+    Every pixel keeps the min, max and mean of the full resolution values it covers, so a
+    zone or interface narrower than a pixel still shows up at its extreme value instead of
+    being averaged away. The base level is reduced from the raw time slices tile by tile,
+    every further level halves both axes of the previous one.
+    """
+    def __init__(self, sim_result, field, num_pixels=(1024, 1024), tile_size=256, num_levels=None):
+        """
+        Args:
+            sim_result:     SimResult to render
+            field:          maps a SimResult chunk to the [q, t, n] values to render
+            num_pixels:     (time, grid) resolution of the base level, capped at the data
+            tile_size:      number of time slices loaded at once
+            num_levels:     maximum number of levels, by default halve down to a single pixel
+        """
+        self.sim_result = sim_result
+        self.field = field
+        self.tile_size = tile_size
+        self.shape = (sim_result.num_steps(), np.shape(field(sim_result.time_slice(0, 1)))[-1])
+        num_pixels = [min(num_pixel, size) for num_pixel, size in zip(num_pixels, self.shape)]
+        self.levels = [self._reduce_base(*num_pixels)]
+        while num_levels is None or len(self.levels) < num_levels:
+            if max(len(self.levels[-1]['t_starts']), len(self.levels[-1]['n_starts'])) == 1:
+                break
+            self.levels.append(self._coarsen(self.levels[-1]))
+        # global range of every image, for a consistent normalization across zoom levels
+        self.min_q = np.min(self.levels[0]['min'], axis=(1,2))
+        self.max_q = np.max(self.levels[0]['max'], axis=(1,2))
+
+    def _reduce_base(self, num_t_pixels, num_n_pixels):
+        num_t, num_n = self.shape
+        # pixel of every time slice and the first grid point of every pixel
+        t_pixel_t = np.arange(num_t) * num_t_pixels // num_t
+        n_starts = np.searchsorted(np.arange(num_n) * num_n_pixels // num_n, np.arange(num_n_pixels))
+        level = None
+        for start, chunk in self.sim_result.iter_time_chunks(self.tile_size):
+            values_qtn = np.asarray(self.field(chunk), dtype=np.float32)
+            if level is None:
+                shape_qtk = (values_qtn.shape[0], num_t_pixels, num_n_pixels)
+                level = {
+                    'min': np.full(shape_qtk, np.inf, dtype=np.float32),
+                    'max': np.full(shape_qtk, -np.inf, dtype=np.float32),
+                    'sum': np.zeros(shape_qtk),
+                }
+            # reduce the grid axis, then merge the time slices into their pixels, as the
+            # pixels at the tile edges may span two tiles
+            t_pixels, t_starts = np.unique(t_pixel_t[start:start + values_qtn.shape[1]], return_index=True)
+            for key, ufunc in [('min', np.minimum), ('max', np.maximum), ('sum', np.add)]:
+                reduced_qtk = ufunc.reduceat(ufunc.reduceat(values_qtn, n_starts, axis=2), t_starts, axis=1)
+                level[key][:, t_pixels] = ufunc(level[key][:, t_pixels], reduced_qtk)
+        level['t_starts'] = np.searchsorted(t_pixel_t, np.arange(num_t_pixels))
+        level['n_starts'] = n_starts
+        return level
+
+    def _coarsen(self, level):
+        t_starts = np.arange(0, len(level['t_starts']), 2)
+        n_starts = np.arange(0, len(level['n_starts']), 2)
+        coarse = {
+            key: ufunc.reduceat(ufunc.reduceat(level[key], n_starts, axis=2), t_starts, axis=1)
+            for key, ufunc in [('min', np.minimum), ('max', np.maximum), ('sum', np.add)]
+        }
+        coarse['t_starts'] = level['t_starts'][t_starts]
+        coarse['n_starts'] = level['n_starts'][n_starts]
+        return coarse
+
+    def view(self, t_range=None, n_range=None, num_pixels=(1024, 1024)):
+        """
+        Args:
+            t_range:    (start, stop) time slice indices to show, defaults to all
+            n_range:    (start, stop) grid indices to show, defaults to all
+            num_pixels: (time, grid) resolution the view needs at least
+
+        Returns:
+            [q, t, k] image of the coarsest level that resolves the view, where every pixel
+            takes its min or max, whichever deviates more from its mean. If even the base
+            level is too coarse, the range is reduced again from the raw time slices.
+            extent of the image in (full resolution) index units, as in plt.imshow
+        """
+        t_range = t_range or (0, self.shape[0])
+        n_range = n_range or (0, self.shape[1])
+        num_pixels = [min(num_pixel, stop - start)
+                      for num_pixel, (start, stop) in zip(num_pixels, [t_range, n_range])]
+        for level in reversed(self.levels):
+            # pixels overlapping with the range
+            t_pixels = self._overlapping(level['t_starts'], t_range, self.shape[0])
+            n_pixels = self._overlapping(level['n_starts'], n_range, self.shape[1])
+            if len(t_pixels) >= num_pixels[0] and len(n_pixels) >= num_pixels[1]:
                 break
-        return i_win
+        else:
+            if (len(level['t_starts']), len(level['n_starts'])) != self.shape:
+                field = lambda chunk: np.asarray(self.field(chunk))[..., n_range[0]:n_range[1]]
+                zoomed = MinMaxPyramid(self.sim_result.time_slice(*t_range), field, num_pixels,
+                                       self.tile_size, num_levels=1)
+                image_qtk, (left, right, bottom, top) = zoomed.view()
+                return image_qtk, (left + n_range[0], right + n_range[0],
+                                   bottom + t_range[0], top + t_range[0])
+
+        crop = (slice(None), t_pixels[:,None], n_pixels)
+        t_ends = np.append(level['t_starts'][1:], self.shape[0])
+        n_ends = np.append(level['n_starts'][1:], self.shape[1])
+        count_tk = (t_ends - level['t_starts'])[t_pixels,None] * (n_ends - level['n_starts'])[n_pixels]
+        min_qtk, max_qtk = level['min'][crop], level['max'][crop]
+        mean_qtk = level['sum'][crop] / count_tk
+        image_qtk = np.where(max_qtk - mean_qtk >= mean_qtk - min_qtk, max_qtk, min_qtk)
+        extent = (level['n_starts'][n_pixels[0]] - .5, n_ends[n_pixels[-1]] - .5,
+                  t_ends[t_pixels[-1]] - .5, level['t_starts'][t_pixels[0]] - .5)
+        return image_qtk, extent
+
+    @staticmethod
+    def _overlapping(starts, index_range, size):
+        ends = np.append(starts[1:], size)
+        return np.flatnonzero((starts < index_range[1]) & (ends > index_range[0]))
 
 class SpatialTemporal(GeneralStat):
-    def __init__(self,result_file_path):
+    def __init__(self,result_file_path,num_pixels=(1024,1024),tile_size=256):
+        """
+        Args:
+            result_file_path:   result to render
+            num_pixels:         (time, grid) resolution of the base level of the pyramids
+            tile_size:          number of time slices loaded at once while building them
+        """
         super(SpatialTemporal,self).__init__(result_file_path)
-
-    def concentration(self,species_names):
-        concentration_tsn = self.sim_result.concentration_tsn
+        self.num_pixels = num_pixels
+        self.tile_size = tile_size
+        self.pyramids = {}
+
+    def _pyramid(self,key,field):
+        # pyramids are built once and reused by every later (zoomed) view
+        if key not in self.pyramids:
+            self.pyramids[key] = MinMaxPyramid(self.sim_result,field,self.num_pixels,self.tile_size)
+        return self.pyramids[key]
+
+    def concentration(self,species_names,t_range=None,n_range=None,num_pixels=None):
+        """
+        Args:
+            species_names:  species to overlay, each in its own hue
+            t_range:        (start, stop) time slice indices to zoom into
+            n_range:        (start, stop) grid indices to zoom into
+            num_pixels:     (time, grid) resolution of the plot, defaults to the base level
+        """
         num_species = len(species_names)
-        concentration_stn = concentration_tsn.transpose(1,0,2)
-        allspecies_names = [sp['name'] for sp in self.sim_result.inputs['species']]
-
-        index_list = []
-        colormap_qtn3 = np.zeros((len(species_names),concentration_tsn.shape[0],concentration_tsn.shape[2],3))
-        for i,name in enumerate(species_names):
-            try:
-                species_idx = allspecies_names.index(name)
-            except ValueError:
-                raise ValueError(
-                    f'Species {name} NOT found, please choose from {allspecies_names}')
-            index_list.append(species_idx)
-
-            cmat_tn = concentration_stn[species_idx]
+        index_list = [self._species_idx(name) for name in species_names]
+        pyramid = self._pyramid(('concentration',) + tuple(index_list),
+                                lambda chunk: np.asarray(chunk.concentration_tsn)[:,index_list].transpose(1,0,2))
+        concentration_qtk, extent = pyramid.view(t_range,n_range,num_pixels or self.num_pixels)
+
+        colormap_qtk3 = np.zeros(concentration_qtk.shape + (3,),dtype=np.float32)
+        for i in range(num_species):
             saturation = 1.0
             hue = 360/num_species * i
-            colormap_qtn3[i] = self._single_species_colormap(cmat_tn,hue,saturation)
+            colormap_qtk3[i] = self._single_species_colormap(
+                concentration_qtk[i],hue,saturation,pyramid.min_q[i],pyramid.max_q[i])
 
-        concentration_qtn = concentration_stn[index_list]
-        concentration_norm_qtn = concentration_qtn/np.max(concentration_qtn,axis=(1,2),keepdims=True)
-        weighted_qtn = concentration_norm_qtn/(np.sum(concentration_norm_qtn,axis=0,keepdims=True))
+        concentration_norm_qtk = concentration_qtk/pyramid.max_q[:,None,None]
+        weighted_qtk = concentration_norm_qtk/(np.sum(concentration_norm_qtk,axis=0,keepdims=True))
 
-        final_img_tn3 = np.sum(weighted_qtn[...,None] * colormap_qtn3 , axis=0)
+        final_img_tk3 = np.sum(weighted_qtk[...,None] * colormap_qtk3 , axis=0)
 
-        plt.imshow(final_img_tn3,aspect = 'auto')
+        plt.imshow(final_img_tk3,aspect = 'auto',extent=extent)
         plt.gca().invert_yaxis()
         return
 
-    def pH(self):
-        cH_tn = self.sim_result.cH_tn
-        pH_tn = -np.log10(cH_tn)
-        final_img_tn3 = self._single_species_colormap(pH_tn,0,0)
+    def pH(self,t_range=None,n_range=None,num_pixels=None):
+        pyramid = self._pyramid(('pH',),lambda chunk: -np.log10(np.asarray(chunk.cH_tn))[None])
+        pH_qtk, extent = pyramid.view(t_range,n_range,num_pixels or self.num_pixels)
+        final_img_tk3 = self._single_species_colormap(pH_qtk[0],0,0,pyramid.min_q[0],pyramid.max_q[0])
 
-        plt.imshow(final_img_tn3,aspect = 'auto')
+        plt.imshow(final_img_tk3,aspect = 'auto',extent=extent)
         plt.gca().invert_yaxis()
         return
 
-    def _single_species_colormap(self,cmat_tn,hue,saturation):
+    def _single_species_colormap(self,cmat_tn,hue,saturation,cmin=None,cmax=None):
         hue = hue * np.ones_like(cmat_tn)
 
-        cmin = np.amin(cmat_tn)
-        cmax = np.amax(cmat_tn)
+        cmin = np.amin(cmat_tn) if cmin is None else cmin
+        cmax = np.amax(cmat_tn) if cmax is None else cmax
 
         lightness =  0.9 * (cmat_tn - cmin) / (cmax - cmin)
 
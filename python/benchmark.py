@@ -0,0 +1,210 @@
+import argparse
+import itertools
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import time
+
+from pathlib import Path
+import tensorflow as tf
+
+from cafes_input import load_species_db, parse_properties
+
+def make_inputs(num_grids, num_species, max_valence, sim_time=50.):
+    """ synthetic ITP input: HCl LE, HEPES TE, TRIS counter ion and anionic analytes
+
+    Analytes are picked deterministically from commonSpecies.json among the anions whose
+    mobility lies between TE and LE, so that they focus between the two. At least one
+    analyte carries max_valence valences, which sets the valence depth of the problem.
+    """
+    if num_species < 4:
+        raise ValueError('At least 4 species (LE, TE, counter ion, analyte) are needed')
+    species_db = load_species_db()
+    le = species_db['HYDROCHLORIC ACID']
+    te = species_db['HEPES']
+    counter_ion = species_db['TRIS']
+    candidates = sorted([specie for specie in species_db.species
+                         if len(specie['valence']) <= max_valence and
+                            all(valence < 0 for valence in specie['valence']) and
+                            te['mobility'][0] < specie['mobility'][0] < le['mobility'][0]],
+                        key=lambda specie: (-len(specie['valence']), specie['name']))
+    if len(candidates) < num_species - 3 or len(candidates[0]['valence']) != max_valence:
+        raise ValueError(f'Not enough analytes with up to {max_valence} valences')
+    # deepest analyte first, then spread the rest over the candidate list
+    analytes = candidates[:1] + candidates[1:][::max(len(candidates) // (num_species - 3), 1)]
+    analytes = analytes[:num_species - 3]
+
+    species = [
+        dict(le, injectionType='Right Plateau', injectionLoc=12e-3, initConcentration=100.),
+        dict(te, injectionType='Left Plateau', injectionLoc=12e-3, initConcentration=65.),
+        dict(counter_ion, injectionType='Uniform', initConcentration=200.),
+    ] + [dict(analyte, injectionType='Peak', injectionLoc=12e-3, injectionWidth=2e-3,
+              injectionAmount=100e-12) for analyte in analytes]
+    max_num_valence = max(len(specie['valence']) for specie in species)
+    return {
+        'simTime': sim_time,
+        'animateRate': 5,
+        'numGrids': num_grids,
+        'tolerance': 1e-2,
+        'interfaceWidth': 1e-3,
+        'domainLen': 40e-3,
+        'current': -10 / 1400e-6,
+        'area': 1400e-12,
+        'species': [{
+            **parse_properties(specie, max_num_valence),
+            'name': specie['name'],
+            'injectionType': specie['injectionType'],
+            'injectionAmount': specie.get('injectionAmount', float('nan')),
+            'injectionLoc': specie.get('injectionLoc', float('nan')),
+            'injectionWidth': specie.get('injectionWidth', float('nan')),
+            'initConcentration': specie.get('initConcentration', float('nan')),
+        } for specie in species],
+    }
+
+def run_config(num_grids, num_species, max_valence, num_steps, num_subdomains=1):
+    """ benchmark a single configuration in the current process """
+    from cafes import Cafes
+    from cafes_tf import CafesSimDecomposed, CafesSimMultiStep, num_subdomains_for
+
+    num_subdomains = num_subdomains_for(num_grids, num_subdomains)
+    if num_subdomains == 1:
+        base, base_args = CafesSimMultiStep, ()
+    else:
+        base, base_args = CafesSimDecomposed, (num_subdomains,)
+
+    class CountingSim(base):
+        """
+        simulation graph that counts steps, integration attempts, flux evaluations and
+        newton iterations
+        """
+        def __init__(self):
+            super(CountingSim, self).__init__(*base_args)
+            self.num_steps = tf.Variable(0, dtype=tf.int64)
+            self.num_flux = tf.Variable(0, dtype=tf.int64)
+            self.num_attempts = tf.Variable(0, dtype=tf.int64)
+            self.num_newton = tf.Variable(0, dtype=tf.int64)
+
+        def step(self, *args, **kwargs):
+            self.num_steps.assign_add(1)
+            return super(CountingSim, self).step(*args, **kwargs)
+
+        def calc_flux(self, *args):
+            self.num_flux.assign_add(1)
+            return super(CountingSim, self).calc_flux(*args)
+
+        def integrate(self, *args, **kwargs):
+            self.num_attempts.assign_add(1)
+            return super(CountingSim, self).integrate(*args, **kwargs)
+
+        def lz_func(self, *args):
+            # every newton iteration evaluates lz_func once
+            self.num_newton.assign_add(1)
+            return super(CountingSim, self).lz_func(*args)
+
+    inputs = make_inputs(num_grids, num_species, max_valence)
+    cafes = Cafes(inputs, model_sim=CountingSim())
+    start = time.time()
+    cafes.init()
+    init_time = time.time() - start
+    # first call traces the graph
+    start = time.time()
+    cafes.simulate(max_steps=1)
+    trace_time = time.time() - start
+    for counter in [cafes.model_sim.num_steps, cafes.model_sim.num_flux,
+                    cafes.model_sim.num_attempts, cafes.model_sim.num_newton]:
+        counter.assign(0)
+    t_start = cafes.t
+    start = time.time()
+    cafes.simulate(max_steps=num_steps)
+    run_time = time.time() - start
+    steps = int(cafes.model_sim.num_steps.numpy())
+    num_flux = int(cafes.model_sim.num_flux.numpy())
+    num_attempts = int(cafes.model_sim.num_attempts.numpy())
+    # every subdomain runs the newton iterations on its own points
+    num_newton = int(cafes.model_sim.num_newton.numpy()) / num_subdomains
+
+    return {
+        'num_grids': num_grids,
+        'num_species': num_species,
+        'max_valence': max_valence,
+        'num_subdomains': num_subdomains,
+        'species': [specie['name'] for specie in inputs['species']],
+        'init_time': init_time,
+        'init_newton_iterations': cafes.num_newton_iter,
+        'init_newton_converged': cafes.newton_converged,
+        'trace_time': trace_time,
+        'steps': steps,
+        'simulated_time': cafes.t - t_start,
+        'steps_per_sec': steps / run_time,
+        'flux_evals_per_step': num_flux / max(steps, 1),
+        'sim_newton_iterations_per_step': num_newton / max(steps, 1),
+        'rejected_ratio': (num_attempts - steps) / max(num_attempts, 1),
+        # ru_maxrss is in kilobytes on Linux
+        'peak_memory_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=Path(__file__).parent,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-o', '--output', type=str, default='benchmark.json',
+                        help='JSON file to store the results')
+    parser.add_argument('--grids', type=int, nargs='+', default=[500, 1000, 2000, 5000],
+                        help='numGrids to sweep')
+    parser.add_argument('--species', type=int, nargs='+', default=[4, 6, 8],
+                        help='species counts to sweep')
+    parser.add_argument('--valences', type=int, nargs='+', default=[1, 2, 3],
+                        help='max valence depths to sweep')
+    parser.add_argument('--subdomains', type=int, nargs='+', default=[1],
+                        help='subdomain counts to sweep (CafesSimDecomposed if > 1), capped '
+                             'by the grid size')
+    parser.add_argument('--steps', type=int, default=200,
+                        help='number of timed steps per configuration')
+    parser.add_argument('--config', type=str, default=None,
+                        help='(internal) run a single JSON encoded configuration')
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    args = parse_args()
+    if args.config is not None:
+        print(json.dumps(run_config(**json.loads(args.config))))
+        sys.exit(0)
+
+    # every configuration runs in a fresh CPU only process so peak memory is per config
+    env = dict(os.environ, CUDA_VISIBLE_DEVICES='-1', TF_CPP_MIN_LOG_LEVEL='2')
+    results = []
+    for num_grids, num_species, max_valence, num_subdomains in itertools.product(
+            args.grids, args.species, args.valences, args.subdomains):
+        config = dict(num_grids=num_grids, num_species=num_species,
+                      max_valence=max_valence, num_steps=args.steps,
+                      num_subdomains=num_subdomains)
+        proc = subprocess.run([sys.executable, __file__, '--config', json.dumps(config)],
+                              env=env, stdout=subprocess.PIPE, universal_newlines=True)
+        if proc.returncode != 0:
+            print(f'{config} failed', file=sys.stderr)
+            continue
+        result = json.loads(proc.stdout.strip().splitlines()[-1])
+        print(f"grids {num_grids:6d} species {num_species:2d} valence {max_valence} "
+              f"subdomains {result['num_subdomains']:2d}: "
+              f"{result['steps_per_sec']:8.1f} steps/s, "
+              f"{result['flux_evals_per_step']:.2f} flux/step, "
+              f"{result['init_newton_iterations']} newton, "
+              f"{result['rejected_ratio']:.3f} rejected, "
+              f"{result['peak_memory_mb']:.0f} MB")
+        results.append(result)
+    with open(args.output, 'w') as f:
+        json.dump({
+            'commit': git_commit(),
+            'tensorflow': tf.__version__,
+            'platform': platform.platform(),
+            'processor': platform.processor(),
+            'results': results,
+        }, f, indent=2)
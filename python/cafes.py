@@ -0,0 +1,534 @@
+import copy
+import glob
+import json
+import os
+import warnings
+
+import numpy as np
+
+from cafes_input import initial_concentrations, property_tensors
+from cafes_tf import EVENT_TYPES, CafesInit, CafesSimAdaptive, CafesSimDecomposed, \
+                     CafesSimEvents, CafesSimMovingFrame, CafesSimMultiStep, num_subdomains_for
+from utils import SimResult
+
+# relative tolerance of end time comparisons, the simulation graphs keep time in float32
+TIME_RTOL = 1e-6
+
+def time_reached(t, t_end):
+    """ whether the (float32) simulation time t reached t_end """
+    return t >= t_end - TIME_RTOL * abs(t_end)
+
+def num_intervals(t, interval):
+    """ number of whole intervals until the (float32) simulation time t """
+    return np.floor(t / interval + TIME_RTOL * max(t / interval, 1.))
+
+def list_checkpoints(checkpoint_dir):
+    """
+    Returns:
+        paths of the checkpoints saved into checkpoint_dir, oldest first
+    """
+    return sorted(glob.glob(os.path.join(checkpoint_dir, 'checkpoint_*.npz')))
+
+def load_checkpoint_history(checkpoint_dir, until=None):
+    """ all time slices recorded by the checkpoints of a run
+
+    Every checkpoint stores the time slices recorded since the previous one, so the
+    checkpoints up to one together hold the whole history of the run until then.
+
+    Args:
+        checkpoint_dir: directory the run saved its checkpoints into
+        until:          path of the last checkpoint to include, defaults to the latest
+
+    Returns:
+        SimResult of the recorded time slices
+    """
+    paths = list_checkpoints(checkpoint_dir)
+    if until is not None:
+        paths = paths[:paths.index(until) + 1]
+    segments = [dict(np.load(path)) for path in paths]
+    return SimResult(
+        inputs=json.loads(str(segments[-1]['inputs'])),
+        grid_n=segments[-1]['grid_n'],
+        concentration_tsn=np.concatenate([segment['concentration_tsn'] for segment in segments]),
+        cH_tn=np.concatenate([segment['cH_tn'] for segment in segments]),
+        efield_tn=np.concatenate([segment['efield_tn'] for segment in segments]),
+        time_t=np.concatenate([segment['time_t'] for segment in segments]),
+    )
+
+class Cafes:
+    """ Python driver of a Cafes simulation (counterpart of Cafes.js) """
+
+    def __init__(self, inputs, model_sim=None, model_init=None, output_interval=None,
+                 adaptive_grid=False, num_output_grids=None, num_grid_passes=5,
+                 window_grids=None, track_species=0, engine_cache=None, checkpoint_dir=None,
+                 checkpoint_interval=None, integrator='dorpri54', events=None,
+                 num_subdomains=None):
+        """
+        Args:
+            inputs:             parsed simulation inputs (same schema as the exported
+                                inputs.json)
+            model_sim:          fused multi step simulation graph, defaults to
+                                CafesSimMultiStep(), CafesSimAdaptive() if adaptive_grid,
+                                CafesSimMovingFrame() if window_grids, CafesSimEvents() if
+                                events or CafesSimDecomposed() if num_subdomains split the
+                                grid
+            model_init:         pH initialization graph, defaults to CafesInit()
+            output_interval:    record a time slice every this many seconds of simulated
+                                time, if None only the state at the end of every call to
+                                simulate() is recorded
+            adaptive_grid:      simulate the numGrids points on a grid that refines at the
+                                zone interfaces instead of a uniform one
+            num_output_grids:   number of uniform grid points the time slices are recorded
+                                on, defaults to numGrids (only used with adaptive_grid)
+            num_grid_passes:    number of equidistribution passes to build the initial
+                                adaptive grid from the analytical initial profiles
+            window_grids:       if given, only simulate a window of this many grid points
+                                that follows the zone down the channel
+            track_species:      index of the species whose steepest interface (usually the
+                                LE one) the window follows
+            engine_cache:       an EngineCache to pick a shape specialized (XLA compiled)
+                                simulation graph from, only used with the uniform grid
+            checkpoint_dir:     directory to save a checkpoint into at the end of every
+                                call to simulate(), see save_checkpoint
+            checkpoint_interval: also save a checkpoint every this many seconds of
+                                simulated time (without an output_interval, a time slice
+                                is recorded at every checkpoint)
+            integrator:         time integrator of the default simulation graph, 'dorpri54'
+                                or 'imex' (see CafesSim)
+            events:             events evaluated at every step on the uniform grid, a list
+                                of dictionaries with
+                                  type:      an EVENT_TYPES key, e.g. peak_position
+                                  species:   name or index of the species it evaluates
+                                  value:     the event triggers when the event function
+                                             crosses this value, required
+                                  level:     interface level relative to the maximum
+                                             (interface_position), defaults to .5
+                                  direction: > 0 only triggers on rising, < 0 only on
+                                             falling crossings, defaults to 0 (both)
+                                  terminal:  end the simulation at the event, defaults
+                                             to True
+                                  name:      name of its records, defaults to the type
+                                every triggered event is recorded into event_records
+            num_subdomains:     split the uniform grid into up to this many subdomains (0 for
+                                the number of CPUs), whose equilibrium and fluxes are
+                                computed on separate cores. Every subdomain holds at least
+                                MIN_SUBDOMAIN_GRIDS points, grids too small to be split
+                                use CafesSimMultiStep.
+        """
+        if adaptive_grid and window_grids is not None:
+            raise ValueError('Adaptive grid and moving window can not be combined')
+        if model_sim is None and engine_cache is not None and \
+                engine_cache.integrator != integrator:
+            raise ValueError(f'Engine cache uses the {engine_cache.integrator} integrator')
+        if events is not None and (adaptive_grid or window_grids is not None or
+                                   (model_sim is None and engine_cache is not None)):
+            raise ValueError('Events are only supported by the uniform grid CafesSimEvents')
+        if num_subdomains is not None and (adaptive_grid or window_grids is not None or
+                                           events is not None or
+                                           (model_sim is None and engine_cache is not None)):
+            raise ValueError('Subdomains are only supported by the uniform grid '
+                             'CafesSimDecomposed')
+        for event in events or []:
+            if event['type'] not in EVENT_TYPES:
+                raise ValueError(f'Unsupported event type {event["type"]}, choose from '
+                                 f'{list(EVENT_TYPES)}')
+            # every event type compares its event function against a value, without one
+            # it would silently never trigger
+            if event.get('value') is None:
+                raise ValueError(f'Event {event.get("name", event["type"])} needs a value')
+        self.inputs = inputs
+        self.output_interval = output_interval
+        self.adaptive_grid = adaptive_grid
+        self.window_grids = window_grids
+        self.track_species = track_species
+        self.integrator = integrator
+        self.num_output_grids = num_output_grids
+        self.events = events
+        # records of the triggered events, and the name of the terminal one that ended the run
+        self.event_records = []
+        self.stopped_by = None
+        self.checkpoint_dir = checkpoint_dir
+        self.checkpoint_interval = checkpoint_interval
+        self.num_checkpoints = 0
+        # index of the first recorded time slice not saved into a checkpoint yet
+        self.num_saved = 0
+        if model_sim is None:
+            if adaptive_grid:
+                model_sim = CafesSimAdaptive(integrator=integrator)
+            elif window_grids is not None:
+                model_sim = CafesSimMovingFrame(integrator=integrator)
+            elif events is not None:
+                model_sim = CafesSimEvents(integrator)
+            elif num_subdomains is not None and \
+                    num_subdomains_for(inputs['numGrids'], num_subdomains) > 1:
+                # grids too small to split run on the single domain graph below
+                model_sim = CafesSimDecomposed(
+                    num_subdomains_for(inputs['numGrids'], num_subdomains), integrator)
+            elif engine_cache is not None:
+                num_species = len(inputs['species'])
+                max_deg = len(inputs['species'][0]['coeffList'])
+                model_sim = engine_cache.get(num_species, max_deg, inputs['numGrids'])
+            else:
+                model_sim = CafesSimMultiStep(integrator)
+        self.model_sim = model_sim
+        self.model_init = model_init or CafesInit()
+        self.dx = inputs['domainLen'] / inputs['numGrids']
+        # x_n is the simulation grid, grid_n the grid of the recorded time slices
+        self.x_n = (np.arange(inputs['numGrids']) * self.dx).astype(np.float32)
+        self.grid_n = np.arange(inputs['numGrids']) * self.dx
+        if adaptive_grid and num_output_grids is not None:
+            self.grid_n = np.arange(num_output_grids) * \
+                          inputs['domainLen'] / num_output_grids
+        self.t = 0.
+        self.dt = 1e-3
+        self.concentration_sn = self._initial_concentrations()
+        if adaptive_grid:
+            for _ in range(num_grid_passes):
+                self.x_n = self.model_sim.adapt_grid(self.x_n, self.concentration_sn).numpy()
+                self.concentration_sn = self._initial_concentrations()
+        if window_grids is not None:
+            # place the tracked interface at the same relative position the graph keeps it
+            self.max_offset = inputs['numGrids'] - window_grids
+            c_track_n = self.concentration_sn[track_species]
+            interface_idx = np.argmax(np.abs(np.diff(c_track_n)))
+            self.offset = int(np.clip(
+                interface_idx - int(model_sim.target_fraction * window_grids),
+                0, self.max_offset))
+            self.x_n = self.x_n[self.offset:self.offset + window_grids]
+            self.concentration_sn = self.concentration_sn[:, self.offset:self.offset + window_grids]
+        # equilibrium params
+        properties = property_tensors(inputs)
+        self.val_mat_sd = properties['val_mat_sd']
+        self.u_mat_sd = properties['u_mat_sd']
+        self.d_mat_sd = properties['d_mat_sd']
+        self.l_mat_sd = properties['l_mat_sd']
+        self.cH_n = None
+
+    def _initial_concentrations(self):
+        return initial_concentrations(self.inputs, self.x_n)
+
+    def _resample(self, y_n, offset=None):
+        """ resample values on the simulation grid onto the recording grid """
+        if self.window_grids is not None:
+            # extend the plateaus at the window edges over the rest of the channel
+            offset = self.offset if offset is None else offset
+            return y_n[..., np.clip(np.arange(self.inputs['numGrids']) - offset,
+                                    0, self.window_grids - 1)]
+        if not self.adaptive_grid:
+            return y_n
+        return np.stack([np.interp(self.grid_n, self.x_n, y_i_n)
+                         for y_i_n in np.reshape(y_n, (-1, y_n.shape[-1]))]) \
+                 .reshape(y_n.shape[:-1] + self.grid_n.shape).astype(np.float32)
+
+    def _params(self, dx=True):
+        params = {
+            'l_mat_sd': self.l_mat_sd,
+            'val_mat_sd': self.val_mat_sd,
+            'u_mat_sd': self.u_mat_sd,
+            'd_mat_sd': self.d_mat_sd,
+            'current': np.float32(self.inputs['current']),
+        }
+        if dx:
+            # only the electric field depends on dx, which the adaptive grid recomputes
+            params['dx'] = np.float32(self.dx)
+        return params
+
+    def _event_args(self):
+        names = [specie['name'] for specie in self.inputs['species']]
+        column = lambda key, default, dtype: np.array(
+            [event.get(key, default) for event in self.events], dtype=dtype)
+        return {
+            'event_type_e': np.array([EVENT_TYPES[event['type']] for event in self.events],
+                                     dtype=np.int32),
+            'event_species_e': np.array([
+                names.index(event['species']) if isinstance(event['species'], str)
+                else event['species'] for event in self.events], dtype=np.int32),
+            'event_level_e': column('level', .5, np.float32),
+            'event_value_e': np.array([event['value'] for event in self.events],
+                                      dtype=np.float32),
+            'event_direction_e': column('direction', 0., np.float32),
+            'event_terminal_e': column('terminal', True, bool),
+        }
+
+    def init(self, cH_n=None):
+        """ initialize pH and record the initial time slice
+
+        Args:
+            cH_n:   optional cached cH solution used as the initial newton guess
+        """
+        if cH_n is None:
+            cH_n, efield_n, num_iter, converged = self.model_init(
+                c_mat_sn=self.concentration_sn, **self._params())
+        else:
+            cH_n, efield_n, num_iter, converged = self.model_init.warm_start(
+                cH_n=np.asarray(cH_n, dtype=np.float32), c_mat_sn=self.concentration_sn,
+                **self._params())
+        if self.adaptive_grid:
+            efield_n = self.model_sim.electric_field(
+                x_n=self.x_n, cH_n=cH_n, c_mat_sn=self.concentration_sn,
+                **self._params(dx=False))
+        self.num_newton_iter = int(num_iter)
+        self.newton_converged = bool(converged)
+        if not self.newton_converged:
+            warnings.warn(f'pH initialization did not converge within {self.num_newton_iter} '
+                          'newton iterations, raise max_newton_iter of model_init')
+        self.cH_n = cH_n.numpy()
+        self.concentration_tsn = [self._resample(self.concentration_sn)]
+        self.cH_tn = [self._resample(self.cH_n)]
+        self.efield_tn = [self._resample(efield_n.numpy())]
+        self.time_t = [self.t]
+
+    def simulate(self, t_end=None, max_steps=np.iinfo(np.int32).max):
+        """ advance the simulation in a single graph call, or one call per checkpoint
+        interval when checkpointing
+
+        Args:
+            t_end:      time to simulate until, defaults to the input simTime
+            max_steps:  maximum number of accepted steps to take
+
+        Returns:
+            True if there is still time left to simulate, no terminal event ended the
+            simulation and the call made progress
+        """
+        t_end = self.inputs['simTime'] if t_end is None else t_end
+        if time_reached(self.t, t_end) or self.stopped_by is not None:
+            return False
+        num_steps = 0
+        while not time_reached(self.t, t_end) and num_steps < max_steps and \
+                self.stopped_by is None:
+            t_stop = t_end
+            if self.checkpoint_interval is not None:
+                t_stop = min(t_end, (num_intervals(self.t, self.checkpoint_interval) + 1) *
+                                    self.checkpoint_interval)
+            num_steps += self._simulate(t_stop, max_steps - num_steps)
+            if self.checkpoint_interval is None or not time_reached(self.t, t_stop) or \
+                    self.stopped_by is not None:
+                break
+            if self.checkpoint_dir is not None and not time_reached(self.t, t_end):
+                self.save_checkpoint()
+        if self.checkpoint_dir is not None:
+            self.save_checkpoint()
+        return not time_reached(self.t, self.inputs['simTime']) and \
+               self.stopped_by is None and num_steps > 0
+
+    def _simulate(self, t_end, max_steps):
+        """
+        Returns:
+            number of steps taken
+        """
+        if self.output_interval is None:
+            output_times_t = np.zeros(0, dtype=np.float32)
+        else:
+            # output times in (t, t_end], a time at t was recorded by the previous call
+            output_times_t = np.minimum(
+                np.arange(num_intervals(self.t, self.output_interval) + 1,
+                          num_intervals(t_end, self.output_interval) + 1) * self.output_interval,
+                t_end).astype(np.float32)
+        sim_args = dict(
+            cH_n=self.cH_n,
+            c_mat_sn=self.concentration_sn,
+            dt=np.float32(self.dt),
+            tolerance=np.float32(self.inputs['tolerance']),
+            t=np.float32(self.t),
+            t_end=np.float32(t_end),
+            max_steps=np.int32(max_steps),
+            output_times_t=output_times_t,
+        )
+        if self.adaptive_grid:
+            x_n, cH_n, efield_n, concentration_sn, t, dt, num_steps, _, time_t, concentration_tsn, \
+                cH_tn, efield_tn = self.model_sim(
+                    x_n=self.x_n, output_grid_k=self.grid_n.astype(np.float32),
+                    **sim_args, **self._params(dx=False))
+            self.x_n = x_n.numpy()
+        elif self.window_grids is not None:
+            cH_n, efield_n, concentration_sn, t, dt, num_steps, offset, time_t, concentration_tsn, \
+                cH_tn, efield_tn, offset_t = self.model_sim(
+                    offset=np.int32(self.offset), max_offset=np.int32(self.max_offset),
+                    track_species=np.int32(self.track_species),
+                    **sim_args, **self._params())
+            self.offset = int(offset)
+            self.x_n = (np.arange(self.offset, self.offset + self.window_grids) * self.dx) \
+                       .astype(np.float32)
+        elif self.events is not None:
+            cH_n, efield_n, concentration_sn, t, dt, num_steps, time_t, concentration_tsn, cH_tn, \
+                efield_tn, event_time_k, event_idx_k, event_concentration_ksn, event_cH_kn, \
+                event_efield_kn, stopped = self.model_sim(
+                    **sim_args, **self._params(), **self._event_args())
+            for event_time, event_idx, concentration_sn_k, cH_n_k, efield_n_k in zip(
+                    event_time_k.numpy(), event_idx_k.numpy(), event_concentration_ksn.numpy(),
+                    event_cH_kn.numpy(), event_efield_kn.numpy()):
+                event = self.events[event_idx]
+                self.event_records.append({
+                    'name': event.get('name', event['type']),
+                    'time': float(event_time),
+                    'concentration_sn': concentration_sn_k,
+                    'cH_n': cH_n_k,
+                    'efield_n': efield_n_k,
+                })
+                if bool(stopped) and event.get('terminal', True):
+                    self.stopped_by = self.event_records[-1]['name']
+        else:
+            cH_n, efield_n, concentration_sn, t, dt, num_steps, time_t, concentration_tsn, cH_tn, \
+                efield_tn = self.model_sim(**sim_args, **self._params())
+        # update to new states
+        self.cH_n = cH_n.numpy()
+        self.concentration_sn = concentration_sn.numpy()
+        self.t = float(t)
+        self.dt = float(dt)
+        # extract data
+        if self.output_interval is None:
+            self.time_t.append(self.t)
+            self.concentration_tsn.append(self._resample(self.concentration_sn))
+            self.cH_tn.append(self._resample(self.cH_n))
+            self.efield_tn.append(self._resample(efield_n.numpy()))
+        elif self.window_grids is not None:
+            self.time_t.extend(time_t.numpy())
+            for concentration_sn, cH_n, efield_n, offset in zip(
+                    concentration_tsn.numpy(), cH_tn.numpy(), efield_tn.numpy(),
+                    offset_t.numpy()):
+                self.concentration_tsn.append(self._resample(concentration_sn, offset))
+                self.cH_tn.append(self._resample(cH_n, offset))
+                self.efield_tn.append(self._resample(efield_n, offset))
+        else:
+            self.time_t.extend(time_t.numpy())
+            self.concentration_tsn.extend(concentration_tsn.numpy())
+            self.cH_tn.extend(cH_tn.numpy())
+            self.efield_tn.extend(efield_tn.numpy())
+
+        return int(num_steps)
+
+    def checkpoint(self):
+        """
+        Returns:
+            the state the simulation continues from (with the inputs it was run with)
+        """
+        state = {
+            'inputs': json.dumps(self.inputs),
+            't': self.t,
+            'dt': self.dt,
+            'cH_n': self.cH_n,
+            'concentration_sn': self.concentration_sn,
+        }
+        if self.adaptive_grid:
+            state['x_n'] = self.x_n
+        if self.window_grids is not None:
+            state['offset'] = self.offset
+        return state
+
+    def save_checkpoint(self, path=None):
+        """ save the state and the time slices recorded since the previous checkpoint
+
+        Args:
+            path:   .npz file to save into, defaults to the next checkpoint_<index>.npz of
+                    the checkpoint_dir
+
+        Returns:
+            path of the checkpoint
+        """
+        if path is None:
+            path = os.path.join(self.checkpoint_dir, f'checkpoint_{self.num_checkpoints:06d}.npz')
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        num_grids = len(self.grid_n)
+        new_slices = slice(self.num_saved, None)
+        segment = {
+            'index': self.num_checkpoints,
+            'grid_n': self.grid_n,
+            'time_t': np.array(self.time_t[new_slices], dtype=np.float32),
+            'concentration_tsn': np.reshape(self.concentration_tsn[new_slices],
+                                            (-1, len(self.inputs['species']), num_grids)),
+            'cH_tn': np.reshape(self.cH_tn[new_slices], (-1, num_grids)),
+            'efield_tn': np.reshape(self.efield_tn[new_slices], (-1, num_grids)),
+        }
+        # write to a temporary file first, a crash while saving keeps the previous one
+        tmp_path = path + '.tmp.npz'
+        np.savez(tmp_path, **self.checkpoint(), **segment)
+        os.replace(tmp_path, path)
+        self.num_checkpoints += 1
+        self.num_saved = len(self.time_t)
+        return path
+
+    def restore(self, state):
+        """ continue the simulation from a checkpoint
+
+        Only the time slices recorded after the checkpoint are recorded by this driver, the
+        earlier ones stay with the run that saved it (see load_checkpoint_history).
+
+        Args:
+            state:  checkpoint() of a run, or its loaded .npz
+        """
+        concentration_sn = np.asarray(state['concentration_sn'], dtype=np.float32)
+        if concentration_sn.shape != self.concentration_sn.shape:
+            raise ValueError(f'Checkpoint of shape {concentration_sn.shape} does not match '
+                             f'the simulation of shape {self.concentration_sn.shape}')
+        self.concentration_sn = concentration_sn
+        self.cH_n = np.asarray(state['cH_n'], dtype=np.float32)
+        self.t = float(state['t'])
+        self.dt = float(state['dt'])
+        if self.adaptive_grid:
+            self.x_n = np.asarray(state['x_n'], dtype=np.float32)
+        if self.window_grids is not None:
+            self.offset = int(state['offset'])
+            self.x_n = (np.arange(self.offset, self.offset + self.window_grids) * self.dx) \
+                       .astype(np.float32)
+        if 'index' in state:
+            # continue the numbering, so a resumed run replaces the checkpoints after it
+            self.num_checkpoints = int(state['index']) + 1
+        self.concentration_tsn, self.cH_tn, self.efield_tn, self.time_t = [], [], [], []
+        self.num_saved = 0
+
+    @classmethod
+    def from_checkpoint(cls, path, inputs=None, **kwargs):
+        """ resume a run from a saved checkpoint
+
+        Args:
+            path:   .npz file saved by save_checkpoint
+            inputs: inputs to continue with, defaults to the ones of the checkpoint
+            kwargs: remaining Cafes arguments, which should match the ones of the run
+
+        Returns:
+            a Cafes driver continuing from the checkpoint
+        """
+        state = dict(np.load(path))
+        cafes = cls(json.loads(str(state['inputs'])) if inputs is None else inputs, **kwargs)
+        cafes.restore(state)
+        return cafes
+
+    def fork(self, checkpoint_dir=None, **input_changes):
+        """ branch a variant of the run off its current state
+
+        The fork shares the simulation graphs, so branching e.g. a current change at time t
+        from a common prefix skips recomputing the prefix.
+
+        Args:
+            checkpoint_dir: checkpoint directory of the fork (not shared with this run)
+            input_changes:  inputs to change, e.g. current or simTime. The grid and the
+                            species have to stay the same.
+
+        Returns:
+            a Cafes driver continuing from the current state with the changed inputs
+        """
+        for key in ['numGrids', 'domainLen', 'species']:
+            if key in input_changes and input_changes[key] != self.inputs[key]:
+                raise ValueError(f'A fork can not change {key}')
+        cafes = Cafes(dict(self.inputs, **input_changes), model_sim=self.model_sim,
+                      model_init=self.model_init, output_interval=self.output_interval,
+                      adaptive_grid=self.adaptive_grid, num_output_grids=self.num_output_grids,
+                      num_grid_passes=0, window_grids=self.window_grids,
+                      track_species=self.track_species, checkpoint_dir=checkpoint_dir,
+                      checkpoint_interval=self.checkpoint_interval, integrator=self.integrator,
+                      events=self.events)
+        cafes.restore(self.checkpoint())
+        # the events recorded before the fork point belong to the history of the fork too
+        cafes.event_records = copy.deepcopy(self.event_records)
+        return cafes
+
+    def to_sim_result(self):
+        """ pack all recorded time slices into a SimResult """
+        return SimResult(
+            inputs=self.inputs,
+            grid_n=self.grid_n,
+            concentration_tsn=np.stack(self.concentration_tsn),
+            cH_tn=np.stack(self.cH_tn),
+            efield_tn=np.stack(self.efield_tn),
+            time_t=np.array(self.time_t, dtype=np.float32),
+        )
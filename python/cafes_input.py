@@ -0,0 +1,279 @@
+import functools
+import json
+from pathlib import Path
+
+import numpy as np
+
+COMMON_SPECIES = Path(__file__).resolve().parent.parent / 'src' / 'commonSpecies.json'
+
+R = 8.314       # Gas constant [J/(mol K)]
+T = 298.        # Room Temperature [K]
+F = 96500.      # Faraday constant [C/mol]
+
+PROPERTY_KEYS = ('zList', 'uList', 'dList', 'coeffList')
+
+def _split(value):
+    """ property list of a specie, either a list or a UI string like '-1, -2' """
+    if isinstance(value, str):
+        return [float(item) for item in value.replace(' ', '').split(',')]
+    return [float(item) for item in value]
+
+def compile_properties(valence_kv, mobility_kv, pka_kv, max_deg):
+    """ python port of CafesInput.parseProperties (src/Cafes.js), vectorized over species
+
+    Args:
+        valence_kv:     valences of k species, padded with NaN to the longest list
+        mobility_kv:    mobilities [1e-9 m^2 / (V s)], padded with NaN
+        pka_kv:         pKas, padded with NaN
+        max_deg:        maximum number of valences across all species + 1
+
+    Returns:
+        zList, uList, dList and coeffList [k, max_deg] of the species, sorted by valence
+        with the neutral valence 0 added and padded with 0
+    """
+    valence_kv = np.asarray(valence_kv, dtype=np.float64)
+    num_species, num_valence = valence_kv.shape
+    if num_valence + 1 > max_deg:
+        raise ValueError(f'Species with {num_valence} valences exceed max_deg {max_deg}')
+    valid_kv = ~np.isnan(valence_kv)
+    num_deg_k = valid_kv.sum(axis=1) + 1
+    mobility_kv = np.asarray(mobility_kv, dtype=np.float64) * 1e-9
+    diffusivity_kv = np.abs(R * T * mobility_kv / (F * valence_kv))
+    # add in valence 0, its diffusivity is the mean of the other ones
+    valence_kv = np.concatenate([valence_kv, np.zeros((num_species, 1))], axis=1)
+    mobility_kv = np.concatenate([mobility_kv * np.sign(valence_kv[:, :-1]),
+                                  np.zeros((num_species, 1))], axis=1)
+    ka_kv = np.concatenate([10**-np.asarray(pka_kv, dtype=np.float64),
+                            np.ones((num_species, 1))], axis=1)
+    diffusivity_kv = np.concatenate([
+        diffusivity_kv, (np.where(valid_kv, diffusivity_kv, 0.).sum(axis=1) /
+                         (num_deg_k - 1))[:, None]], axis=1)
+    # sort according to valence, the padding last
+    order_kv = np.argsort(np.where(np.isnan(valence_kv), np.inf, valence_kv), axis=1,
+                          kind='stable')
+    take = lambda y_kv: np.nan_to_num(np.take_along_axis(y_kv, order_kv, axis=1))
+    valence_kv, mobility_kv, ka_kv, diffusivity_kv = map(
+        take, (valence_kv, mobility_kv, ka_kv, diffusivity_kv))
+    # calculate equilibrium coefficients, the products of the Ka between a valence and the
+    # neutral one (at index -min valence), multiplied in the same order as Cafes.js
+    neutral_k = -valence_kv[:, 0].astype(int)
+    idx_v = np.arange(valence_kv.shape[1])
+    coeff_kv = np.ones_like(ka_kv)
+    for idx in idx_v:
+        lower_k = np.where(valence_kv[:, idx] < 0, idx, neutral_k)
+        upper_k = np.where(valence_kv[:, idx] > 0, idx + 1, neutral_k)
+        product_k = np.ones(num_species)
+        for factor_idx in idx_v:
+            in_range_k = (lower_k <= factor_idx) & (factor_idx < np.maximum(upper_k, neutral_k))
+            product_k = product_k * np.where(in_range_k, ka_kv[:, factor_idx], 1.)
+        coeff_kv[:, idx] = np.where(valence_kv[:, idx] > 0, 1. / product_k, product_k)
+    coeff_kv = np.where(idx_v < num_deg_k[:, None], coeff_kv, 0.)
+    padding = lambda y_kv: np.pad(y_kv, [[0, 0], [0, max_deg - y_kv.shape[1]]])
+    return dict(zip(PROPERTY_KEYS, map(padding, (
+        valence_kv, mobility_kv, diffusivity_kv, coeff_kv))))
+
+@functools.lru_cache(maxsize=None)
+def _parse_properties(valences, mobilities, pkas, max_deg):
+    properties = compile_properties([valences], [mobilities], [pkas], max_deg)
+    return {key: tuple(value_kd[0].tolist()) for key, value_kd in properties.items()}
+
+def parse_properties(specie, max_num_valence):
+    """ properties of a single specie, memoized on its valence, mobility and pKa lists
+
+    Args:
+        specie:             specie with valence, mobility [1e-9 m^2 / (V s)] and pKa lists
+                            (or UI strings), a specie with propertyValid false gets zeros
+        max_num_valence:    maximum number of valences across all species
+
+    Returns:
+        zList, uList, dList and coeffList of the specie, padded to max_num_valence + 1
+    """
+    max_deg = max_num_valence + 1
+    if not specie.get('propertyValid', True):
+        return {key: [0.] * max_deg for key in PROPERTY_KEYS}
+    properties = _parse_properties(*(tuple(_split(specie[key]))
+                                     for key in ['valence', 'mobility', 'pKa']), max_deg)
+    return {key: list(value) for key, value in properties.items()}
+
+class SpeciesDB:
+    """ species database as an array table indexed by name
+
+    The properties of all species are compiled once, so looking up the rows of any set of
+    species is a gather.
+    """
+    def __init__(self, species):
+        """
+        Args:
+            species:    list of species with name, valence, mobility and pKa lists
+        """
+        self.species = species
+        self.names = [specie['name'] for specie in species]
+        self.index = {name: idx for idx, name in enumerate(self.names)}
+        self.num_valence_k = np.array([len(specie['valence']) for specie in species])
+        self.max_deg = int(self.num_valence_k.max()) + 1
+        pad = lambda key: np.array([
+            specie[key] + [np.nan] * (self.max_deg - 1 - len(specie[key]))
+            for specie in species], dtype=np.float64)
+        self.properties = compile_properties(pad('valence'), pad('mobility'), pad('pKa'),
+                                             self.max_deg)
+
+    @classmethod
+    def from_file(cls, path=COMMON_SPECIES):
+        with open(path, 'r') as f:
+            return cls(json.load(f))
+
+    def __len__(self):
+        return len(self.species)
+
+    def __contains__(self, name):
+        return name in self.index
+
+    def __getitem__(self, name):
+        return self.species[self.index[name]]
+
+    def lookup(self, names, max_num_valence=None):
+        """
+        Args:
+            names:              names of the species
+            max_num_valence:    maximum number of valences to pad to, defaults to the
+                                maximum across the species
+
+        Returns:
+            zList, uList, dList and coeffList [s, max_num_valence + 1] of the species
+        """
+        idx_s = np.array([self.index[name] for name in names], dtype=int)
+        max_deg = int(self.num_valence_k[idx_s].max()) + 1
+        if max_num_valence is not None:
+            if max_num_valence + 1 < max_deg:
+                raise ValueError(f'Species with {max_deg - 1} valences exceed '
+                                 f'max_num_valence {max_num_valence}')
+            max_deg = max_num_valence + 1
+        return {key: np.pad(value_kd[idx_s, :max_deg],
+                            [[0, 0], [0, max(max_deg - self.max_deg, 0)]])
+                for key, value_kd in self.properties.items()}
+
+@functools.lru_cache(maxsize=None)
+def load_species_db(path=COMMON_SPECIES):
+    """ SpeciesDB of a species JSON file, loaded once per process """
+    return SpeciesDB.from_file(path)
+
+def parse_inputs(ui_inputs, species_db=None):
+    """ python port of CafesInput.parse (src/Cafes.js), from UI units to SI
+
+    Species without valence, mobility and pKa take their properties from the species
+    database by name.
+
+    Args:
+        ui_inputs:  dictionary with the CafesInput fields (simTime, animateRate, numGrids,
+                    tolerance, interfaceWidth [mm], domainLen [mm], current [uA],
+                    area [um^2] and species with injectionAmount [pmol], injectionLoc [mm]
+                    and injectionWidth [mm])
+        species_db: SpeciesDB of species given by name only, defaults to commonSpecies.json
+
+    Returns:
+        simulation inputs (same schema as the exported inputs.json)
+    """
+    species = []
+    for specie in ui_inputs['species']:
+        if 'valence' not in specie:
+            specie = dict((species_db or load_species_db())[specie['name']], **specie)
+        species.append(specie)
+    max_num_valence = max(len(_split(specie['valence'])) for specie in species)
+    return {
+        'simTime': float(ui_inputs['simTime']),
+        'animateRate': int(ui_inputs['animateRate']),
+        'numGrids': int(ui_inputs['numGrids']),
+        'tolerance': float(ui_inputs['tolerance']),
+        'interfaceWidth': float(ui_inputs['interfaceWidth']) * 1e-3,
+        'domainLen': float(ui_inputs['domainLen']) * 1e-3,
+        'current': float(ui_inputs['current']) / (float(ui_inputs['area']) * 1e-6),
+        'area': float(ui_inputs['area']) * 1e-12,
+        'species': [{
+            **parse_properties(specie, max_num_valence),
+            'name': specie['name'],
+            'injectionType': specie['injectionType'],
+            'injectionAmount': float(specie.get('injectionAmount', np.nan)) * 1e-12,
+            'injectionLoc': float(specie.get('injectionLoc', np.nan)) * 1e-3,
+            'injectionWidth': float(specie.get('injectionWidth', np.nan)) * 1e-3,
+            'initConcentration': float(specie.get('initConcentration', np.nan)),
+        } for specie in species],
+    }
+
+def property_tensors(inputs):
+    """
+    Returns:
+        l_mat_sd, val_mat_sd, u_mat_sd and d_mat_sd of the simulation inputs
+    """
+    stack = lambda key: np.array([specie[key] for specie in inputs['species']],
+                                 dtype=np.float32)
+    return {
+        'l_mat_sd': stack('coeffList'),
+        'val_mat_sd': stack('zList'),
+        'u_mat_sd': stack('uList'),
+        'd_mat_sd': stack('dList'),
+    }
+
+def cell_widths(x_n):
+    """ widths of the control volumes around the grid points """
+    dx_m = np.diff(x_n)
+    return np.concatenate([dx_m[:1], .5 * (dx_m[1:] + dx_m[:-1]), dx_m[-1:]])
+
+def initial_concentrations(inputs, x_n):
+    """ erf profiles of the injections, computed for all species at once
+
+    Args:
+        inputs:     simulation inputs
+        x_n:        grid points (float32)
+
+    Returns:
+        c_mat_sn, the initial concentrations on the grid
+    """
+    import tensorflow as tf
+
+    species = inputs['species']
+    x_n = np.asarray(x_n, dtype=np.float32)
+    column = lambda key: np.nan_to_num(np.array(
+        [specie[key] for specie in species], dtype=np.float32))[:, None]
+    injection_types = np.array([specie['injectionType'] for specie in species])
+    unsupported = set(injection_types) - {'Left Plateau', 'Right Plateau', 'Peak', 'Uniform'}
+    if unsupported:
+        raise ValueError(f'Unsupported specie type {unsupported.pop()}')
+    is_type = lambda injection_type: (injection_types == injection_type)[:, None]
+    loc_s1, width_s1 = column('injectionLoc'), column('injectionWidth')
+    init_concentration_s1 = column('initConcentration')
+    amount_s1 = column('injectionAmount')
+
+    erf = lambda x_sn: tf.math.erf(x_sn / np.float32(.5 * inputs['interfaceWidth'])).numpy()
+    # plateaus ignore injectionWidth, as in Cafes.js
+    erf_sn = erf(x_n - loc_s1)
+    plateau_sn = np.where(is_type('Left Plateau'), 1. - erf_sn, 1. + erf_sn) * \
+                 init_concentration_s1 / 2
+    erf_left_sn = erf(x_n - loc_s1 + width_s1 / 2)
+    erf_right_sn = erf(x_n - loc_s1 - width_s1 / 2)
+    c_raw_sn = erf_left_sn - erf_right_sn
+    with np.errstate(divide='ignore', invalid='ignore'):
+        peak_sn = c_raw_sn * amount_s1 / (np.float32(inputs['area']) * np.sum(
+            c_raw_sn * cell_widths(x_n), axis=-1, keepdims=True))
+    uniform_sn = np.ones_like(c_raw_sn) * init_concentration_s1
+    return np.select([is_type('Peak'), is_type('Uniform')], [peak_sn, uniform_sn],
+                     plateau_sn).astype(np.float32)
+
+def compile_inputs(inputs, x_n=None):
+    """ simulation inputs to the tensors of the CafesInit / CafesSim graphs
+
+    Args:
+        inputs:     simulation inputs
+        x_n:        grid points, defaults to the uniform grid of numGrids points
+
+    Returns:
+        c_mat_sn, l_mat_sd, val_mat_sd, u_mat_sd, d_mat_sd, current and dx
+    """
+    dx = inputs['domainLen'] / inputs['numGrids']
+    if x_n is None:
+        x_n = (np.arange(inputs['numGrids']) * dx).astype(np.float32)
+    return {
+        'c_mat_sn': initial_concentrations(inputs, x_n),
+        **property_tensors(inputs),
+        'current': np.float32(inputs['current']),
+        'dx': np.float32(dx),
+    }
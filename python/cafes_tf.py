@@ -37,34 +37,195 @@ DORPRI54_TABLEAU = {
         [35/384,     0,           500/1113,   125/192, -2187/6784, 11/84],
     ],
     'c4': [5179/57600, 0, 7571/16695, 393/640, -92097/339200, 187/2100, 1/40],
+    # continuous extension (Hairer's dopri5 dense output)
+    'dense': [-12715105075/11282082432, 0, 87487479700/32700410799,
+              -10690763975/1880347072, 701980252875/199316789632,
+              -1453857185/822651844, 69997945/29380423],
 }
 
+# exponents of the PI step size controller (Hairer's dopri5)
+PI_ALPHA = 0.17
+PI_BETA = 0.04
+
+# ARS(2,2,2) IMEX Runge-Kutta scheme (Ascher, Ruuth & Spiteri 1997), L-stable and stiffly
+# accurate implicit part
+ARS222_GAMMA = 1 - 2**-.5
+ARS222_DELTA = 1 - 1 / (2 * ARS222_GAMMA)
+
+# step size controller exponents per integrator, scaled to the order of its error estimate
+# (the IMEX error is estimated against the first order IMEX Euler solution)
+INTEGRATORS = {
+    'dorpri54': (PI_ALPHA, PI_BETA),
+    'imex': (0.35, 0.2),
+}
+
+# event functions of CafesSimEvents, evaluated on the concentration of a single species:
+#   peak_position:      position of the maximum, refined by a parabola through its neighbours
+#   interface_position: first position where the concentration crosses level * maximum
+#   zone_width:         width of a plateau of the same variance, sqrt(12) standard deviations
+#   zone_width_rate:    magnitude of the relative rate of change of zone_width [1/s]
+EVENT_TYPES = {
+    'peak_position': 0,
+    'interface_position': 1,
+    'zone_width': 2,
+    'zone_width_rate': 3,
+}
+# number of neighbouring grid points on either side that calc_flux reads (the limiter
+# stencil), i.e. the halo width of the subdomains of CafesSimDecomposed
+HALO_WIDTH = 2
+# smallest number of grid points per subdomain, smaller ones cost more in op dispatch and
+# halo overhead than they gain in parallelism
+MIN_SUBDOMAIN_GRIDS = 64
+
+# upper bound on max_deg (the number of valences of a species + 1, 5 across the species
+# database), the powers of cH are unrolled to it when the graph does not fix max_deg
+MAX_DEG = 8
+
+# Illinois iterations to locate an event within a step, and their tolerance on theta
+EVENT_MAX_ITER = 30
+EVENT_THETA_TOL = 1e-6
+
+def num_subdomains_for(num_grids, max_subdomains=None):
+    """
+    Returns:
+        number of subdomains of a grid of num_grids points, at most max_subdomains
+        (defaults to the number of CPUs) with at least MIN_SUBDOMAIN_GRIDS points each
+    """
+    return max(min(max_subdomains or os.cpu_count(), num_grids // MIN_SUBDOMAIN_GRIDS), 1)
+
+def stack_snapshots(snapshots, element_shape):
+    """ stack a TensorArray of snapshots, which may be empty """
+    return tf.cond(snapshots.size() > 0, snapshots.stack,
+                   lambda: tf.zeros(tf.concat([[0], element_shape], axis=0)))
+
+def interp_linear(xq_k, x_n, y_n):
+    """ piecewise linear interpolation along the last axis of y_n sampled at sorted x_n """
+    idx_k = tf.clip_by_value(tf.searchsorted(x_n, xq_k, side='right') - 1,
+                             0, tf.size(x_n) - 2)
+    x_left_k = tf.gather(x_n, idx_k)
+    x_right_k = tf.gather(x_n, idx_k + 1)
+    w_k = tf.clip_by_value(
+        tf.math.divide_no_nan(xq_k - x_left_k, x_right_k - x_left_k), 0., 1.)
+    y_left_k = tf.gather(y_n, idx_k, axis=-1)
+    y_right_k = tf.gather(y_n, idx_k + 1, axis=-1)
+    return y_left_k + w_k * (y_right_k - y_left_k)
+
+def remap_conservative(x_new_k, x_n, c_mat_sn):
+    """
+    remap the cell averages c_mat_sn on grid x_n onto grid x_new_k (with the same end
+    points), by interpolating the cumulative mass at the cell edges with a monotone
+    (Fritsch-Butland) Hermite cubic
+
+    The cumulative mass is differenced in float64 and the end edges of the domain stay
+    where they are, so mass is conserved. A cell is clamped to the range of the source
+    cells it overlaps and their neighbours, so no new extrema are created, and the mass the
+    clamping removes is given back to the cells in proportion to their room within it.
+    """
+    cell_edges = lambda x_n: tf.concat([1.5 * x_n[:1] - .5 * x_n[1:2],
+                                        .5 * (x_n[1:] + x_n[:-1]),
+                                        1.5 * x_n[-1:] - .5 * x_n[-2:-1]], axis=0)
+    c64_mat_sn = tf.cast(c_mat_sn, tf.float64)
+    edge_o = cell_edges(tf.cast(x_n, tf.float64))
+    edge_new_o = tf.concat([edge_o[:1], cell_edges(tf.cast(x_new_k, tf.float64))[1:-1],
+                            edge_o[-1:]], axis=0)
+    w_n = edge_o[1:] - edge_o[:-1]
+    cum_so = tf.concat([tf.zeros_like(c64_mat_sn[..., :1]),
+                        tf.cumsum(c64_mat_sn * w_n, axis=-1)], axis=-1)
+    # slopes of the cumulative mass at the cell edges, i.e. edge concentrations
+    c_left_sm = c64_mat_sn[..., :-1]
+    c_right_sm = c64_mat_sn[..., 1:]
+    weight_left_m = 2 * w_n[1:] + w_n[:-1]
+    weight_right_m = w_n[1:] + 2 * w_n[:-1]
+    monotone_sm = c_left_sm * c_right_sm > 0
+    one = tf.constant(1., tf.float64)
+    slope_sm = tf.where(monotone_sm, (weight_left_m + weight_right_m) / (
+        weight_left_m / tf.where(monotone_sm, c_left_sm, one) +
+        weight_right_m / tf.where(monotone_sm, c_right_sm, one)), tf.zeros_like(c_left_sm))
+    slope_so = tf.concat([c64_mat_sn[..., :1], slope_sm, c64_mat_sn[..., -1:]], axis=-1)
+    # cubic hermite interpolation
+    idx_o = tf.clip_by_value(tf.searchsorted(edge_o, edge_new_o, side='right') - 1,
+                             0, tf.size(w_n) - 1)
+    w_o = tf.gather(w_n, idx_o)
+    t_o = tf.clip_by_value((edge_new_o - tf.gather(edge_o, idx_o)) / w_o, 0., 1.)
+    cum_new_so = (2 * t_o**3 - 3 * t_o**2 + 1) * tf.gather(cum_so, idx_o, axis=-1) + \
+                 (t_o**3 - 2 * t_o**2 + t_o) * w_o * tf.gather(slope_so, idx_o, axis=-1) + \
+                 (-2 * t_o**3 + 3 * t_o**2) * tf.gather(cum_so, idx_o + 1, axis=-1) + \
+                 (t_o**3 - t_o**2) * w_o * tf.gather(slope_so, idx_o + 1, axis=-1)
+    w_new_k = edge_new_o[1:] - edge_new_o[:-1]
+    c_new_sk = (cum_new_so[..., 1:] - cum_new_so[..., :-1]) / w_new_k
+
+    # range of the source cells around the end edges of every new cell, and of the source
+    # cells whose centers lie inside it
+    c_pad_so = tf.concat([c64_mat_sn[..., :1], c64_mat_sn, c64_mat_sn[..., -1:]], axis=-1)
+    c_min_sn = tf.minimum(tf.minimum(c_pad_so[..., :-2], c_pad_so[..., 1:-1]), c_pad_so[..., 2:])
+    c_max_sn = tf.maximum(tf.maximum(c_pad_so[..., :-2], c_pad_so[..., 1:-1]), c_pad_so[..., 2:])
+    num_new = tf.size(x_new_k)
+    cell_k_n = tf.clip_by_value(
+        tf.searchsorted(edge_new_o, tf.cast(x_n, tf.float64), side='right') - 1, 0, num_new - 1)
+    inner_min_sk = tf.transpose(tf.math.unsorted_segment_min(
+        tf.transpose(c64_mat_sn), cell_k_n, num_new))
+    inner_max_sk = tf.transpose(tf.math.unsorted_segment_max(
+        tf.transpose(c64_mat_sn), cell_k_n, num_new))
+    c_min_sk = tf.minimum(tf.minimum(tf.gather(c_min_sn, idx_o[:-1], axis=-1),
+                                     tf.gather(c_min_sn, idx_o[1:], axis=-1)), inner_min_sk)
+    c_max_sk = tf.maximum(tf.maximum(tf.gather(c_max_sn, idx_o[:-1], axis=-1),
+                                     tf.gather(c_max_sn, idx_o[1:], axis=-1)), inner_max_sk)
+
+    c_clip_sk = tf.clip_by_value(c_new_sk, c_min_sk, c_max_sk)
+    mass_lost_s1 = tf.reduce_sum((c_new_sk - c_clip_sk) * w_new_k, axis=-1, keepdims=True)
+    room_sk = tf.where(mass_lost_s1 > 0, c_max_sk - c_clip_sk, c_clip_sk - c_min_sk)
+    fraction_s1 = tf.clip_by_value(tf.math.divide_no_nan(
+        mass_lost_s1, tf.reduce_sum(room_sk * w_new_k, axis=-1, keepdims=True)), -1., 1.)
+
+    return tf.cast(c_clip_sk + fraction_s1 * room_sk, c_mat_sn.dtype)
+
 class CafesInit(tf.Module):
     """ Tensorflow implementation of Cafes initial pH calculation """
-    def __init__(self):
+    def __init__(self, newton_tol=1e-4, max_newton_iter=5000):
+        """
+        Args:
+            newton_tol:         norm(inc) / max(cH) of the newton increments below which the
+                                grid is converged
+            max_newton_iter:    upper bound on the number of newton iterations, the graphs
+                                return whether all points converged within it
+        """
         super(CafesInit, self).__init__()
+        self.newton_tol = newton_tol
+        self.max_newton_iter = max_newton_iter
 
-    def lz_func(self, cH_n, c_mat_sn, l_mat_sd, val_mat_sd):
-        max_deg = tf.shape(l_mat_sd)[1]
+    def lz_power_table(self, cH_n, l_mat_sd):
+        """
+        calculate powers of cH, i.e. cH_mat_nd[..., j] = cH_n**j, by repeated multiplication
+        unrolled over the static max_deg (MAX_DEG if unknown), which tfjs runs on any backend
+        """
+        max_deg = l_mat_sd.shape[1]
 
-        cH_log_n = tf.math.log(cH_n)
-        cH_mat_log_nd = tf.tile(tf.expand_dims(cH_log_n, axis=1), (1, max_deg))
-        cH_mat_log_cumsum_nd = tf.cumsum(cH_mat_log_nd, axis=1, exclusive=True)
-        cH_mat_nd = tf.exp(cH_mat_log_cumsum_nd)
-        temp_mat_sn = tf.reduce_sum(tf.expand_dims(l_mat_sd, axis=1) * \
-                                    tf.expand_dims(cH_mat_nd, axis=0), axis=2)
+        cH_pow_n_list = [tf.ones_like(cH_n)]
+        for _ in range((max_deg or MAX_DEG) - 1):
+            cH_pow_n_list.append(cH_pow_n_list[-1] * cH_n)
+        cH_mat_nd = tf.stack(cH_pow_n_list, axis=-1)
+        if max_deg is None:
+            cH_mat_nd = cH_mat_nd[..., :tf.shape(l_mat_sd)[1]]
+        return cH_mat_nd
 
-        m1_mat_sn = tf.math.divide_no_nan(c_mat_sn, temp_mat_sn)
-        ciz_cube_snd = tf.expand_dims(l_mat_sd, axis=1) * \
-                       tf.expand_dims(cH_mat_nd, axis=0) * \
-                       tf.expand_dims(m1_mat_sn, axis=2)
+    def lz_polynomials(self, cH_mat_nd, coeff_mat_sd_list):
+        """
+        evaluate sum_j coeff_mat_sd[s, j] * cH_n**j for every coefficient matrix in the list
+        with a single matrix product, returning a list of [..., s, n] matrices
+        """
+        num_species = tf.shape(coeff_mat_sd_list[0])[0]
+        poly_mat_mn = tf.linalg.matmul(tf.concat(coeff_mat_sd_list, axis=0), cH_mat_nd,
+                                       transpose_b=True)
+        return tf.split(poly_mat_mn, [num_species] * len(coeff_mat_sd_list), axis=-2)
+
+    def lz_func(self, cH_n, c_mat_sn, l_mat_sd, val_mat_sd):
+        cH_mat_nd = self.lz_power_table(cH_n, l_mat_sd)
+        temp_mat_sn, temp_z_sn, temp_z2_sn = self.lz_polynomials(
+            cH_mat_nd, [l_mat_sd, val_mat_sd * l_mat_sd, val_mat_sd**2 * l_mat_sd])
 
-        temp_z_sn = tf.reduce_sum(tf.expand_dims(val_mat_sd, axis=1) * \
-                                  tf.expand_dims(l_mat_sd, axis=1) * \
-                                  tf.expand_dims(cH_mat_nd, axis=0), axis=2)
-        rhs_den_n = tf.reduce_sum(tf.reduce_sum(
-            ciz_cube_snd * tf.expand_dims(val_mat_sd, axis=1)**2, axis=2), axis=0)
-        rhs_num_n = tf.reduce_sum(ciz_cube_snd * tf.expand_dims(val_mat_sd, axis=1), axis=(0,2))
+        m1_mat_sn = tf.math.divide_no_nan(c_mat_sn, temp_mat_sn)
+        rhs_den_n = tf.reduce_sum(m1_mat_sn * temp_z2_sn, axis=-2)
+        rhs_num_n = tf.reduce_sum(m1_mat_sn * temp_z_sn, axis=-2)
 
         f_n = rhs_num_n + cH_n - Kw / cH_n
         f_p_n = rhs_den_n / cH_n + 1.0 + Kw / cH_n**2
@@ -73,49 +234,70 @@ class CafesInit(tf.Module):
         return inc_n, cH_mat_nd, temp_mat_sn
 
     def lz_calc_equilibrium(self, cH_n, c_mat_sn, l_mat_sd, val_mat_sd):
-        c_mat_sn = c_mat_sn / lit2met
+        """
+        newton solve of the grid, iterating until norm(inc_n) / max(cH_n) <= newton_tol;
+        with a batch dimension every member has its own test and is frozen once converged
 
-        max_deg = tf.shape(l_mat_sd)[1]
-        num_grid = tf.shape(cH_n)[0]
+        Returns:
+            cH_n, the power table and the denominator polynomial of the solution, the
+            number of newton iterations and whether all members converged
+        """
+        c_mat_sn = c_mat_sn / lit2met
 
-        inc_n = tf.ones_like(cH_n)
-        tmp_nd = tf.broadcast_to(tf.expand_dims(cH_n, axis=-1), (num_grid, max_deg))
-        cH_mat_nd = tf.zeros_like(tmp_nd)
-        temp_mat_sn = tf.ones_like(c_mat_sn)
-        while tf.norm(inc_n) / tf.reduce_max(cH_n) > 1e-4:
-            inc_n, cH_mat_nd, temp_mat_sn = self.lz_func(cH_n, c_mat_sn, l_mat_sd, val_mat_sd)
+        # [] without and [b] with a batch dimension
+        active = tf.ones_like(cH_n[..., 0], dtype=tf.bool)
+        num_iter = 0
+        while tf.reduce_any(active) and num_iter < self.max_newton_iter:
+            inc_n, _, _ = self.lz_func(cH_n, c_mat_sn, l_mat_sd, val_mat_sd)
+            inc_n = inc_n * tf.expand_dims(tf.cast(active, inc_n.dtype), axis=-1)
             cH_n = cH_n - inc_n
+            active = active & (tf.norm(inc_n, axis=-1) >
+                               self.newton_tol * tf.reduce_max(cH_n, axis=-1))
+            num_iter += 1
 
-        giz_cube_snd = tf.expand_dims(l_mat_sd, axis=1) * \
-                       tf.expand_dims(cH_mat_nd, axis=0) / \
-                       tf.expand_dims(temp_mat_sn, axis=2)
+        cH_mat_nd = self.lz_power_table(cH_n, l_mat_sd)
+        temp_mat_sn, = self.lz_polynomials(cH_mat_nd, [l_mat_sd])
 
-        return cH_n, giz_cube_snd
+        return cH_n, cH_mat_nd, temp_mat_sn, num_iter, tf.logical_not(tf.reduce_any(active))
 
     def calc_spatial_properties(self, cH_n, c_mat_sn,
                                 l_mat_sd, val_mat_sd, u_mat_sd, d_mat_sd):
-        cH_n, giz_cube_snd = self.lz_calc_equilibrium(cH_n, c_mat_sn, l_mat_sd, val_mat_sd)
-
-        u_cube_snd = tf.expand_dims(u_mat_sd, axis=1) * giz_cube_snd
-        d_cube_snd = tf.expand_dims(d_mat_sd, axis=1) * giz_cube_snd
+        cH_n, cH_mat_nd, temp_mat_sn, num_iter, converged = self.lz_calc_equilibrium(
+            cH_n, c_mat_sn, l_mat_sd, val_mat_sd)
 
-        u_mat_sn = tf.reduce_sum(u_cube_snd, axis=2)
-        d_mat_sn = tf.reduce_sum(d_cube_snd, axis=2)
-        val_mat_s1d = tf.expand_dims(val_mat_sd, axis=1)
-        alpha_mat_sn = F * tf.reduce_sum(val_mat_s1d * u_cube_snd, axis=2)
-        beta_mat_sn = F * tf.reduce_sum(val_mat_s1d * d_cube_snd, axis=2)
+        # ionization fraction weighted sums, i.e. sum_j coeff[s, j] * giz[s, n, j]
+        lu_mat_sd = l_mat_sd * u_mat_sd
+        ld_mat_sd = l_mat_sd * d_mat_sd
+        poly_mat_sn_list = self.lz_polynomials(
+            cH_mat_nd, [lu_mat_sd, ld_mat_sd, val_mat_sd * lu_mat_sd, val_mat_sd * ld_mat_sd])
+        u_mat_sn, d_mat_sn, alpha_mat_sn, beta_mat_sn = [
+            tf.math.divide_no_nan(poly_mat_sn, temp_mat_sn) for poly_mat_sn in poly_mat_sn_list]
+        alpha_mat_sn = F * alpha_mat_sn
+        beta_mat_sn = F * beta_mat_sn
 
-        sig_vec_n = tf.reduce_sum(alpha_mat_sn * c_mat_sn, axis=0) + \
+        sig_vec_n = tf.reduce_sum(alpha_mat_sn * c_mat_sn, axis=-2) + \
                     lit2met * F * (uH * cH_n + uOH * Kw / cH_n)
-        s_vec_n = tf.reduce_sum(beta_mat_sn * c_mat_sn, axis=0) + \
+        s_vec_n = tf.reduce_sum(beta_mat_sn * c_mat_sn, axis=-2) + \
                     lit2met * R * T * (uH * cH_n - uOH * Kw / cH_n)
 
-        return cH_n, u_mat_sn, d_mat_sn, sig_vec_n, s_vec_n
+        return cH_n, u_mat_sn, d_mat_sn, sig_vec_n, s_vec_n, num_iter, converged
+
+    def calc_cell_widths(self, dx):
+        """
+        control volume widths of the grid points, dx is either a scalar (uniform grid)
+        or the [..., n-1] spacing between neighbouring grid points
+        """
+        if dx.shape.rank == 0:
+            return dx
+        return tf.concat([dx[..., :1], .5 * (dx[..., 1:] + dx[..., :-1]), dx[..., -1:]],
+                         axis=-1)
 
     def calc_eletric_field(self, s_vec_n, sig_vec_n, current, dx):
-        s_left_vec_n = tf.concat([[2*s_vec_n[0] - s_vec_n[1]], s_vec_n[:-1]], axis=0)
-        s_right_vec_n = tf.concat([s_vec_n[1:], [2*s_vec_n[-1] - s_vec_n[-2]]], axis=0)
-        dsdx_vec_n = (s_right_vec_n - s_left_vec_n) / (2 * dx)
+        s_left_vec_n = tf.concat([2*s_vec_n[..., :1] - s_vec_n[..., 1:2], s_vec_n[..., :-1]],
+                                 axis=-1)
+        s_right_vec_n = tf.concat([s_vec_n[..., 1:], 2*s_vec_n[..., -1:] - s_vec_n[..., -2:-1]],
+                                  axis=-1)
+        dsdx_vec_n = (s_right_vec_n - s_left_vec_n) / (2 * self.calc_cell_widths(dx))
 
         return (current + dsdx_vec_n) / sig_vec_n
 
@@ -132,42 +314,59 @@ class CafesInit(tf.Module):
         # initial guess pH == 7
         cH_n = tf.ones(tf.shape(c_mat_sn)[1], dtype=tf.float32) * 1e-7
 
-        cH_n, _, _, sig_vec_n, s_vec_n = self.calc_spatial_properties(
+        return self.initialize(cH_n, c_mat_sn, l_mat_sd, val_mat_sd, u_mat_sd, d_mat_sd,
+                               current, dx)
+
+    @tf.function(input_signature=[
+        tf.TensorSpec(shape=[None], name='cH_n'),
+        tf.TensorSpec(shape=[None, None], name='c_mat_sn'),
+        tf.TensorSpec(shape=[None, None], name='l_mat_sd'),
+        tf.TensorSpec(shape=[None, None], name='val_mat_sd'),
+        tf.TensorSpec(shape=[None, None], name='u_mat_sd'),
+        tf.TensorSpec(shape=[None, None], name='d_mat_sd'),
+        tf.TensorSpec(shape=[], name='current'),
+        tf.TensorSpec(shape=[], name='dx'),
+    ])
+    def warm_start(self, cH_n, c_mat_sn, l_mat_sd, val_mat_sd, u_mat_sd, d_mat_sd, current, dx):
+        """ same as __call__ but starting from a (cached) previous cH solution """
+        return self.initialize(cH_n, c_mat_sn, l_mat_sd, val_mat_sd, u_mat_sd, d_mat_sd,
+                               current, dx)
+
+    def initialize(self, cH_n, c_mat_sn, l_mat_sd, val_mat_sd, u_mat_sd, d_mat_sd, current, dx):
+        cH_n, _, _, sig_vec_n, s_vec_n, num_iter, converged = self.calc_spatial_properties(
             cH_n, c_mat_sn, l_mat_sd, val_mat_sd, u_mat_sd, d_mat_sd)
         efield_vec_n = self.calc_eletric_field(s_vec_n, sig_vec_n, current, dx)
 
-        return cH_n, efield_vec_n
+        return cH_n, efield_vec_n, num_iter, converged
 
 
 class CafesSim(CafesInit):
     """ Tensorflow implementation of Cafes simulation step """
-    def __init__(self):
+    def __init__(self, telemetry=False, integrator='dorpri54'):
+        """
+        Args:
+            telemetry:  append solver telemetry (number of attempts, error estimate, newton
+                        increment norm and min / max cH) to the outputs of __call__
+            integrator: 'dorpri54' (explicit) or 'imex', which treats the diffusive fluxes
+                        implicitly so fine grids are not bound to the diffusive step limit
+        """
         super(CafesSim, self).__init__()
+        if integrator not in INTEGRATORS:
+            raise ValueError(f'Unsupported integrator {integrator}, '
+                             f'choose from {list(INTEGRATORS)}')
+        self.telemetry = telemetry
+        self.integrator = integrator
+        self.pi_alpha, self.pi_beta = INTEGRATORS[integrator]
 
     def lz_func(self, cH_n, c_mat_sn, l_mat_sd, val_mat_sd):
-        max_deg = tf.shape(l_mat_sd)[1]
-
-        cH_log_n = tf.math.log(cH_n)
-        cH_mat_log_nd = tf.tile(tf.expand_dims(cH_log_n, axis=1), (1, max_deg))
-        cH_mat_log_cumsum_nd = tf.cumsum(cH_mat_log_nd, axis=1, exclusive=True)
-        cH_mat_nd = tf.exp(cH_mat_log_cumsum_nd)
-        temp_mat_sn = tf.reduce_sum(tf.expand_dims(l_mat_sd, axis=1) * \
-                                    tf.expand_dims(cH_mat_nd, axis=0), axis=2)
+        cH_mat_nd = self.lz_power_table(cH_n, l_mat_sd)
+        temp_mat_sn, temp_z_sn, temp_z2_sn = self.lz_polynomials(
+            cH_mat_nd, [l_mat_sd, val_mat_sd * l_mat_sd, val_mat_sd**2 * l_mat_sd])
 
         m1_mat_sn = tf.math.divide_no_nan(c_mat_sn, temp_mat_sn)
-        ciz_cube_snd = tf.expand_dims(l_mat_sd, axis=1) * \
-                       tf.expand_dims(cH_mat_nd, axis=0) * \
-                       tf.expand_dims(m1_mat_sn, axis=2)
-
-        temp_z_sn = tf.reduce_sum(tf.expand_dims(val_mat_sd, axis=1) * \
-                                  tf.expand_dims(l_mat_sd, axis=1) * \
-                                  tf.expand_dims(cH_mat_nd, axis=0), axis=2)
-        rhs_den_n = tf.reduce_sum(tf.reduce_sum(
-            ciz_cube_snd * tf.expand_dims(val_mat_sd, axis=1)**2 - \
-                ciz_cube_snd * tf.expand_dims(val_mat_sd, axis=1) * \
-                tf.expand_dims(temp_z_sn, axis=2) / tf.expand_dims(temp_mat_sn, axis=2),
-        axis=2), axis=0)
-        rhs_num_n = tf.reduce_sum(ciz_cube_snd * tf.expand_dims(val_mat_sd, axis=1), axis=(0,2))
+        rhs_den_n = tf.reduce_sum(m1_mat_sn * (
+            temp_z2_sn - temp_z_sn * tf.math.divide_no_nan(temp_z_sn, temp_mat_sn)), axis=-2)
+        rhs_num_n = tf.reduce_sum(m1_mat_sn * temp_z_sn, axis=-2)
 
         f_n = rhs_num_n + cH_n - Kw / cH_n
         f_p_n = rhs_den_n / cH_n + 1.0 + Kw / cH_n**2
@@ -184,11 +383,7 @@ class CafesSim(CafesInit):
         inc_n, cH_mat_nd, temp_mat_sn = self.lz_func(cH_n, c_mat_sn, l_mat_sd, val_mat_sd)
         cH_n = cH_n - inc_n
 
-        giz_cube_snd = tf.expand_dims(l_mat_sd, axis=1) * \
-                       tf.expand_dims(cH_mat_nd, axis=0) / \
-                       tf.expand_dims(temp_mat_sn, axis=2)
-
-        return cH_n, giz_cube_snd
+        return cH_n, cH_mat_nd, temp_mat_sn, 2, True
 
     def limiter_func(self, x, y):
         """ calculate limiter for SLIP scheme """
@@ -197,47 +392,165 @@ class CafesSim(CafesInit):
         D = 1 - (tf.abs(tf.math.divide_no_nan(x - y, z_xy)))**q
         return 0.5 * D * (x + y)
 
-    def calc_flux(self, c_mat_sn, u_mat_sn, d_mat_sn, sig_vec_n, s_vec_n, current, dx):
-        num_species = tf.shape(c_mat_sn)[0]
-        num_grid = tf.shape(c_mat_sn)[1]
+    def calc_max_velocity(self, u_mat_sn, sig_vec_1n, current):
+        """ largest electromigration speed over the species at every face """
+        v_max_sm = tf.abs(0.5 * current * (u_mat_sn[..., 1:] / sig_vec_1n[..., 1:] + \
+                                           u_mat_sn[..., :-1] / sig_vec_1n[..., :-1]))
+        return tf.reduce_max(v_max_sm, axis=-2, keepdims=True)
 
-        sig_vec_1n = tf.expand_dims(sig_vec_n, axis=0)
-        s_vec_1n = tf.expand_dims(s_vec_n, axis=0)
+    def calc_flux(self, c_mat_sn, u_mat_sn, d_mat_sn, sig_vec_n, s_vec_n, current, dx):
+        sig_vec_1n = tf.expand_dims(sig_vec_n, axis=-2)
+        s_vec_1n = tf.expand_dims(s_vec_n, axis=-2)
+        # current broadcasts against [..., n], so it needs an extra species axis here
+        current = tf.expand_dims(current, axis=-1)
+        dx_n = self.calc_cell_widths(dx)
+        if dx.shape.rank > 0:
+            dx = tf.expand_dims(dx, axis=-2)
+            dx_n = tf.expand_dims(dx_n, axis=-2)
 
         elec_flux_factor0_sn = u_mat_sn * c_mat_sn / sig_vec_1n
         elec_flux_factor_sn = current * u_mat_sn / sig_vec_1n * c_mat_sn
 
-        adv_flux_sm = 0.5 * (elec_flux_factor_sn[:, 1:] + elec_flux_factor_sn[:, :num_grid-1])
-        adv_flux_left_s = elec_flux_factor_sn[:, 0]
-        adv_flux_right_s = elec_flux_factor_sn[:, num_grid-1]
+        adv_flux_sm = 0.5 * (elec_flux_factor_sn[..., 1:] + elec_flux_factor_sn[..., :-1])
+        adv_flux_left_s = elec_flux_factor_sn[..., 0]
+        adv_flux_right_s = elec_flux_factor_sn[..., -1]
 
-        v_max_sm = tf.abs(0.5 * current * (u_mat_sn[:, 1:] / sig_vec_1n[:, 1:] + \
-                                           u_mat_sn[:, :num_grid-1] / sig_vec_1n[:, :num_grid-1]))
-        v_max_1m = tf.reduce_max(v_max_sm, axis=0, keepdims=True)
+        v_max_1m = self.calc_max_velocity(u_mat_sn, sig_vec_1n, current)
 
-        molecular_diff_flux_sm = (d_mat_sn[:, 1:] * c_mat_sn[:, 1:] - \
-                                  d_mat_sn[:, :num_grid-1] * c_mat_sn[:, :num_grid-1]) / dx;
-        elec_diff_flux_sm = .5 * (elec_flux_factor0_sn[:, 1:] + elec_flux_factor0_sn[:, :num_grid-1]) * \
-                                 (s_vec_1n[:, 1:] - s_vec_1n[:, :num_grid-1]) / dx
-        dc_mat_so = tf.pad(c_mat_sn[:, 1:] - c_mat_sn[:, :num_grid-1], [[0, 0], [1, 1]])
-        limit_mat_sm = self.limiter_func(dc_mat_so[:, 2:], dc_mat_so[:, :num_grid-1])
+        molecular_diff_flux_sm = (d_mat_sn[..., 1:] * c_mat_sn[..., 1:] - \
+                                  d_mat_sn[..., :-1] * c_mat_sn[..., :-1]) / dx;
+        elec_diff_flux_sm = .5 * (elec_flux_factor0_sn[..., 1:] + elec_flux_factor0_sn[..., :-1]) * \
+                                 (s_vec_1n[..., 1:] - s_vec_1n[..., :-1]) / dx
+        dc_mat_sm = c_mat_sn[..., 1:] - c_mat_sn[..., :-1]
+        zeros_s1 = tf.zeros_like(dc_mat_sm[..., :1])
+        dc_mat_so = tf.concat([zeros_s1, dc_mat_sm, zeros_s1], axis=-1)
+        limit_mat_sm = self.limiter_func(dc_mat_so[..., 2:], dc_mat_so[..., :-2])
 
-        num_diff_sm = 0.5 * v_max_1m * (c_mat_sn[:, 1:] - c_mat_sn[:, :num_grid-1] - limit_mat_sm)
+        num_diff_sm = 0.5 * v_max_1m * (dc_mat_sm - limit_mat_sm)
         diff_flux_sm = elec_diff_flux_sm - molecular_diff_flux_sm
 
         flux_sm = adv_flux_sm + diff_flux_sm - num_diff_sm
 
-        gradient_mid_sl = -(flux_sm[:,1:]-flux_sm[:,:num_grid-2])/dx
-        gradient_left_s1 = tf.expand_dims((adv_flux_left_s - flux_sm[:, 0]) / dx, axis=1)
-        gradient_right_s1 = tf.expand_dims((flux_sm[:, num_grid-2] - adv_flux_right_s) / dx, axis=1)
+        flux_so = tf.concat([tf.expand_dims(adv_flux_left_s, axis=-1), flux_sm,
+                             tf.expand_dims(adv_flux_right_s, axis=-1)], axis=-1)
+
+        return -(flux_so[..., 1:] - flux_so[..., :-1]) / dx_n
+
+    def calc_diffusion_operator(self, u_mat_sn, d_mat_sn, sig_vec_n, current, dx):
+        """ linear diffusive part L of calc_flux, i.e. the molecular diffusion and the
+        unlimited numerical diffusion, with L c = sub * c[i-1] + diag * c[i] + sup * c[i+1]
+
+        Returns:
+            the sub, main and super diagonals of L, all [..., s, n]
+        """
+        current = tf.expand_dims(current, axis=-1)
+        dx_n = self.calc_cell_widths(dx)
+        if dx.shape.rank > 0:
+            dx = tf.expand_dims(dx, axis=-2)
+            dx_n = tf.expand_dims(dx_n, axis=-2)
+        v_max_1m = self.calc_max_velocity(u_mat_sn, tf.expand_dims(sig_vec_n, axis=-2), current)
+        # diffusive flux through face m is p[m] * c[m] - q[m] * c[m+1], none at the boundaries
+        p_sm = d_mat_sn[..., :-1] / dx + 0.5 * v_max_1m
+        q_sm = d_mat_sn[..., 1:] / dx + 0.5 * v_max_1m
+        zeros_s1 = tf.zeros_like(p_sm[..., :1])
+        p_so = tf.concat([zeros_s1, p_sm, zeros_s1], axis=-1)
+        q_so = tf.concat([zeros_s1, q_sm, zeros_s1], axis=-1)
+
+        return p_so[..., :-1] / dx_n, -(p_so[..., 1:] + q_so[..., :-1]) / dx_n, \
+               q_so[..., 1:] / dx_n
+
+    def apply_tridiagonal(self, sub_sn, diag_sn, sup_sn, y_sn):
+        zeros_s1 = tf.zeros_like(y_sn[..., :1])
+        return sub_sn * tf.concat([zeros_s1, y_sn[..., :-1]], axis=-1) + diag_sn * y_sn + \
+               sup_sn * tf.concat([y_sn[..., 1:], zeros_s1], axis=-1)
 
-        return tf.concat([gradient_left_s1, gradient_mid_sl, gradient_right_s1], axis=1)
+    def solve_tridiagonal(self, sub_sn, diag_sn, sup_sn, rhs_sn):
+        """ solve tridiagonal systems along the last axis by parallel cyclic reduction
 
-    def integrate(self, c_mat_sn, u_mat_sn, d_mat_sn, sig_vec_n, s_vec_n, current, dx, dt):
+        Every pass eliminates the couplings to the neighbours at the current stride and
+        doubles it, so log2(n) passes of elementwise ops decouple all unknowns. Unlike
+        tf.linalg.tridiagonal_solve this exports to tfjs, and it unrolls (for XLA) when n is
+        static. sub_sn[..., 0] and sup_sn[..., -1] are ignored.
+        """
+        num_grids = diag_sn.shape[-1]
+        if num_grids is None:
+            num_grids = tf.shape(diag_sn)[-1]
+        paddings = [[0, 0]] * (diag_sn.shape.rank - 1)
+        zeros_s1 = tf.zeros_like(diag_sn[..., :1])
+        sub_sn = tf.concat([zeros_s1, sub_sn[..., 1:]], axis=-1)
+        sup_sn = tf.concat([sup_sn[..., :-1], zeros_s1], axis=-1)
+        stride = 1
+        while stride < num_grids:
+            # values of row i - stride and i + stride, an identity row outside of the grid
+            lower = lambda y_sn, fill: tf.pad(y_sn[..., :-stride], paddings + [[stride, 0]],
+                                              constant_values=fill)
+            upper = lambda y_sn, fill: tf.pad(y_sn[..., stride:], paddings + [[0, stride]],
+                                              constant_values=fill)
+            alpha_sn = -sub_sn / lower(diag_sn, 1.)
+            beta_sn = -sup_sn / upper(diag_sn, 1.)
+            diag_sn = diag_sn + alpha_sn * lower(sup_sn, 0.) + beta_sn * upper(sub_sn, 0.)
+            rhs_sn = rhs_sn + alpha_sn * lower(rhs_sn, 0.) + beta_sn * upper(rhs_sn, 0.)
+            sub_sn = alpha_sn * lower(sub_sn, 0.)
+            sup_sn = beta_sn * upper(sup_sn, 0.)
+            stride *= 2
+        return rhs_sn / diag_sn
+
+    def integrate(self, c_mat_sn, u_mat_sn, d_mat_sn, sig_vec_n, s_vec_n, current, dx, dt,
+                  flux_sn=None):
+        """ one integration attempt of the selected integrator
+
+        Returns:
+            the solution after dt, its error estimate and the coefficients of its dense output
+        """
+        integrate = self.integrate_imex if self.integrator == 'imex' else \
+                    self.integrate_dorpri54
+        return integrate(c_mat_sn, u_mat_sn, d_mat_sn, sig_vec_n, s_vec_n, current, dx, dt,
+                         flux_sn)
+
+    def integrate_imex(self, c_mat_sn, u_mat_sn, d_mat_sn, sig_vec_n, s_vec_n, current, dx, dt,
+                       flux_sn=None):
+        """ one ARS(2,2,2) attempt, implicit in the diffusive part L of the flux and explicit
+        in the rest (electromigration and the limiter correction of the numerical diffusion)
+        """
         calc_flux = lambda input_sn: self.calc_flux(input_sn,
                 u_mat_sn, d_mat_sn, sig_vec_n, s_vec_n, current, dx)
+        if flux_sn is None:
+            flux_sn = calc_flux(c_mat_sn)
+        sub_sn, diag_sn, sup_sn = self.calc_diffusion_operator(
+            u_mat_sn, d_mat_sn, sig_vec_n, current, dx)
+        apply_diffusion = lambda y_sn: self.apply_tridiagonal(sub_sn, diag_sn, sup_sn, y_sn)
+        # solve (I - h L) y = rhs, for several h and rhs at once
+        solve = lambda hs, rhss: tf.unstack(self.solve_tridiagonal(
+            tf.stack([-h * sub_sn for h in hs]), tf.stack([1. - h * diag_sn for h in hs]),
+            tf.stack([-h * sup_sn for h in hs]), tf.stack(rhss)))
+        gamma, delta = ARS222_GAMMA, ARS222_DELTA
+        explicit_1_sn = flux_sn - apply_diffusion(c_mat_sn)
+        # the first stage and the embedded first order IMEX Euler solution only depend on
+        # c_mat_sn, so they share a single solve
+        y_2_sn, c_mat_1_sn = solve([gamma * dt, dt], [c_mat_sn + gamma * dt * explicit_1_sn,
+                                                      c_mat_sn + dt * explicit_1_sn])
+        diffusion_2_sn = apply_diffusion(y_2_sn)
+        explicit_2_sn = calc_flux(y_2_sn) - diffusion_2_sn
+        c_mat_2_sn, = solve([gamma * dt], [c_mat_sn + dt * (
+            delta * explicit_1_sn + (1 - delta) * explicit_2_sn + (1 - gamma) * diffusion_2_sn)])
+
+        error = tf.norm(c_mat_1_sn - c_mat_2_sn, axis=(-2, -1))
+
+        # quadratic dense output matching the slope at the beginning of the step
+        zeros_sn = tf.zeros_like(c_mat_sn)
+        dense_coeffs = (dt * flux_sn - (c_mat_2_sn - c_mat_sn), zeros_sn, zeros_sn)
+
+        return c_mat_2_sn, error, dense_coeffs
+
+    def integrate_dorpri54(self, c_mat_sn, u_mat_sn, d_mat_sn, sig_vec_n, s_vec_n, current, dx,
+                           dt, flux_sn=None):
+        """ one DORPRI54 attempt, flux_sn is the (reusable) flux at c_mat_sn if known """
+        calc_flux = lambda input_sn: self.calc_flux(input_sn,
+                u_mat_sn, d_mat_sn, sig_vec_n, s_vec_n, current, dx)
+        if flux_sn is None:
+            flux_sn = calc_flux(c_mat_sn)
         T = DORPRI54_TABLEAU['beta']
-        k1 = dt * calc_flux(c_mat_sn)
+        k1 = dt * flux_sn
         k2 = dt * calc_flux(c_mat_sn + (T[0][0]*k1))
         k3 = dt * calc_flux(c_mat_sn + (T[1][0]*k1 + T[1][1]*k2))
         k4 = dt * calc_flux(c_mat_sn + (T[2][0]*k1 + T[2][1]*k2 + T[2][2]*k3))
@@ -252,9 +565,89 @@ class CafesSim(CafesInit):
         c_mat_4_sn = c_mat_sn + (T[0]*k1 + T[1]*k2 + T[2]*k3 + T[3]*k4 + T[4]*k5 +
                                  T[5]*k6 + T[6]*k7)
 
-        error = tf.linalg.norm(c_mat_4_sn - c_mat_5_sn)
+        error = tf.norm(c_mat_4_sn - c_mat_5_sn, axis=(-2, -1))
+
+        # coefficients of the dense output interpolant
+        T = DORPRI54_TABLEAU['dense']
+        bspl_sn = k1 - (c_mat_5_sn - c_mat_sn)
+        dense_coeffs = (
+            bspl_sn,
+            c_mat_5_sn - c_mat_sn - k7 - bspl_sn,
+            T[0]*k1 + T[2]*k3 + T[3]*k4 + T[4]*k5 + T[5]*k6 + T[6]*k7,
+        )
+
+        return c_mat_5_sn, error, dense_coeffs
+
+    def dense_output(self, c_mat_sn, c_mat_5_sn, dense_coeffs, theta):
+        """ evaluate the solution at fraction theta in [0, 1] of a step from c_mat_sn """
+        bspl_sn, rcont4_sn, rcont5_sn = dense_coeffs
+        return c_mat_sn + theta * (c_mat_5_sn - c_mat_sn + (1 - theta) * \
+            (bspl_sn + theta * (rcont4_sn + (1 - theta) * rcont5_sn)))
+
+    def dense_derivative(self, c_mat_sn, c_mat_5_sn, dense_coeffs, theta):
+        """ derivative of dense_output with respect to theta """
+        bspl_sn, rcont4_sn, rcont5_sn = dense_coeffs
+        inner_sn = bspl_sn + theta * (rcont4_sn + (1 - theta) * rcont5_sn)
+        inner_derivative_sn = rcont4_sn + (1 - 2 * theta) * rcont5_sn
+        return c_mat_5_sn - c_mat_sn + (1 - theta) * inner_sn + \
+               theta * ((1 - theta) * inner_derivative_sn - inner_sn)
+
+    def reject_scale(self, error, tolerance):
+        """ step size scale from the local error alone (used on rejected attempts) """
+        error_ratio = tf.maximum(error / tolerance, 1e-4)
+        return tf.clip_by_value(.9 * error_ratio**(-self.pi_alpha), 0.1, 10)
+
+    def accept_scale(self, dt_scale, error_prev, tolerance, rejected):
+        """ PI correction of the step size scale once an attempt is accepted """
+        error_prev_ratio = tf.maximum(error_prev / tolerance, 1e-4)
+        dt_scale = tf.clip_by_value(dt_scale * error_prev_ratio**self.pi_beta, 0.1, 10)
+        # never grow the step right after a rejection
+        return tf.where(rejected, tf.minimum(dt_scale, 1.), dt_scale)
 
-        return c_mat_5_sn, error
+    def step(self, cH_n, c_mat_sn, l_mat_sd, val_mat_sd, u_mat_sd, d_mat_sd,
+             current, dx, dt, tolerance, error_prev=None):
+        """ perform a single accepted adaptive step (shared by all simulation graphs)
+
+        error_prev is the error of the previous accepted step used by the PI controller,
+        without it (error_prev = tolerance) the controller reduces to a plain I controller.
+        """
+        error_prev = tolerance if error_prev is None else error_prev
+        # chemical equillibrium
+        cH_n, u_mat_sn, d_mat_sn, sig_vec_n, s_vec_n, _, _ = self.calc_spatial_properties(
+            cH_n, c_mat_sn, l_mat_sd, val_mat_sd, u_mat_sd, d_mat_sd)
+        efield_vec_n = self.calc_eletric_field(s_vec_n, sig_vec_n, current, dx)
+        # the first stage does not depend on dt, so rejected attempts reuse it
+        flux_sn = self.calc_flux(c_mat_sn, u_mat_sn, d_mat_sn, sig_vec_n, s_vec_n, current, dx)
+        # perform integration
+        c_mat_5_sn = tf.identity(c_mat_sn)
+        dense_coeffs = (tf.zeros_like(c_mat_sn),) * 3
+        error = tolerance + 1.
+        dt_scale = 1.
+        num_attempts = 0
+        while error > tolerance:
+            dt *= dt_scale
+            c_mat_5_sn, error, dense_coeffs = self.integrate(
+                c_mat_sn, u_mat_sn, d_mat_sn, sig_vec_n, s_vec_n, current, dx, dt, flux_sn)
+            dt_scale = self.reject_scale(error, tolerance)
+            num_attempts += 1
+        dt_scale = self.accept_scale(dt_scale, error_prev, tolerance, num_attempts > 1)
+
+        return cH_n, efield_vec_n, c_mat_5_sn, dt, dt*dt_scale, dense_coeffs, error, \
+               num_attempts
+
+    def calc_telemetry(self, cH_n, c_mat_sn, l_mat_sd, val_mat_sd, error, num_attempts):
+        """
+        Returns:
+            number of integration attempts of the step
+            error estimate of the accepted attempt
+            norm of the next newton increment relative to max(cH), i.e. the remaining
+            equilibrium residual after the fixed newton iterations
+            min / max of cH
+        """
+        inc_n, _, _ = self.lz_func(cH_n, c_mat_sn / lit2met, l_mat_sd, val_mat_sd)
+        return tf.convert_to_tensor(num_attempts, dtype=tf.int32), error, \
+               tf.norm(inc_n) / tf.reduce_max(cH_n), \
+               tf.reduce_min(cH_n), tf.reduce_max(cH_n)
 
     @tf.function(input_signature=(
         tf.TensorSpec(shape=[None], name='cH_n'),
@@ -270,27 +663,854 @@ class CafesSim(CafesInit):
     ))
     def __call__(self, cH_n, c_mat_sn, l_mat_sd, val_mat_sd, u_mat_sd, d_mat_sd,
                  current, dx, dt, tolerance):
+        cH_n, efield_vec_n, c_mat_5_sn, dt, dt_new, _, error, num_attempts = self.step(
+            cH_n, c_mat_sn, l_mat_sd, val_mat_sd, u_mat_sd, d_mat_sd,
+            current, dx, dt, tolerance)
+        outputs = (cH_n, efield_vec_n, c_mat_5_sn, dt, dt_new)
+        if not self.telemetry:
+            return outputs
+        # cH_n is the equilibrium of the concentrations at the beginning of the step
+        return outputs + self.calc_telemetry(cH_n, c_mat_sn, l_mat_sd, val_mat_sd,
+                                             error, num_attempts)
+
+
+class CafesSimMultiStep(CafesSim):
+    """ Tensorflow implementation of Cafes simulation fused over many steps
+
+    All steps run inside a single in-graph loop, so the driver pays for one graph dispatch
+    and one device to host readback per call instead of one per step. Snapshots are stored
+    on a requested time grid via the dense output of the integrator, so the result size does
+    not depend on the number of adaptive steps.
+    """
+    def __init__(self, integrator='dorpri54'):
+        super(CafesSimMultiStep, self).__init__(integrator=integrator)
+
+    @tf.function(input_signature=(
+        tf.TensorSpec(shape=[None], name='cH_n'),
+        tf.TensorSpec(shape=[None, None], name='c_mat_sn'),
+        tf.TensorSpec(shape=[None, None], name='l_mat_sd'),
+        tf.TensorSpec(shape=[None, None], name='val_mat_sd'),
+        tf.TensorSpec(shape=[None, None], name='u_mat_sd'),
+        tf.TensorSpec(shape=[None, None], name='d_mat_sd'),
+        tf.TensorSpec(shape=[], name='current'),
+        tf.TensorSpec(shape=[], name='dx'),
+        tf.TensorSpec(shape=[], name='dt'),
+        tf.TensorSpec(shape=[], name='tolerance'),
+        tf.TensorSpec(shape=[], name='t'),
+        tf.TensorSpec(shape=[], name='t_end'),
+        tf.TensorSpec(shape=[], dtype=tf.int32, name='max_steps'),
+        tf.TensorSpec(shape=[None], name='output_times_t'),
+    ))
+    def __call__(self, cH_n, c_mat_sn, l_mat_sd, val_mat_sd, u_mat_sd, d_mat_sd,
+                 current, dx, dt, tolerance, t, t_end, max_steps, output_times_t):
+        """
+        Advance the simulation until either t_end is reached or max_steps steps are taken.
+        A snapshot is recorded at every (sorted) output time in (t, t_end] that is passed.
+        Returned cH_n and efield_vec_n follow the same convention as CafesSim, i.e. they
+        correspond to the state at the beginning of the last step.
+        """
+        return self.multi_step(cH_n, c_mat_sn, l_mat_sd, val_mat_sd, u_mat_sd, d_mat_sd,
+                               current, dx, dt, tolerance, t, t_end, max_steps, output_times_t)
+
+    def calc_snapshot(self, cH_n, c_out_sn, l_mat_sd, val_mat_sd, u_mat_sd, d_mat_sd,
+                      current, dx):
+        """ cH and electric field of an interpolated state, cH_n is the newton guess """
+        cH_out_n, _, _, sig_vec_n, s_vec_n, _, _ = self.calc_spatial_properties(
+            cH_n, c_out_sn, l_mat_sd, val_mat_sd, u_mat_sd, d_mat_sd)
+        return cH_out_n, self.calc_eletric_field(s_vec_n, sig_vec_n, current, dx)
+
+    def multi_step(self, cH_n, c_mat_sn, l_mat_sd, val_mat_sd, u_mat_sd, d_mat_sd,
+                   current, dx, dt, tolerance, t, t_end, max_steps, output_times_t,
+                   events=None):
+        """ in-graph loop over the steps, see __call__
+
+        Args:
+            events: optional tuple of the event tensors of CafesSimEvents, if given the
+                    triggered events are recorded and the loop ends at the first terminal
+                    one
+        """
+        time_t = tf.TensorArray(tf.float32, size=0, dynamic_size=True)
+        concentration_tsn = tf.TensorArray(tf.float32, size=0, dynamic_size=True,
+                                           element_shape=tf.TensorShape([None, None]))
+        cH_tn = tf.TensorArray(tf.float32, size=0, dynamic_size=True,
+                               element_shape=tf.TensorShape([None]))
+        efield_tn = tf.TensorArray(tf.float32, size=0, dynamic_size=True,
+                                   element_shape=tf.TensorShape([None]))
+        event_time_k = tf.TensorArray(tf.float32, size=0, dynamic_size=True)
+        event_idx_k = tf.TensorArray(tf.int32, size=0, dynamic_size=True)
+        event_concentration_ksn = tf.TensorArray(tf.float32, size=0, dynamic_size=True,
+                                                 element_shape=tf.TensorShape([None, None]))
+        event_cH_kn = tf.TensorArray(tf.float32, size=0, dynamic_size=True,
+                                     element_shape=tf.TensorShape([None]))
+        event_efield_kn = tf.TensorArray(tf.float32, size=0, dynamic_size=True,
+                                         element_shape=tf.TensorShape([None]))
+
+        num_outputs = tf.size(output_times_t)
+        output_idx = tf.searchsorted(output_times_t, tf.expand_dims(t, 0), side='right')[0]
+        efield_vec_n = tf.zeros_like(cH_n)
+        error = tolerance
+        num_steps = 0
+        stopped = False if events is None else tf.constant(False)
+        # event functions at the end of the previous step, unknown before the first one
+        g_prev_e = tf.fill(tf.shape(events[0]) if events is not None else [0], float('nan'))
+        while num_steps < max_steps and t < t_end and not stopped:
+            # do not step over the requested end time
+            cH_n, efield_vec_n, c_mat_5_sn, dt_used, dt, dense_coeffs, error, _ = self.step(
+                cH_n, c_mat_sn, l_mat_sd, val_mat_sd, u_mat_sd, d_mat_sd,
+                current, dx, tf.minimum(dt, t_end - t), tolerance, error)
+            # part of the step that is kept and its end state, a terminal event cuts it short
+            dt_step = dt_used
+            c_next_sn = c_mat_5_sn
+            if events is not None:
+                event_terminal_e = events[-1]
+                theta_e, triggered_e, g_prev_e = self.locate_events(
+                    c_mat_sn, c_mat_5_sn, dense_coeffs, dx, dt_used, g_prev_e, *events[:-1])
+                terminal_e = triggered_e & event_terminal_e
+                theta_stop = tf.minimum(
+                    tf.reduce_min(tf.where(terminal_e, theta_e, 1.)), 1.)
+                # record the triggered events up to the terminal one, in time order
+                recorded_e = triggered_e & (theta_e <= theta_stop)
+                order_k = tf.argsort(tf.where(recorded_e, theta_e, 2.))
+                num_recorded = tf.reduce_sum(tf.cast(recorded_e, tf.int32))
+                record_idx = 0
+                while record_idx < num_recorded:
+                    event_idx = order_k[record_idx]
+                    c_out_sn = self.dense_output(c_mat_sn, c_mat_5_sn, dense_coeffs,
+                                                 theta_e[event_idx])
+                    cH_out_n, efield_out_n = self.calc_snapshot(
+                        cH_n, c_out_sn, l_mat_sd, val_mat_sd, u_mat_sd, d_mat_sd,
+                        current, dx)
+                    idx = event_time_k.size()
+                    event_time_k = event_time_k.write(idx, t + theta_e[event_idx] * dt_used)
+                    event_idx_k = event_idx_k.write(idx, event_idx)
+                    event_concentration_ksn = event_concentration_ksn.write(idx, c_out_sn)
+                    event_cH_kn = event_cH_kn.write(idx, cH_out_n)
+                    event_efield_kn = event_efield_kn.write(idx, efield_out_n)
+                    record_idx += 1
+                stopped = tf.reduce_any(terminal_e)
+                if stopped:
+                    c_next_sn = self.dense_output(c_mat_sn, c_mat_5_sn, dense_coeffs,
+                                                  theta_stop)
+                    dt_step = theta_stop * dt_used
+            # interpolate all the output times covered by this step
+            while output_idx < num_outputs and output_times_t[output_idx] <= t + dt_step:
+                theta = (output_times_t[output_idx] - t) / dt_used
+                c_out_sn = self.dense_output(c_mat_sn, c_mat_5_sn, dense_coeffs, theta)
+                cH_out_n, efield_out_n = self.calc_snapshot(
+                    cH_n, c_out_sn, l_mat_sd, val_mat_sd, u_mat_sd, d_mat_sd, current, dx)
+                idx = time_t.size()
+                time_t = time_t.write(idx, output_times_t[output_idx])
+                concentration_tsn = concentration_tsn.write(idx, c_out_sn)
+                cH_tn = cH_tn.write(idx, cH_out_n)
+                efield_tn = efield_tn.write(idx, efield_out_n)
+                output_idx += 1
+            c_mat_sn = c_next_sn
+            t += dt_step
+            num_steps += 1
+
+        outputs = (cH_n, efield_vec_n, c_mat_sn, t, dt, num_steps, time_t.stack(),
+                   stack_snapshots(concentration_tsn, tf.shape(c_mat_sn)),
+                   stack_snapshots(cH_tn, tf.shape(cH_n)),
+                   stack_snapshots(efield_tn, tf.shape(efield_vec_n)))
+        if events is None:
+            return outputs
+        return outputs + (event_time_k.stack(), event_idx_k.stack(),
+                          stack_snapshots(event_concentration_ksn, tf.shape(c_mat_sn)),
+                          stack_snapshots(event_cH_kn, tf.shape(cH_n)),
+                          stack_snapshots(event_efield_kn, tf.shape(efield_vec_n)),
+                          stopped)
+
+class CafesSimEvents(CafesSimMultiStep):
+    """ Tensorflow implementation of Cafes simulation fused over many steps, with events
+
+    Events are sign changes of event functions (see EVENT_TYPES) of a single species minus
+    a value, checked at every step. A triggered event is located within the step on the
+    dense output and records a snapshot there, and a terminal one also ends the run at its
+    time, so runs only need to last until e.g. a peak reaches the detector.
+    """
+    def __init__(self, integrator='dorpri54'):
+        super(CafesSimEvents, self).__init__(integrator=integrator)
+
+    def calc_event_values(self, c_en, dc_en, event_type_e, event_level_e, dx):
+        """
+        Args:
+            c_en:           concentration of the species of every event
+            dc_en:          its time derivative
+            event_type_e:   EVENT_TYPES value of every event
+            event_level_e:  interface level of every event, relative to the maximum
+
+        Returns:
+            value of the event function of every event, NaN if it is undefined (an
+            interface that does not exist)
+        """
+        num_grids = tf.shape(c_en)[-1]
+        c_max_e = tf.reduce_max(c_en, axis=-1)
+        # peak position, refined by a parabola through the maximum and its neighbours
+        peak_idx_e = tf.clip_by_value(tf.argmax(c_en, axis=-1, output_type=tf.int32),
+                                      1, num_grids - 2)
+        y_e3 = tf.gather(c_en, peak_idx_e[:, None] + [-1, 0, 1], batch_dims=1)
+        peak_offset_e = tf.clip_by_value(tf.math.divide_no_nan(
+            .5 * (y_e3[:, 0] - y_e3[:, 2]), y_e3[:, 0] - 2 * y_e3[:, 1] + y_e3[:, 2]),
+            -.5, .5)
+        peak_e = (tf.cast(peak_idx_e, tf.float32) + peak_offset_e) * dx
+        # first crossing of the level, linearly interpolated between the grid points
+        level_e = event_level_e * c_max_e
+        above_en = c_en >= level_e[:, None]
+        crossing_em = tf.cast(above_en[:, 1:] != above_en[:, :-1], tf.int32)
+        crossing_idx_e = tf.argmax(crossing_em, axis=-1, output_type=tf.int32)
+        c_left_e = tf.gather(c_en, crossing_idx_e, batch_dims=1)
+        c_right_e = tf.gather(c_en, crossing_idx_e + 1, batch_dims=1)
+        interface_e = tf.where(
+            tf.reduce_any(crossing_em > 0, axis=-1),
+            (tf.cast(crossing_idx_e, tf.float32) +
+             tf.math.divide_no_nan(level_e - c_left_e, c_right_e - c_left_e)) * dx,
+            float('nan'))
+        # zone width from the variance of the distribution, and its relative rate
+        # d(log width)/dt = d(variance)/dt / (2 variance)
+        x_n = tf.cast(tf.range(num_grids), tf.float32) * dx
+        amount_e = tf.reduce_sum(c_en, axis=-1)
+        mean_e1 = tf.math.divide_no_nan(tf.reduce_sum(x_n * c_en, axis=-1), amount_e)[:, None]
+        square_en = (x_n - mean_e1)**2
+        variance_e = tf.math.divide_no_nan(tf.reduce_sum(square_en * c_en, axis=-1), amount_e)
+        width_e = tf.sqrt(12 * tf.maximum(variance_e, 0.))
+        variance_rate_e = tf.math.divide_no_nan(
+            tf.reduce_sum(square_en * dc_en, axis=-1) -
+            variance_e * tf.reduce_sum(dc_en, axis=-1), amount_e)
+        width_rate_e = tf.abs(tf.math.divide_no_nan(variance_rate_e, 2 * variance_e))
+        return tf.gather(tf.stack([peak_e, interface_e, width_e, width_rate_e], axis=-1),
+                         event_type_e, batch_dims=1)
+
+    def locate_events(self, c_mat_sn, c_mat_5_sn, dense_coeffs, dx, dt, g_start_e,
+                      event_type_e, event_species_e, event_level_e, event_value_e,
+                      event_direction_e):
+        """ find the events triggered within a step and locate them on its dense output
+
+        An event triggers when its event function minus its value changes sign over the
+        step, in the given direction (> 0 rising, < 0 falling, 0 either). The crossing is
+        bracketed by Illinois (modified regula falsi) iterations on theta.
+
+        Args:
+            g_start_e:  event functions at the beginning of the step (the end of the
+                        previous one), evaluated here if any is NaN
+
+        Returns:
+            theta of every event, the end of its final bracket (just past the crossing, so
+            a run that continues from there does not trigger it again)
+            whether every event is triggered
+            event functions at the end of the step
+        """
+        # the interpolant of the species of every event
+        gather = lambda y_sn: tf.gather(y_sn, event_species_e)
+        c_en, c_5_en = gather(c_mat_sn), gather(c_mat_5_sn)
+        dense_coeffs_en = tuple(gather(coeff_sn) for coeff_sn in dense_coeffs)
+
+        def event_func(theta_e):
+            theta_e1 = tf.expand_dims(theta_e, -1)
+            return self.calc_event_values(
+                self.dense_output(c_en, c_5_en, dense_coeffs_en, theta_e1),
+                self.dense_derivative(c_en, c_5_en, dense_coeffs_en, theta_e1) / dt,
+                event_type_e, event_level_e, dx) - event_value_e
+
+        lo_e = tf.zeros_like(event_value_e)
+        hi_e = tf.ones_like(event_value_e)
+        g_lo_e = tf.cond(tf.reduce_any(tf.math.is_nan(g_start_e)),
+                         lambda: event_func(lo_e), lambda: g_start_e)
+        g_hi_e = event_func(hi_e)
+        g_end_e = g_hi_e
+        rising_e = (g_lo_e < 0) & (g_hi_e >= 0)
+        falling_e = (g_lo_e > 0) & (g_hi_e <= 0)
+        triggered_e = (rising_e & (event_direction_e >= 0)) | \
+                      (falling_e & (event_direction_e <= 0))
+        # past_e(g) is whether g lies on the far side of the crossing
+        past_e = lambda g_e: tf.where(rising_e, g_e >= 0, g_e <= 0)
+        # side that was replaced last, to halve the other one (Illinois)
+        side_e = tf.zeros_like(event_type_e)
+        num_iter = 0
+        while num_iter < EVENT_MAX_ITER and \
+                tf.reduce_any(triggered_e & (hi_e - lo_e > EVENT_THETA_TOL)):
+            theta_e = hi_e - g_hi_e * (hi_e - lo_e) / (g_hi_e - g_lo_e)
+            # bisect where the secant degenerates
+            theta_e = tf.where((theta_e > lo_e) & (theta_e < hi_e), theta_e,
+                               .5 * (lo_e + hi_e))
+            g_e = event_func(theta_e)
+            update_hi_e = triggered_e & past_e(g_e)
+            update_lo_e = triggered_e & ~past_e(g_e)
+            g_lo_e = tf.where(update_hi_e & (side_e > 0), .5 * g_lo_e, g_lo_e)
+            g_hi_e = tf.where(update_lo_e & (side_e < 0), .5 * g_hi_e, g_hi_e)
+            hi_e = tf.where(update_hi_e, theta_e, hi_e)
+            g_hi_e = tf.where(update_hi_e, g_e, g_hi_e)
+            lo_e = tf.where(update_lo_e, theta_e, lo_e)
+            g_lo_e = tf.where(update_lo_e, g_e, g_lo_e)
+            side_e = tf.where(update_hi_e, 1, tf.where(update_lo_e, -1, side_e))
+            num_iter += 1
+
+        return hi_e, triggered_e, g_end_e
+
+    @tf.function(input_signature=(
+        tf.TensorSpec(shape=[None], name='cH_n'),
+        tf.TensorSpec(shape=[None, None], name='c_mat_sn'),
+        tf.TensorSpec(shape=[None, None], name='l_mat_sd'),
+        tf.TensorSpec(shape=[None, None], name='val_mat_sd'),
+        tf.TensorSpec(shape=[None, None], name='u_mat_sd'),
+        tf.TensorSpec(shape=[None, None], name='d_mat_sd'),
+        tf.TensorSpec(shape=[], name='current'),
+        tf.TensorSpec(shape=[], name='dx'),
+        tf.TensorSpec(shape=[], name='dt'),
+        tf.TensorSpec(shape=[], name='tolerance'),
+        tf.TensorSpec(shape=[], name='t'),
+        tf.TensorSpec(shape=[], name='t_end'),
+        tf.TensorSpec(shape=[], dtype=tf.int32, name='max_steps'),
+        tf.TensorSpec(shape=[None], name='output_times_t'),
+        tf.TensorSpec(shape=[None], dtype=tf.int32, name='event_type_e'),
+        tf.TensorSpec(shape=[None], dtype=tf.int32, name='event_species_e'),
+        tf.TensorSpec(shape=[None], name='event_level_e'),
+        tf.TensorSpec(shape=[None], name='event_value_e'),
+        tf.TensorSpec(shape=[None], name='event_direction_e'),
+        tf.TensorSpec(shape=[None], dtype=tf.bool, name='event_terminal_e'),
+    ))
+    def __call__(self, cH_n, c_mat_sn, l_mat_sd, val_mat_sd, u_mat_sd, d_mat_sd,
+                 current, dx, dt, tolerance, t, t_end, max_steps, output_times_t,
+                 event_type_e, event_species_e, event_level_e, event_value_e,
+                 event_direction_e, event_terminal_e):
+        """
+        Same as CafesSimMultiStep, the run also ends at the first terminal event.
+
+        Returns:
+            the outputs of CafesSimMultiStep, followed by the time, event index,
+            concentrations, cH and electric field of every recorded event, and whether a
+            terminal event ended the run
+        """
+        return self.multi_step(cH_n, c_mat_sn, l_mat_sd, val_mat_sd, u_mat_sd, d_mat_sd,
+                               current, dx, dt, tolerance, t, t_end, max_steps, output_times_t,
+                               (event_type_e, event_species_e, event_level_e, event_value_e,
+                                event_direction_e, event_terminal_e))
+
+class CafesSimDecomposed(CafesSimMultiStep):
+    """ Tensorflow implementation of Cafes simulation fused over many steps, with the grid
+    decomposed into subdomains
+
+    The equilibrium is pointwise and the flux a local stencil, so both are computed per
+    subdomain (the flux on the subdomain extended by HALO_WIDTH halo points on either
+    side). The subdomains are independent ops, which the inter-op thread pool runs on
+    separate cores, while the cheap integrator updates and the global reductions (error
+    norm, output snapshots) see the whole grid. Results match CafesSimMultiStep up to
+    floating point rounding. On a single core the split only adds dispatch overhead.
+    """
+    def __init__(self, num_subdomains=None, integrator='dorpri54'):
+        """
+        Args:
+            num_subdomains: maximum number of subdomains, defaults to the number of CPUs.
+                            Grids are split into fewer subdomains (or none) so that every
+                            one holds at least MIN_SUBDOMAIN_GRIDS points, see
+                            num_subdomains_for.
+            integrator:     see CafesSim
+        """
+        super(CafesSimDecomposed, self).__init__(integrator=integrator)
+        self.num_subdomains = num_subdomains or os.cpu_count()
+
+    def subdomains(self, num_grids, halo, num_subdomains):
+        """
+        Returns:
+            for every subdomain, the start and stop of its points extended by halo points
+            on either side (clipped to the grid), and the offset of its own points in there
+        """
+        bounds = [k * num_grids // num_subdomains for k in range(num_subdomains + 1)]
+        return [(tf.maximum(start - halo, 0), tf.minimum(stop + halo, num_grids),
+                 start - tf.maximum(start - halo, 0), stop - start)
+                for start, stop in zip(bounds[:-1], bounds[1:])]
+
+    def decompose(self, func, y_n_list, halo):
+        """ apply func to every subdomain of the [..., n] arrays and join the results
+
+        Args:
+            func:       function of the arrays of a subdomain, returning a list of [..., n]
+                        arrays
+            y_n_list:   arrays to split along their last axis
+            halo:       number of halo points func needs on either side
+
+        Returns:
+            the joined outputs of func
+        """
+        def split(num_subdomains):
+            if num_subdomains == 1:
+                return list(func(*y_n_list))
+            outputs_k = []
+            for ext_start, ext_stop, offset, size in self.subdomains(
+                    tf.shape(y_n_list[0])[-1], halo, num_subdomains):
+                outputs = func(*[y_n[..., ext_start:ext_stop] for y_n in y_n_list])
+                outputs_k.append([output_n[..., offset:offset + size] for output_n in outputs])
+            return [tf.concat(list(output_k), axis=-1) for output_k in zip(*outputs_k)]
+
+        num_grids = y_n_list[0].shape[-1]
+        if num_grids is not None:
+            return split(num_subdomains_for(num_grids, self.num_subdomains))
+        # the grid size is only known at run time, pick the branch of the largest count
+        # that num_subdomains_for allows, every count up to num_subdomains has its own branch
+        num_subdomains = tf.clip_by_value(
+            tf.shape(y_n_list[0])[-1] // MIN_SUBDOMAIN_GRIDS, 1, self.num_subdomains)
+        return tf.switch_case(num_subdomains - 1, [
+            lambda k=k: split(k) for k in range(1, self.num_subdomains + 1)])
+
+    def calc_spatial_properties(self, cH_n, c_mat_sn,
+                                l_mat_sd, val_mat_sd, u_mat_sd, d_mat_sd):
+        calc = lambda cH_n, c_mat_sn: super(CafesSimDecomposed, self).calc_spatial_properties(
+            cH_n, c_mat_sn, l_mat_sd, val_mat_sd, u_mat_sd, d_mat_sd)[:-2]
+        cH_n, u_mat_sn, d_mat_sn, sig_vec_n, s_vec_n = self.decompose(
+            calc, [cH_n, c_mat_sn], 0)
+        # the equilibrium of the simulation graphs takes a fixed number of iterations
+        return cH_n, u_mat_sn, d_mat_sn, sig_vec_n, s_vec_n, 2, True
+
+    def calc_flux(self, c_mat_sn, u_mat_sn, d_mat_sn, sig_vec_n, s_vec_n, current, dx):
+        calc = lambda *y_n_list: [super(CafesSimDecomposed, self).calc_flux(
+            *y_n_list, current, dx)]
+        flux_sn, = self.decompose(calc, [c_mat_sn, u_mat_sn, d_mat_sn, sig_vec_n, s_vec_n],
+                                  HALO_WIDTH)
+        return flux_sn
+
+class CafesSimDifferentiable(CafesSim):
+    """ Tensorflow implementation of a differentiable fixed step Cafes simulation
+
+    Adaptive steps decide on the error estimate, which is not differentiable, so this mode
+    takes fixed steps (dt has to stay below the stability limit, e.g. the steps an adaptive
+    run takes) and can run under a tf.GradientTape, with respect to the species properties
+    (u_mat_sd, l_mat_sd, ...), the initial concentrations and the current. The steps are
+    grouped into segments whose intermediate states are recomputed in the backward pass
+    (tf.recompute_grad), so the memory of a gradient evaluation grows with the number of
+    segments instead of the number of steps.
+    """
+    def __init__(self, steps_per_segment=10, integrator='dorpri54'):
+        """
+        Args:
+            steps_per_segment:  number of steps between the states kept for the backward
+                                pass, a snapshot is recorded at the end of every segment
+            integrator:         see CafesSim
+        """
+        super(CafesSimDifferentiable, self).__init__(integrator=integrator)
+        self.steps_per_segment = steps_per_segment
+
+    def fixed_step(self, cH_n, c_mat_sn, l_mat_sd, val_mat_sd, u_mat_sd, d_mat_sd,
+                   current, dx, dt):
+        """ one step of size dt without error control """
+        cH_n, u_mat_sn, d_mat_sn, sig_vec_n, s_vec_n, _, _ = self.calc_spatial_properties(
+            cH_n, c_mat_sn, l_mat_sd, val_mat_sd, u_mat_sd, d_mat_sd)
+        c_mat_sn, _, _ = self.integrate(c_mat_sn, u_mat_sn, d_mat_sn, sig_vec_n, s_vec_n,
+                                        current, dx, dt)
+        return cH_n, c_mat_sn
+
+    @tf.function(input_signature=(
+        tf.TensorSpec(shape=[None], name='cH_n'),
+        tf.TensorSpec(shape=[None, None], name='c_mat_sn'),
+        tf.TensorSpec(shape=[None, None], name='l_mat_sd'),
+        tf.TensorSpec(shape=[None, None], name='val_mat_sd'),
+        tf.TensorSpec(shape=[None, None], name='u_mat_sd'),
+        tf.TensorSpec(shape=[None, None], name='d_mat_sd'),
+        tf.TensorSpec(shape=[], name='current'),
+        tf.TensorSpec(shape=[], name='dx'),
+        tf.TensorSpec(shape=[], name='dt'),
+    ))
+    def segment(self, cH_n, c_mat_sn, l_mat_sd, val_mat_sd, u_mat_sd, d_mat_sd,
+                current, dx, dt):
+        """ steps_per_segment fixed steps, recomputed in the backward pass """
+        @tf.recompute_grad
+        def run(cH_n, c_mat_sn, l_mat_sd, val_mat_sd, u_mat_sd, d_mat_sd, current, dx, dt):
+            step = lambda idx, cH_n, c_mat_sn: (idx + 1,) + self.fixed_step(
+                cH_n, c_mat_sn, l_mat_sd, val_mat_sd, u_mat_sd, d_mat_sd, current, dx, dt)
+            # an in-graph loop, so the size of the (backward) graph does not grow with
+            # steps_per_segment
+            _, cH_n, c_mat_sn = tf.while_loop(
+                lambda idx, *_: idx < self.steps_per_segment, step, (0, cH_n, c_mat_sn))
+            return cH_n, c_mat_sn
+
+        return run(cH_n, c_mat_sn, l_mat_sd, val_mat_sd, u_mat_sd, d_mat_sd, current, dx, dt)
+
+    def simulate(self, cH_n, c_mat_sn, l_mat_sd, val_mat_sd, u_mat_sd, d_mat_sd,
+                 current, dx, dt, num_segments):
+        """ run num_segments segments eagerly, so a tf.GradientTape around the call records
+        one op per segment
+
+        Args:
+            cH_n:           cH at c_mat_sn (e.g. of CafesInit), only a newton guess, so it
+                            does not need to follow changes of the parameters
+            num_segments:   number of segments, i.e. num_segments * steps_per_segment steps
+
+        Returns:
+            cH_n and c_mat_sn at the end of the run
+            concentration_tsn, the snapshots at the end of every segment
+        """
+        concentration_tsn = []
+        for _ in range(num_segments):
+            cH_n, c_mat_sn = self.segment(cH_n, c_mat_sn, l_mat_sd, val_mat_sd, u_mat_sd,
+                                          d_mat_sd, current, dx, dt)
+            concentration_tsn.append(c_mat_sn)
+        return cH_n, c_mat_sn, tf.stack(concentration_tsn)
+
+class CafesInitBatch(CafesInit):
+    """ Tensorflow implementation of Cafes initial pH calculation over a batch of variants
+
+    All variants share the same chemistry (species properties and grid), while the
+    concentrations and current are given per batch member.
+    """
+    def __init__(self, newton_tol=1e-4, max_newton_iter=5000):
+        super(CafesInitBatch, self).__init__(newton_tol, max_newton_iter)
+
+    @tf.function(input_signature=[
+        tf.TensorSpec(shape=[None, None, None], name='c_mat_bsn'),
+        tf.TensorSpec(shape=[None, None], name='l_mat_sd'),
+        tf.TensorSpec(shape=[None, None], name='val_mat_sd'),
+        tf.TensorSpec(shape=[None, None], name='u_mat_sd'),
+        tf.TensorSpec(shape=[None, None], name='d_mat_sd'),
+        tf.TensorSpec(shape=[None], name='current_b'),
+        tf.TensorSpec(shape=[], name='dx'),
+    ])
+    def __call__(self, c_mat_bsn, l_mat_sd, val_mat_sd, u_mat_sd, d_mat_sd, current_b, dx):
+        # initial guess pH == 7
+        cH_bn = tf.ones(tf.gather(tf.shape(c_mat_bsn), [0, 2]), dtype=tf.float32) * 1e-7
+
+        cH_bn, _, _, sig_vec_bn, s_vec_bn, num_iter, converged = self.calc_spatial_properties(
+            cH_bn, c_mat_bsn, l_mat_sd, val_mat_sd, u_mat_sd, d_mat_sd)
+        efield_vec_bn = self.calc_eletric_field(
+            s_vec_bn, sig_vec_bn, tf.expand_dims(current_b, axis=-1), dx)
+
+        return cH_bn, efield_vec_bn, num_iter, converged
+
+
+class CafesSimBatch(CafesSim):
+    """ Tensorflow implementation of Cafes simulation step over a batch of variants
+
+    Every batch member carries its own step size and tolerance. Rejected members are
+    re-integrated alone, so they do not redo the work of the accepted ones.
+    """
+    def __init__(self, integrator='dorpri54'):
+        super(CafesSimBatch, self).__init__(integrator=integrator)
+
+    def step(self, cH_bn, c_mat_bsn, l_mat_sd, val_mat_sd, u_mat_sd, d_mat_sd,
+             current_b, dx, dt_b, tolerance_b, error_prev_b=None):
+        error_prev_b = tolerance_b if error_prev_b is None else error_prev_b
+        current_b1 = tf.expand_dims(current_b, axis=-1)
         # chemical equillibrium
-        cH_n, u_mat_sn, d_mat_sn, sig_vec_n, s_vec_n = self.calc_spatial_properties(
+        cH_bn, u_mat_bsn, d_mat_bsn, sig_vec_bn, s_vec_bn, _, _ = self.calc_spatial_properties(
+            cH_bn, c_mat_bsn, l_mat_sd, val_mat_sd, u_mat_sd, d_mat_sd)
+        efield_vec_bn = self.calc_eletric_field(s_vec_bn, sig_vec_bn, current_b1, dx)
+        flux_bsn = self.calc_flux(
+            c_mat_bsn, u_mat_bsn, d_mat_bsn, sig_vec_bn, s_vec_bn, current_b1, dx)
+        # perform integration on the members that are not yet accepted
+        c_mat_5_bsn = tf.identity(c_mat_bsn)
+        error_b = tf.identity(tolerance_b)
+        dt_scale_b = tf.ones_like(dt_b)
+        pending_b = tf.ones_like(dt_b, dtype=tf.bool)
+        rejected_b = tf.zeros_like(dt_b, dtype=tf.bool)
+        while tf.reduce_any(pending_b):
+            dt_b = tf.where(pending_b, dt_b * dt_scale_b, dt_b)
+            idx_p1 = tf.where(pending_b)
+            gather = lambda x: tf.gather_nd(x, idx_p1)
+            c_mat_5_psn, error_p, _ = self.integrate(
+                gather(c_mat_bsn), gather(u_mat_bsn), gather(d_mat_bsn),
+                gather(sig_vec_bn), gather(s_vec_bn), gather(current_b1), dx,
+                tf.reshape(gather(dt_b), (-1, 1, 1)), gather(flux_bsn))
+            c_mat_5_bsn = tf.tensor_scatter_nd_update(c_mat_5_bsn, idx_p1, c_mat_5_psn)
+            error_b = tf.tensor_scatter_nd_update(error_b, idx_p1, error_p)
+            dt_scale_b = tf.tensor_scatter_nd_update(
+                dt_scale_b, idx_p1, self.reject_scale(error_p, gather(tolerance_b)))
+            rejected_b = rejected_b | (pending_b & (error_b > tolerance_b))
+            pending_b = pending_b & (error_b > tolerance_b)
+        dt_scale_b = self.accept_scale(dt_scale_b, error_prev_b, tolerance_b, rejected_b)
+
+        return cH_bn, efield_vec_bn, c_mat_5_bsn, dt_b, dt_b*dt_scale_b, error_b
+
+    @tf.function(input_signature=(
+        tf.TensorSpec(shape=[None, None], name='cH_bn'),
+        tf.TensorSpec(shape=[None, None, None], name='c_mat_bsn'),
+        tf.TensorSpec(shape=[None, None], name='l_mat_sd'),
+        tf.TensorSpec(shape=[None, None], name='val_mat_sd'),
+        tf.TensorSpec(shape=[None, None], name='u_mat_sd'),
+        tf.TensorSpec(shape=[None, None], name='d_mat_sd'),
+        tf.TensorSpec(shape=[None], name='current_b'),
+        tf.TensorSpec(shape=[], name='dx'),
+        tf.TensorSpec(shape=[None], name='dt_b'),
+        tf.TensorSpec(shape=[None], name='tolerance_b'),
+    ))
+    def __call__(self, cH_bn, c_mat_bsn, l_mat_sd, val_mat_sd, u_mat_sd, d_mat_sd,
+                 current_b, dx, dt_b, tolerance_b):
+        return self.step(cH_bn, c_mat_bsn, l_mat_sd, val_mat_sd, u_mat_sd, d_mat_sd,
+                         current_b, dx, dt_b, tolerance_b)[:5]
+
+
+class CafesSimAdaptive(CafesSim):
+    """ Tensorflow implementation of Cafes simulation on an adaptive grid
+
+    Grid points are placed to equidistribute a monitor function of the normalized
+    concentration gradients, so they concentrate at the zone interfaces. Whenever the
+    interfaces have migrated far enough to spoil the equidistribution, the grid is rebuilt
+    and the concentrations are conservatively remapped onto it. Snapshots are resampled onto
+    a fixed output grid.
+    """
+    def __init__(self, uniform_fraction=.3, max_refinement=20., smoothing_passes=2,
+                 regrid_threshold=1.5, integrator='dorpri54'):
+        """
+        Args:
+            uniform_fraction:   fraction of the grid points that are spread uniformly
+            max_refinement:     bound on the ratio between the largest and smallest spacing
+            smoothing_passes:   number of [1, 2, 1] / 4 smoothing passes over the monitor,
+                                which keeps the spacing smoothly graded
+            regrid_threshold:   rebuild the grid once the largest monitor integral over a
+                                cell exceeds the average by this ratio
+            integrator:         see CafesSim
+        """
+        super(CafesSimAdaptive, self).__init__(integrator=integrator)
+        self.uniform_fraction = uniform_fraction
+        self.max_refinement = max_refinement
+        self.smoothing_passes = smoothing_passes
+        self.regrid_threshold = regrid_threshold
+
+    def calc_grid_monitor(self, x_n, c_mat_sn):
+        """ monitor function on the [n-1] cells between neighbouring grid points """
+        dx_m = x_n[1:] - x_n[:-1]
+        domain_len = x_n[-1] - x_n[0]
+        c_scale_s1 = tf.reduce_max(tf.abs(c_mat_sn), axis=-1, keepdims=True)
+        grad_m = tf.reduce_max(tf.math.divide_no_nan(
+            tf.abs(c_mat_sn[:, 1:] - c_mat_sn[:, :-1]), c_scale_s1), axis=0) / dx_m
+        # constant part of the monitor which holds uniform_fraction of its integral
+        uniform = self.uniform_fraction / (1. - self.uniform_fraction) * \
+                  tf.reduce_sum(grad_m * dx_m) / domain_len
+        uniform = tf.maximum(uniform, 1. / domain_len)
+        monitor_m = tf.minimum(grad_m, (self.max_refinement - 1.) * uniform) + uniform
+        for _ in range(self.smoothing_passes):
+            monitor_o = tf.concat([monitor_m[:1], monitor_m, monitor_m[-1:]], axis=0)
+            monitor_m = .25 * monitor_o[:-2] + .5 * monitor_o[1:-1] + .25 * monitor_o[2:]
+
+        return monitor_m
+
+    def calc_adaptive_grid(self, x_n, c_mat_sn):
+        """
+        Returns:
+            grid equidistributing the monitor evaluated on x_n, with the same end points
+            ratio between the largest and the average monitor integral over a cell of x_n
+        """
+        weight_m = self.calc_grid_monitor(x_n, c_mat_sn) * (x_n[1:] - x_n[:-1])
+        cum_weight_n = tf.concat([tf.zeros(1), tf.cumsum(weight_m)], axis=0)
+        target_n = tf.linspace(0., cum_weight_n[-1], tf.size(x_n))
+        x_new_n = interp_linear(target_n, cum_weight_n, x_n)
+        x_new_n = tf.concat([x_n[:1], x_new_n[1:-1], x_n[-1:]], axis=0)
+
+        return x_new_n, tf.reduce_max(weight_m) / tf.reduce_mean(weight_m)
+
+    @tf.function(input_signature=[
+        tf.TensorSpec(shape=[None], name='x_n'),
+        tf.TensorSpec(shape=[None, None], name='c_mat_sn'),
+    ])
+    def adapt_grid(self, x_n, c_mat_sn):
+        """ single equidistribution pass, used to build the grid of the initial condition """
+        return self.calc_adaptive_grid(x_n, c_mat_sn)[0]
+
+    @tf.function(input_signature=[
+        tf.TensorSpec(shape=[None], name='x_n'),
+        tf.TensorSpec(shape=[None], name='cH_n'),
+        tf.TensorSpec(shape=[None, None], name='c_mat_sn'),
+        tf.TensorSpec(shape=[None, None], name='l_mat_sd'),
+        tf.TensorSpec(shape=[None, None], name='val_mat_sd'),
+        tf.TensorSpec(shape=[None, None], name='u_mat_sd'),
+        tf.TensorSpec(shape=[None, None], name='d_mat_sd'),
+        tf.TensorSpec(shape=[], name='current'),
+    ])
+    def electric_field(self, x_n, cH_n, c_mat_sn, l_mat_sd, val_mat_sd, u_mat_sd, d_mat_sd,
+                       current):
+        """ electric field on the (non-uniform) grid x_n """
+        _, _, _, sig_vec_n, s_vec_n, _, _ = self.calc_spatial_properties(
             cH_n, c_mat_sn, l_mat_sd, val_mat_sd, u_mat_sd, d_mat_sd)
-        efield_vec_n = self.calc_eletric_field(s_vec_n, sig_vec_n, current, dx)
-        # perform integration
-        c_mat_5_sn = tf.identity(c_mat_sn)
-        error = tolerance + 1.
-        dt_scale = 1.
-        while error > tolerance:
-            dt *= dt_scale
-            c_mat_5_sn, error = self.integrate(
-                c_mat_sn, u_mat_sn, d_mat_sn, sig_vec_n, s_vec_n, current, dx, dt)
-            dt_scale = .9 * (tolerance / error)**(1/5)
-            dt_scale = tf.clip_by_value(dt_scale, 0.1, 10)
+        return self.calc_eletric_field(s_vec_n, sig_vec_n, current, x_n[1:] - x_n[:-1])
+
+    @tf.function(input_signature=(
+        tf.TensorSpec(shape=[None], name='x_n'),
+        tf.TensorSpec(shape=[None], name='cH_n'),
+        tf.TensorSpec(shape=[None, None], name='c_mat_sn'),
+        tf.TensorSpec(shape=[None, None], name='l_mat_sd'),
+        tf.TensorSpec(shape=[None, None], name='val_mat_sd'),
+        tf.TensorSpec(shape=[None, None], name='u_mat_sd'),
+        tf.TensorSpec(shape=[None, None], name='d_mat_sd'),
+        tf.TensorSpec(shape=[], name='current'),
+        tf.TensorSpec(shape=[], name='dt'),
+        tf.TensorSpec(shape=[], name='tolerance'),
+        tf.TensorSpec(shape=[], name='t'),
+        tf.TensorSpec(shape=[], name='t_end'),
+        tf.TensorSpec(shape=[], dtype=tf.int32, name='max_steps'),
+        tf.TensorSpec(shape=[None], name='output_times_t'),
+        tf.TensorSpec(shape=[None], name='output_grid_k'),
+    ))
+    def __call__(self, x_n, cH_n, c_mat_sn, l_mat_sd, val_mat_sd, u_mat_sd, d_mat_sd,
+                 current, dt, tolerance, t, t_end, max_steps, output_times_t, output_grid_k):
+        """
+        Same as CafesSimMultiStep, but the state lives on the adaptive grid x_n, which is
+        returned along with the number of regrids. Snapshots are given on output_grid_k.
+        """
+        time_t = tf.TensorArray(tf.float32, size=0, dynamic_size=True)
+        concentration_tsk = tf.TensorArray(tf.float32, size=0, dynamic_size=True,
+                                           element_shape=tf.TensorShape([None, None]))
+        cH_tk = tf.TensorArray(tf.float32, size=0, dynamic_size=True,
+                               element_shape=tf.TensorShape([None]))
+        efield_tk = tf.TensorArray(tf.float32, size=0, dynamic_size=True,
+                                   element_shape=tf.TensorShape([None]))
+
+        num_outputs = tf.size(output_times_t)
+        output_idx = tf.searchsorted(output_times_t, tf.expand_dims(t, 0), side='right')[0]
+        efield_vec_n = tf.zeros_like(cH_n)
+        error = tolerance
+        num_steps = 0
+        num_regrids = 0
+        while num_steps < max_steps and t < t_end:
+            # follow the interfaces once they drifted away from the refined regions
+            x_new_n, ratio = self.calc_adaptive_grid(x_n, c_mat_sn)
+            if ratio > self.regrid_threshold:
+                cH_n = interp_linear(x_new_n, x_n, cH_n)
+                c_mat_sn = remap_conservative(x_new_n, x_n, c_mat_sn)
+                x_n = x_new_n
+                num_regrids += 1
+            dx_m = x_n[1:] - x_n[:-1]
+            cH_n, efield_vec_n, c_mat_5_sn, dt_used, dt, dense_coeffs, error, _ = self.step(
+                cH_n, c_mat_sn, l_mat_sd, val_mat_sd, u_mat_sd, d_mat_sd,
+                current, dx_m, tf.minimum(dt, t_end - t), tolerance, error)
+            while output_idx < num_outputs and output_times_t[output_idx] <= t + dt_used:
+                theta = (output_times_t[output_idx] - t) / dt_used
+                c_out_sn = self.dense_output(c_mat_sn, c_mat_5_sn, dense_coeffs, theta)
+                cH_out_n, _, _, sig_vec_n, s_vec_n, _, _ = self.calc_spatial_properties(
+                    cH_n, c_out_sn, l_mat_sd, val_mat_sd, u_mat_sd, d_mat_sd)
+                efield_out_n = self.calc_eletric_field(s_vec_n, sig_vec_n, current, dx_m)
+                idx = time_t.size()
+                time_t = time_t.write(idx, output_times_t[output_idx])
+                concentration_tsk = concentration_tsk.write(
+                    idx, interp_linear(output_grid_k, x_n, c_out_sn))
+                cH_tk = cH_tk.write(idx, interp_linear(output_grid_k, x_n, cH_out_n))
+                efield_tk = efield_tk.write(idx, interp_linear(output_grid_k, x_n, efield_out_n))
+                output_idx += 1
+            c_mat_sn = c_mat_5_sn
+            t += dt_used
+            num_steps += 1
+
+        num_species = tf.shape(c_mat_sn)[:1]
+        num_output_grids = tf.shape(output_grid_k)
+        return x_n, cH_n, efield_vec_n, c_mat_sn, t, dt, num_steps, num_regrids, \
+               time_t.stack(), \
+               stack_snapshots(concentration_tsk,
+                               tf.concat([num_species, num_output_grids], axis=0)), \
+               stack_snapshots(cH_tk, num_output_grids), \
+               stack_snapshots(efield_tk, num_output_grids)
+
+
+class CafesSimMovingFrame(CafesSim):
+    """ Tensorflow implementation of Cafes simulation in a window that follows the zone
+
+    Only a window of the (uniform) channel grid is simulated. After every step the window
+    is shifted by whole grid cells to keep the steepest interface of a tracked species
+    (e.g. the LE interface) at a fixed place inside the window, filling the cells that
+    enter the window with the plateau values at its incoming edge.
+    """
+    def __init__(self, target_fraction=.5, margin_fraction=.05, integrator='dorpri54'):
+        """
+        Args:
+            target_fraction:    position of the tracked interface as a fraction of the window
+            margin_fraction:    fraction of the window the interface may drift away from its
+                                target before the window is shifted
+            integrator:         see CafesSim
+        """
+        super(CafesSimMovingFrame, self).__init__(integrator=integrator)
+        self.target_fraction = target_fraction
+        self.margin_fraction = margin_fraction
+
+    def find_interface(self, c_mat_sn, track_species):
+        """ grid index of the steepest gradient of the tracked species """
+        c_track_n = c_mat_sn[track_species]
+        return tf.argmax(tf.abs(c_track_n[1:] - c_track_n[:-1]), output_type=tf.int32)
+
+    def shift_window(self, y_n, shift):
+        """ shift the window by shift cells towards +x, extending the edge values inwards """
+        num_grids = tf.shape(y_n)[-1]
+        return tf.gather(y_n, tf.clip_by_value(tf.range(num_grids) + shift, 0, num_grids - 1),
+                         axis=-1)
+
+    @tf.function(input_signature=(
+        tf.TensorSpec(shape=[None], name='cH_n'),
+        tf.TensorSpec(shape=[None, None], name='c_mat_sn'),
+        tf.TensorSpec(shape=[None, None], name='l_mat_sd'),
+        tf.TensorSpec(shape=[None, None], name='val_mat_sd'),
+        tf.TensorSpec(shape=[None, None], name='u_mat_sd'),
+        tf.TensorSpec(shape=[None, None], name='d_mat_sd'),
+        tf.TensorSpec(shape=[], name='current'),
+        tf.TensorSpec(shape=[], name='dx'),
+        tf.TensorSpec(shape=[], name='dt'),
+        tf.TensorSpec(shape=[], name='tolerance'),
+        tf.TensorSpec(shape=[], name='t'),
+        tf.TensorSpec(shape=[], name='t_end'),
+        tf.TensorSpec(shape=[], dtype=tf.int32, name='max_steps'),
+        tf.TensorSpec(shape=[None], name='output_times_t'),
+        tf.TensorSpec(shape=[], dtype=tf.int32, name='offset'),
+        tf.TensorSpec(shape=[], dtype=tf.int32, name='max_offset'),
+        tf.TensorSpec(shape=[], dtype=tf.int32, name='track_species'),
+    ))
+    def __call__(self, cH_n, c_mat_sn, l_mat_sd, val_mat_sd, u_mat_sd, d_mat_sd,
+                 current, dx, dt, tolerance, t, t_end, max_steps, output_times_t,
+                 offset, max_offset, track_species):
+        """
+        Same as CafesSimMultiStep, but cH_n and c_mat_sn hold the window starting at grid
+        cell offset of the channel, which may move within [0, max_offset]. The final offset
+        and the offset of every snapshot are returned as well.
+        """
+        time_t = tf.TensorArray(tf.float32, size=0, dynamic_size=True)
+        offset_t = tf.TensorArray(tf.int32, size=0, dynamic_size=True)
+        concentration_tsn = tf.TensorArray(tf.float32, size=0, dynamic_size=True,
+                                           element_shape=tf.TensorShape([None, None]))
+        cH_tn = tf.TensorArray(tf.float32, size=0, dynamic_size=True,
+                               element_shape=tf.TensorShape([None]))
+        efield_tn = tf.TensorArray(tf.float32, size=0, dynamic_size=True,
+                                   element_shape=tf.TensorShape([None]))
+
+        num_grids = tf.cast(tf.shape(c_mat_sn)[1], tf.float32)
+        target_idx = tf.cast(self.target_fraction * num_grids, tf.int32)
+        margin = tf.cast(self.margin_fraction * num_grids, tf.int32)
+        num_outputs = tf.size(output_times_t)
+        output_idx = tf.searchsorted(output_times_t, tf.expand_dims(t, 0), side='right')[0]
+        efield_vec_n = tf.zeros_like(cH_n)
+        error = tolerance
+        num_steps = 0
+        while num_steps < max_steps and t < t_end:
+            cH_n, efield_vec_n, c_mat_5_sn, dt_used, dt, dense_coeffs, error, _ = self.step(
+                cH_n, c_mat_sn, l_mat_sd, val_mat_sd, u_mat_sd, d_mat_sd,
+                current, dx, tf.minimum(dt, t_end - t), tolerance, error)
+            while output_idx < num_outputs and output_times_t[output_idx] <= t + dt_used:
+                theta = (output_times_t[output_idx] - t) / dt_used
+                c_out_sn = self.dense_output(c_mat_sn, c_mat_5_sn, dense_coeffs, theta)
+                cH_out_n, _, _, sig_vec_n, s_vec_n, _, _ = self.calc_spatial_properties(
+                    cH_n, c_out_sn, l_mat_sd, val_mat_sd, u_mat_sd, d_mat_sd)
+                idx = time_t.size()
+                time_t = time_t.write(idx, output_times_t[output_idx])
+                offset_t = offset_t.write(idx, offset)
+                concentration_tsn = concentration_tsn.write(idx, c_out_sn)
+                cH_tn = cH_tn.write(idx, cH_out_n)
+                efield_tn = efield_tn.write(
+                    idx, self.calc_eletric_field(s_vec_n, sig_vec_n, current, dx))
+                output_idx += 1
+            c_mat_sn = c_mat_5_sn
+            t += dt_used
+            num_steps += 1
+            # move the window along with the tracked interface
+            drift = self.find_interface(c_mat_sn, track_species) - target_idx
+            if tf.abs(drift) > margin:
+                shift = tf.clip_by_value(offset + drift, 0, max_offset) - offset
+                c_mat_sn = self.shift_window(c_mat_sn, shift)
+                cH_n = self.shift_window(cH_n, shift)
+                efield_vec_n = self.shift_window(efield_vec_n, shift)
+                offset += shift
 
-        return cH_n, efield_vec_n, c_mat_5_sn, dt, dt*dt_scale
+        return cH_n, efield_vec_n, c_mat_sn, t, dt, num_steps, offset, time_t.stack(), \
+               stack_snapshots(concentration_tsn, tf.shape(c_mat_sn)), \
+               stack_snapshots(cH_tn, tf.shape(cH_n)), \
+               stack_snapshots(efield_tn, tf.shape(efield_vec_n)), \
+               offset_t.stack()
 
 def parse_args():
     parser = argparse.ArgumentParser()
     parser.add_argument('-o', '--output', type=str, required=True,
                         help='directory to store the output model')
+    parser.add_argument('--integrator', type=str, default='dorpri54', choices=list(INTEGRATORS),
+                        help='time integrator of the simulation graph')
     return parser.parse_args()
 
 def save_tf_model(model, output_dir, name):
@@ -305,6 +1525,6 @@ if __name__ == '__main__':
     args = parse_args()
     # make sure output path exist
     Path(args.output).mkdir(parents=True, exist_ok=True)
-    save_tf_model(CafesSim(), args.output, 'cafes-sim')
+    save_tf_model(CafesSim(integrator=args.integrator), args.output, 'cafes-sim')
     save_tf_model(CafesInit(), args.output, 'cafes-init')
 
@@ -0,0 +1,191 @@
+import argparse
+import inspect
+import json
+import os
+import time
+
+import numpy as np
+import tensorflow as tf
+
+from cafes_tf import CafesSimMultiStep
+
+def compile_kwargs(jit_compile):
+    """ tf.function arguments that toggle XLA (experimental_compile before TF 2.5) """
+    if 'jit_compile' in inspect.signature(tf.function).parameters:
+        return {'jit_compile': jit_compile}
+    return {'experimental_compile': jit_compile}
+
+class CafesSimEngine(CafesSimMultiStep):
+    """ CafesSimMultiStep specialized to fixed shapes, with every step compiled by XLA
+
+    The fused loop records a dynamic number of snapshots, which XLA can not compile, so
+    only the adaptive step (equilibrium, flux and all the integration attempts) is one XLA
+    cluster, while the loop around it stays a regular graph with static shapes.
+    """
+    def __init__(self, num_species, max_deg, num_grids, jit_compile=True, integrator='dorpri54'):
+        """
+        Args:
+            num_species:    number of species
+            max_deg:        number of ionization states per species (incl. padding)
+            num_grids:      number of grid points
+            jit_compile:    compile every step with XLA, otherwise only the shapes are fixed
+            integrator:     time integrator, see CafesSim
+        """
+        super(CafesSimEngine, self).__init__(integrator)
+        self.num_species = num_species
+        self.max_deg = max_deg
+        self.num_grids = num_grids
+        self.jit_compile = jit_compile
+        shape_sn = [num_species, num_grids]
+        shape_sd = [num_species, max_deg]
+        param_signature = [
+            tf.TensorSpec(shape=shape_sd, name='l_mat_sd'),
+            tf.TensorSpec(shape=shape_sd, name='val_mat_sd'),
+            tf.TensorSpec(shape=shape_sd, name='u_mat_sd'),
+            tf.TensorSpec(shape=shape_sd, name='d_mat_sd'),
+            tf.TensorSpec(shape=[], name='current'),
+            tf.TensorSpec(shape=[], name='dx'),
+            tf.TensorSpec(shape=[], name='dt'),
+            tf.TensorSpec(shape=[], name='tolerance'),
+        ]
+        if jit_compile:
+            self.compiled_step = tf.function(
+                super(CafesSimEngine, self).step,
+                input_signature=[
+                    tf.TensorSpec(shape=[num_grids], name='cH_n'),
+                    tf.TensorSpec(shape=shape_sn, name='c_mat_sn'),
+                ] + param_signature + [
+                    tf.TensorSpec(shape=[], name='error_prev'),
+                ],
+                **compile_kwargs(True))
+        self.call_fixed = tf.function(
+            CafesSimMultiStep.__call__.python_function.__get__(self),
+            input_signature=[
+                tf.TensorSpec(shape=[num_grids], name='cH_n'),
+                tf.TensorSpec(shape=shape_sn, name='c_mat_sn'),
+            ] + param_signature + [
+                tf.TensorSpec(shape=[], name='t'),
+                tf.TensorSpec(shape=[], name='t_end'),
+                tf.TensorSpec(shape=[], dtype=tf.int32, name='max_steps'),
+                tf.TensorSpec(shape=[None], name='output_times_t'),
+            ])
+
+    def step(self, cH_n, c_mat_sn, l_mat_sd, val_mat_sd, u_mat_sd, d_mat_sd,
+             current, dx, dt, tolerance, error_prev=None):
+        if not self.jit_compile:
+            # a separate function call only pays off when it is compiled
+            return super(CafesSimEngine, self).step(
+                cH_n, c_mat_sn, l_mat_sd, val_mat_sd, u_mat_sd, d_mat_sd,
+                current, dx, dt, tolerance, error_prev)
+        error_prev = tolerance if error_prev is None else error_prev
+        return self.compiled_step(cH_n, c_mat_sn, l_mat_sd, val_mat_sd, u_mat_sd, d_mat_sd,
+                                  current, dx, dt, tolerance, error_prev)
+
+    def __call__(self, **kwargs):
+        return self.call_fixed(**kwargs)
+
+
+class EngineCache:
+    """ on disk cache of shape specialized simulation engines
+
+    Engines are stored as SavedModels keyed by their shape, compile mode and the
+    Tensorflow version, so the (expensive) tracing only happens once per configuration.
+    """
+    def __init__(self, cache_dir, jit_compile=True, integrator='dorpri54'):
+        """
+        Args:
+            cache_dir:      directory to store the exported engines in
+            jit_compile:    whether the engines are XLA compiled
+            integrator:     time integrator of the engines, see CafesSim
+        """
+        self.cache_dir = cache_dir
+        self.jit_compile = jit_compile
+        self.integrator = integrator
+        self.engines = {}
+
+    def key(self, num_species, max_deg, num_grids):
+        mode = 'xla' if self.jit_compile else 'graph'
+        if self.integrator != 'dorpri54':
+            mode += f'_{self.integrator}'
+        return f'cafes-sim_s{num_species}_d{max_deg}_n{num_grids}_{mode}_tf{tf.__version__}'
+
+    def get(self, num_species, max_deg, num_grids):
+        """
+        Returns:
+            a callable with the same interface as CafesSimMultiStep for the given shape,
+            loaded from the cache if possible, otherwise built and stored into the cache
+        """
+        key = self.key(num_species, max_deg, num_grids)
+        if key in self.engines:
+            return self.engines[key]
+        path = os.path.join(self.cache_dir, key)
+        if os.path.isdir(path):
+            engine = tf.saved_model.load(path).call_fixed
+        else:
+            engine = CafesSimEngine(num_species, max_deg, num_grids, self.jit_compile,
+                                    self.integrator)
+            engine.call_fixed.get_concrete_function()
+            tf.saved_model.save(engine, path)
+        self.engines[key] = engine
+        return engine
+
+def time_calls(model, sim_args, num_calls):
+    """
+    Returns:
+        wall time of the first call (tracing and compilation included)
+        average wall time of the following calls
+    """
+    start = time.time()
+    model(**sim_args)[0].numpy()
+    first_call = time.time() - start
+    start = time.time()
+    for _ in range(num_calls):
+        model(**sim_args)[0].numpy()
+    return first_call, (time.time() - start) / max(num_calls, 1)
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-i', '--inputs', type=str, required=True,
+                        help='inputs.json of a simulation to compile the engine for')
+    parser.add_argument('-c', '--cache-dir', type=str, required=True,
+                        help='directory of the engine cache')
+    parser.add_argument('--steps', type=int, default=100,
+                        help='number of steps taken by every timed call')
+    parser.add_argument('--calls', type=int, default=5,
+                        help='number of timed calls after the first one')
+    return parser.parse_args()
+
+# build (or load) the engine for a simulation input and compare it to the generic graph
+if __name__ == '__main__':
+    from cafes import Cafes
+
+    args = parse_args()
+    with open(args.inputs, 'r') as f:
+        inputs = json.load(f)
+    cafes = Cafes(inputs)
+    cafes.init()
+    num_species, max_deg = cafes.l_mat_sd.shape
+    sim_args = dict(
+        cH_n=cafes.cH_n,
+        c_mat_sn=cafes.concentration_sn,
+        dt=np.float32(cafes.dt),
+        tolerance=np.float32(inputs['tolerance']),
+        t=np.float32(0.),
+        t_end=np.float32(inputs['simTime']),
+        max_steps=np.int32(args.steps),
+        output_times_t=np.zeros(0, dtype=np.float32),
+        **cafes._params(),
+    )
+    candidates = {'generic': lambda: CafesSimMultiStep()}
+    for jit_compile in [False, True]:
+        cache = EngineCache(args.cache_dir, jit_compile)
+        name = cache.key(num_species, max_deg, inputs['numGrids'])
+        candidates[name] = lambda cache=cache: cache.get(num_species, max_deg,
+                                                         inputs['numGrids'])
+    for name, build in candidates.items():
+        start = time.time()
+        model = build()
+        build_time = time.time() - start
+        first_call, per_call = time_calls(model, sim_args, args.calls)
+        print(f'{name}: build {build_time:.2f}s, first call {first_call:.2f}s, '
+              f'{per_call / args.steps * 1e3:.3f}ms / step')
@@ -2,21 +2,184 @@ from utils import SimResult
 import numpy as np
 import scipy.io
 import argparse
+import concurrent.futures
+import datetime
+import os
+import sys
+
+# MATLAB reads a v7.3 MAT-file as HDF5 with this 128 byte header in a 512 byte userblock
+MAT73_USERBLOCK_SIZE = 512
+
+def _mat73_header():
+    text = ('MATLAB 7.3 MAT-file, Platform: GLNXA64, Created on: '
+            f'{datetime.datetime.now():%a %b %d %H:%M:%S %Y} HDF5 schema 1.00 .')
+    # 116 bytes of text, 8 bytes of subsystem offset, version 0x0200 and the endian indicator
+    return text.encode('ascii').ljust(116, b' ') + b' ' * 8 + b'\x00\x02' + b'IM'
+
+def _is_result_dir(path):
+    # same layouts as SimResult.from_file: a chunked store, the result files, or the
+    # extracted zip with the result files in a single sub folder
+    if any(os.path.isfile(os.path.join(path, marker)) for marker in ['meta.json', 'inputs.json']):
+        return True
+    return any(os.path.isfile(os.path.join(path, sub, 'inputs.json')) for sub in os.listdir(path))
+
+def find_results(directory):
+    """
+    Returns:
+        sorted paths of the results (result zips, extracted result directories and chunked
+        result stores) directly inside the directory
+    """
+    results = []
+    for name in sorted(os.listdir(directory)):
+        path = os.path.join(directory, name)
+        if name.endswith('.zip') and os.path.isfile(path):
+            results.append(path)
+        elif os.path.isdir(path) and not os.path.isfile(path + '.zip') and _is_result_dir(path):
+            # directories next to a zip of the same name are its decompression cache
+            results.append(path)
+    return results
+
+def save_mat5(sim_results, output_path):
+    """ write the whole result with scipy.io.savemat (readable by any MATLAB version) """
+    # lazily loaded results (e.g. of a chunked store) are read as a whole here
+    scipy.io.savemat(output_path, {
+        'ctable': np.asarray(sim_results.concentration_tsn),
+        'cH': np.asarray(sim_results.cH_tn),
+        'efield': np.asarray(sim_results.efield_tn),
+        'time': np.asarray(sim_results.time_t),
+        'grid': sim_results.grid_n,
+    })
+
+def save_mat73(sim_results, output_path, chunk_size=64, compression=True):
+    """ write the result as a MAT v7.3 (HDF5) file, one chunk of time slices at a time
+
+    MATLAB stores arrays column major, so every array is written with its axes reversed and
+    shows up in MATLAB with the same sizes savemat produces, e.g. ctable as [t s n].
+
+    Args:
+        sim_results:    SimResult to convert, ideally lazily loaded
+        output_path:    path of the .mat file
+        chunk_size:     number of time slices held in memory at once
+        compression:    deflate compress the arrays
+    """
+    try:
+        import h5py
+    except ImportError:
+        raise ImportError('MAT v7.3 output requires h5py, install it or use format 5')
+    num_steps = sim_results.num_steps()
+    num_species, num_grids = len(sim_results.inputs['species']), len(sim_results.grid_n)
+    chunk_size = max(min(chunk_size, num_steps), 1)
+    options = {'compression': 'gzip', 'compression_opts': 1} if compression else {}
+
+    with h5py.File(output_path, 'w', userblock_size=MAT73_USERBLOCK_SIZE, libver='earliest') as f:
+        def create(name, shape, dtype, chunks=None):
+            dataset = f.create_dataset(name, shape=shape, dtype=dtype, chunks=chunks,
+                                       **(options if chunks else {}))
+            dataset.attrs['MATLAB_class'] = np.bytes_(
+                'single' if np.dtype(dtype) == np.float32 else 'double')
+            return dataset
+
+        ctable = create('ctable', (num_grids, num_species, num_steps), np.float32,
+                        (num_grids, num_species, chunk_size))
+        cH = create('cH', (num_grids, num_steps), np.float32, (num_grids, chunk_size))
+        efield = create('efield', (num_grids, num_steps), np.float32, (num_grids, chunk_size))
+        # 1-D arrays are row vectors, as with savemat
+        time = create('time', (num_steps, 1), np.float32)
+        grid = create('grid', (num_grids, 1), np.asarray(sim_results.grid_n).dtype)
+        grid[:, 0] = sim_results.grid_n
+        for start, chunk in sim_results.iter_time_chunks(chunk_size):
+            stop = start + chunk.num_steps()
+            ctable[:, :, start:stop] = np.asarray(chunk.concentration_tsn, dtype=np.float32).T
+            cH[:, start:stop] = np.asarray(chunk.cH_tn, dtype=np.float32).T
+            efield[:, start:stop] = np.asarray(chunk.efield_tn, dtype=np.float32).T
+            time[start:stop, 0] = chunk.time_t
+
+    with open(output_path, 'r+b') as f:
+        f.write(_mat73_header())
+
+def convert(result_path, output_path, format='5', chunk_size=64, compression=True):
+    """ convert a single result, the .mat file only appears once it is complete
+
+    Returns:
+        output_path
+    """
+    sim_results = SimResult.from_file(result_path)
+    tmp_path = output_path + '.tmp'
+    if format == '7.3':
+        save_mat73(sim_results, tmp_path, chunk_size, compression)
+    elif format == '5':
+        # savemat appends .mat to names without it, a file object keeps the name as is
+        with open(tmp_path, 'wb') as f:
+            save_mat5(sim_results, f)
+    else:
+        raise ValueError(f'Unsupported MAT-file format {format}, choose from 5 and 7.3')
+    os.replace(tmp_path, output_path)
+    return output_path
+
+def convert_directory(directory, output_dir=None, num_workers=None, overwrite=False, **kwargs):
+    """ convert all results in a directory across a process pool
+
+    Args:
+        directory:      directory with the results, see find_results
+        output_dir:     directory to write <result name>.mat into, defaults to directory
+        num_workers:    number of processes, defaults to the number of CPUs
+        overwrite:      convert results whose .mat file already exists again
+        kwargs:         passed on to convert
+
+    Returns:
+        dictionary from result path to its .mat path, or to the exception it failed with
+    """
+    output_dir = output_dir or directory
+    os.makedirs(output_dir, exist_ok=True)
+    jobs = {}
+    for result_path in find_results(directory):
+        name = os.path.splitext(os.path.basename(os.path.normpath(result_path)))[0]
+        output_path = os.path.join(output_dir, name + '.mat')
+        if overwrite or not os.path.exists(output_path):
+            jobs[result_path] = output_path
+
+    outcomes = {}
+    with concurrent.futures.ProcessPoolExecutor(num_workers) as executor:
+        futures = {executor.submit(convert, result_path, output_path, **kwargs): result_path
+                   for result_path, output_path in jobs.items()}
+        for future in concurrent.futures.as_completed(futures):
+            result_path = futures[future]
+            try:
+                outcomes[result_path] = future.result()
+                print(f'{result_path} -> {outcomes[result_path]}')
+            except Exception as e:
+                outcomes[result_path] = e
+                print(f'{result_path} failed: {e}', file=sys.stderr)
+    return outcomes
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(
         description='Converts CAFES results into MATLAB table.')
     parser.add_argument('-filename', type=str,
                         help='Location of the CAFES result file')
+    parser.add_argument('-output', type=str, default=None,
+                        help='Name of the MATLAB data file, prompted for if not given')
+    parser.add_argument('-batch', type=str, default=None,
+                        help='Convert every CAFES result in this directory instead')
+    parser.add_argument('-outdir', type=str, default=None,
+                        help='Output directory of the batch mode, defaults to the batch directory')
+    parser.add_argument('-workers', type=int, default=None,
+                        help='Number of conversion processes of the batch mode')
+    parser.add_argument('-overwrite', action='store_true',
+                        help='Convert results whose MATLAB data file already exists again')
+    parser.add_argument('-format', type=str, default='5', choices=['5', '7.3'],
+                        help='MAT-file version, 7.3 (HDF5) streams large results in chunks '
+                             'and needs h5py')
+    parser.add_argument('-chunk_size', type=int, default=64,
+                        help='Number of time slices written at once (format 7.3)')
     args = parser.parse_args()
+    options = dict(format=args.format, chunk_size=args.chunk_size)
+
+    if args.batch is not None:
+        outcomes = convert_directory(args.batch, args.outdir, args.workers, args.overwrite,
+                                     **options)
+        sys.exit(int(any(isinstance(outcome, Exception) for outcome in outcomes.values())))
+
     filename = args.filename
-    filetag = input('Name of the MATLAB data file : ')
-
-    sim_results = SimResult.from_directory(filename)
-    scipy.io.savemat(filetag+".mat", {
-        'ctable': sim_results.concentration_tsn,
-        'cH': sim_results.cH_tn,
-        'efield': sim_results.efield_tn,
-        'time': sim_results.time_t,
-        'grid': sim_results.grid_n,
-    })
+    filetag = args.output or input('Name of the MATLAB data file : ')
+    convert(filename, filetag if filetag.endswith('.mat') else filetag + '.mat', **options)
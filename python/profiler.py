@@ -0,0 +1,133 @@
+import time
+
+import numpy as np
+import tensorflow as tf
+
+from cafes_tf import CafesSim
+
+TELEMETRY_KEYS = ('num_attempts', 'error', 'newton_increment', 'cH_min', 'cH_max')
+
+class SimProfiler:
+    """ profiling hook that aggregates CafesSim telemetry and wall-clock phase timings
+
+    Steps a Cafes driver one step at a time with a telemetry enabled CafesSim, recording
+    the telemetry and wall time of every step. The equilibrium, flux and integration phases
+    run fused inside the step graph, so they are timed separately as standalone graphs on
+    the state of the last profiled step.
+    """
+    def __init__(self, model=None):
+        """
+        Args:
+            model:  simulation step graph with telemetry enabled, defaults to
+                    CafesSim(telemetry=True)
+        """
+        self.model = model or CafesSim(telemetry=True)
+        if not self.model.telemetry:
+            raise ValueError('Profiling requires a CafesSim with telemetry enabled')
+        self.equilibrium = tf.function(self.model.calc_spatial_properties)
+        self.flux = tf.function(self.model.calc_flux)
+        self.integrate = tf.function(self.model.integrate)
+        self.records = []
+        self.phase_times = None
+
+    def profile(self, cafes, num_steps, num_repeats=10):
+        """ advance the state of an initialized Cafes driver and profile it
+
+        Args:
+            cafes:          a Cafes driver on a uniform grid, whose init() was called
+            num_steps:      number of steps to take
+            num_repeats:    number of timed runs of every phase
+
+        Returns:
+            summary() of all steps profiled so far
+        """
+        params = cafes._params()
+        for _ in range(num_steps):
+            if cafes.t >= cafes.inputs['simTime']:
+                break
+            start = time.time()
+            outputs = self.model(
+                cH_n=cafes.cH_n,
+                c_mat_sn=cafes.concentration_sn,
+                dt=np.float32(min(cafes.dt, cafes.inputs['simTime'] - cafes.t)),
+                tolerance=np.float32(cafes.inputs['tolerance']),
+                **params)
+            cH_n, _, concentration_sn, dt, dt_new = [output.numpy() for output in outputs[:5]]
+            wall_time = time.time() - start
+            self.records.append(dict(
+                zip(TELEMETRY_KEYS, [output.numpy().item() for output in outputs[5:]]),
+                t=cafes.t, dt=dt.item(), wall_time=wall_time))
+            cafes.cH_n = cH_n
+            cafes.concentration_sn = concentration_sn
+            cafes.t += dt.item()
+            cafes.dt = dt_new.item()
+        self.phase_times = self.time_phases(cafes.cH_n, cafes.concentration_sn,
+                                            np.float32(cafes.dt), num_repeats, **params)
+        return self.summary()
+
+    def time_phases(self, cH_n, c_mat_sn, dt, num_repeats, l_mat_sd, val_mat_sd,
+                    u_mat_sd, d_mat_sd, current, dx):
+        """
+        Returns:
+            average wall time of the equilibrium, flux and (single attempt) integration phases
+        """
+        _, u_mat_sn, d_mat_sn, sig_vec_n, s_vec_n, _, _ = self.equilibrium(
+            cH_n, c_mat_sn, l_mat_sd, val_mat_sd, u_mat_sd, d_mat_sd)
+        flux_sn = self.flux(c_mat_sn, u_mat_sn, d_mat_sn, sig_vec_n, s_vec_n, current, dx)
+        phases = {
+            'equilibrium': lambda: self.equilibrium(
+                cH_n, c_mat_sn, l_mat_sd, val_mat_sd, u_mat_sd, d_mat_sd)[0],
+            'flux': lambda: self.flux(
+                c_mat_sn, u_mat_sn, d_mat_sn, sig_vec_n, s_vec_n, current, dx),
+            'integration': lambda: self.integrate(
+                c_mat_sn, u_mat_sn, d_mat_sn, sig_vec_n, s_vec_n, current, dx, dt,
+                flux_sn)[0],
+        }
+        phase_times = {}
+        for name, phase in phases.items():
+            # the first run traces the graph
+            phase().numpy()
+            start = time.time()
+            for _ in range(num_repeats):
+                phase().numpy()
+            phase_times[name] = (time.time() - start) / num_repeats
+        return phase_times
+
+    def summary(self):
+        """
+        Returns:
+            aggregated telemetry of all profiled steps, and if the phases were timed, the
+            estimated share of every phase in a step. A step computes the equilibrium and
+            the first flux once and a full integration per attempt, so many rejections or
+            tiny steps show up as an integration (stiffness) bound run, while a dominant
+            equilibrium share shows an equilibrium bound one.
+        """
+        if not self.records:
+            return {}
+        column = lambda key: np.array([record[key] for record in self.records])
+        num_attempts = column('num_attempts')
+        summary = {
+            'steps': len(self.records),
+            'attempts_per_step': num_attempts.mean(),
+            'rejected_ratio': 1. - len(self.records) / num_attempts.sum(),
+            'dt_mean': column('dt').mean(),
+            'dt_min': column('dt').min(),
+            'error_mean': column('error').mean(),
+            'newton_increment_mean': column('newton_increment').mean(),
+            'newton_increment_max': column('newton_increment').max(),
+            'cH_min': column('cH_min').min(),
+            'cH_max': column('cH_max').max(),
+            'wall_time_per_step': column('wall_time').mean(),
+        }
+        if self.phase_times is not None:
+            step_time = {
+                'equilibrium': self.phase_times['equilibrium'],
+                'flux': self.phase_times['flux'],
+                'integration': self.phase_times['integration'] * summary['attempts_per_step'],
+            }
+            total_time = sum(step_time.values())
+            summary['phase_times'] = self.phase_times
+            summary['phase_shares'] = {name: phase_time / total_time
+                                       for name, phase_time in step_time.items()}
+            summary['bound'] = max(summary['phase_shares'], key=summary['phase_shares'].get)
+        return summary
@@ -0,0 +1,238 @@
+import argparse
+import concurrent.futures
+import hashlib
+import json
+import math
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+
+from cafes_input import parse_inputs
+from utils import ChunkedResultWriter, SimResult
+
+# bump whenever a change alters the results of the same inputs, e.g. the simulation graphs,
+# the pH initialization or the initial profiles, so stale cached results are not served
+SWEEP_VERSION = 2
+
+def normalize(value):
+    """ canonical form of inputs, so equal configurations hash equally
+
+    All numbers become floats (100 and 100.0 are the same numGrids) and NaN, the padding
+    of unused species properties, is kept as a string since NaN != NaN.
+    """
+    if isinstance(value, dict):
+        return {key: normalize(value[key]) for key in sorted(value)}
+    if isinstance(value, (list, tuple)):
+        return [normalize(item) for item in value]
+    if isinstance(value, bool) or value is None or isinstance(value, str):
+        return value
+    value = float(value)
+    return 'nan' if math.isnan(value) else value
+
+def input_hash(inputs, options=None):
+    """
+    Args:
+        inputs:     simulation inputs (same schema as the exported inputs.json)
+        options:    Cafes driver arguments the result depends on
+
+    Returns:
+        sha256 hex digest of the normalized inputs, options and SWEEP_VERSION
+    """
+    key = {'version': SWEEP_VERSION, 'inputs': normalize(inputs), 'options': normalize(options or {})}
+    return hashlib.sha256(json.dumps(key, sort_keys=True, separators=(',', ':')).encode()).hexdigest()
+
+# warm graphs of a worker process, kept across the configurations it runs
+_models = {}
+
+def _init_worker(num_threads):
+    import tensorflow as tf
+    if num_threads:
+        tf.config.threading.set_intra_op_parallelism_threads(num_threads)
+        tf.config.threading.set_inter_op_parallelism_threads(num_threads)
+
+def _model_sim(inputs, options):
+    from cafes_tf import CafesSimAdaptive, CafesSimDecomposed, CafesSimEvents, \
+                         CafesSimMovingFrame, CafesSimMultiStep, num_subdomains_for
+    integrator = options.get('integrator', 'dorpri54')
+    # same graph selection as Cafes, so no driver option is silently dropped
+    num_subdomains = options.get('num_subdomains')
+    if num_subdomains is not None:
+        num_subdomains = num_subdomains_for(inputs['numGrids'], num_subdomains)
+    if options.get('adaptive_grid'):
+        key, build = 'adaptive', lambda: CafesSimAdaptive(integrator=integrator)
+    elif options.get('window_grids') is not None:
+        key, build = 'window', lambda: CafesSimMovingFrame(integrator=integrator)
+    elif options.get('events') is not None:
+        key, build = 'events', lambda: CafesSimEvents(integrator)
+    elif num_subdomains is not None and num_subdomains > 1:
+        key, build = 'decomposed%d' % num_subdomains, \
+            lambda: CafesSimDecomposed(num_subdomains, integrator)
+    else:
+        key, build = 'multistep', lambda: CafesSimMultiStep(integrator=integrator)
+    key += '-' + integrator
+    if key not in _models:
+        _models[key] = build()
+    return _models[key]
+
+def run_config(inputs, path, options):
+    """ simulate a single configuration in a worker and store it at path
+
+    The result is written into a temporary directory next to path and renamed once
+    complete, so an interrupted sweep never leaves a partial result in the cache.
+    """
+    from cafes import Cafes
+    from cafes_tf import CafesInit
+
+    if 'init' not in _models:
+        _models['init'] = CafesInit()
+    cafes = Cafes(inputs, model_sim=_model_sim(inputs, options), model_init=_models['init'], **options)
+    cafes.init()
+    cafes.simulate()
+    tmp_dir = tempfile.mkdtemp(dir=os.path.dirname(path), prefix='.tmp-')
+    try:
+        with ChunkedResultWriter(tmp_dir, inputs) as writer:
+            writer.append_result(cafes.to_sim_result())
+        os.rename(tmp_dir, path)
+    except OSError:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        # a concurrent sweep stored the same configuration first
+        if not os.path.isdir(path):
+            raise
+    return path
+
+class SweepRunner:
+    """ runs many simulations across a pool of worker processes, with a content addressed
+    cache of the results
+
+    Every worker holds warm CafesInit / CafesSim graphs that are reused by all the
+    configurations it runs, and results are chunked result stores at
+    <cache_dir>/<hash[:2]>/<hash> keyed by input_hash of the inputs and driver options.
+    """
+    def __init__(self, cache_dir, num_workers=None, threads_per_worker=None, **options):
+        """
+        Args:
+            cache_dir:          directory of the result cache
+            num_workers:        number of worker processes, defaults to the number of CPUs
+            threads_per_worker: Tensorflow threads of every worker, defaults to splitting
+                                the CPUs evenly across the workers
+            options:            Cafes driver arguments, e.g. output_interval or adaptive_grid
+        """
+        if 'engine_cache' in options:
+            raise ValueError('Workers hold their own graphs, engine_cache is not supported')
+        self.cache_dir = cache_dir
+        self.num_workers = num_workers or os.cpu_count()
+        self.threads_per_worker = threads_per_worker or max(os.cpu_count() // self.num_workers, 1)
+        self.options = options
+
+    def key(self, inputs):
+        return input_hash(inputs, self.options)
+
+    def path(self, inputs):
+        key = self.key(inputs)
+        return os.path.join(self.cache_dir, key[:2], key)
+
+    def is_cached(self, inputs):
+        return os.path.isfile(os.path.join(self.path(inputs), 'meta.json'))
+
+    def load(self, inputs):
+        """
+        Returns:
+            the cached SimResult of the inputs
+        """
+        return SimResult.from_file(self.path(inputs))
+
+    def run(self, inputs_list):
+        """ simulate all configurations that are not cached yet
+
+        Args:
+            inputs_list:    list of simulation inputs
+
+        Returns:
+            for every inputs (in order), the path of its result store, or the exception its
+            simulation failed with
+        """
+        outcomes = [None] * len(inputs_list)
+        jobs = {}
+        for idx, inputs in enumerate(inputs_list):
+            path = self.path(inputs)
+            if self.is_cached(inputs):
+                outcomes[idx] = path
+            else:
+                # duplicate configurations within a sweep only run once
+                jobs.setdefault(path, (inputs, []))[1].append(idx)
+        print(f'{len(inputs_list) - sum(len(idxs) for _, idxs in jobs.values())} cached, '
+              f'{len(jobs)} to run')
+        if not jobs:
+            return outcomes
+
+        # Tensorflow is not fork safe, so workers start from a fresh interpreter
+        with concurrent.futures.ProcessPoolExecutor(
+                min(self.num_workers, len(jobs)), multiprocessing.get_context('spawn'),
+                _init_worker, (self.threads_per_worker,)) as executor:
+            futures = {}
+            for path, (inputs, idxs) in jobs.items():
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                futures[executor.submit(run_config, inputs, path, self.options)] = idxs
+            for future in concurrent.futures.as_completed(futures):
+                idxs = futures[future]
+                try:
+                    outcome = future.result()
+                    print(f'{idxs} -> {outcome}')
+                except Exception as e:
+                    outcome = e
+                    print(f'{idxs} failed: {e}', file=sys.stderr)
+                for idx in idxs:
+                    outcomes[idx] = outcome
+        return outcomes
+
+def load_inputs(paths):
+    """ read inputs from JSON files holding either a single inputs or a list of them
+
+    Inputs in UI units (whose species have no zList) are compiled with
+    cafes_input.parse_inputs, so their species can be given by name only.
+    """
+    inputs_list = []
+    for path in paths:
+        with open(path, 'r') as f:
+            inputs = json.load(f)
+        inputs_list.extend(inputs if isinstance(inputs, list) else [inputs])
+    return [inputs if all('zList' in specie for specie in inputs['species'])
+            else parse_inputs(inputs) for inputs in inputs_list]
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('inputs', type=str, nargs='+',
+                        help='inputs.json files, or JSON files with a list of inputs')
+    parser.add_argument('-c', '--cache-dir', type=str, required=True,
+                        help='directory of the result cache')
+    parser.add_argument('-w', '--workers', type=int, default=None,
+                        help='number of worker processes')
+    parser.add_argument('--threads', type=int, default=None,
+                        help='Tensorflow threads per worker')
+    parser.add_argument('--output-interval', type=float, default=None,
+                        help='record a time slice every this many seconds of simulated time')
+    parser.add_argument('--integrator', type=str, default='dorpri54',
+                        choices=['dorpri54', 'imex'], help='time integrator of the simulations')
+    parser.add_argument('--subdomains', type=int, default=None,
+                        help='split every grid into up to this many subdomains, 0 for the '
+                             'number of CPUs')
+    parser.add_argument('-o', '--output', type=str, default=None,
+                        help='JSON file to store the result path of every configuration in')
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    args = parse_args()
+    # only non default integrators are part of the cache key, so existing caches stay valid
+    options = {} if args.integrator == 'dorpri54' else {'integrator': args.integrator}
+    if args.subdomains is not None:
+        options['num_subdomains'] = args.subdomains
+    runner = SweepRunner(args.cache_dir, args.workers, args.threads,
+                         output_interval=args.output_interval, **options)
+    outcomes = runner.run(load_inputs(args.inputs))
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump([outcome if isinstance(outcome, str) else None for outcome in outcomes],
+                      f, indent=2)
+    sys.exit(int(any(not isinstance(outcome, str) for outcome in outcomes)))
@@ -0,0 +1,26 @@
+import numpy as np
+
+from analysis import GeneralStat
+from benchmark import make_inputs
+from cafes import Cafes
+
+def simulated_stat():
+    cafes = Cafes(make_inputs(100, 4, 1, sim_time=.2), output_interval=.05)
+    cafes.init()
+    cafes.simulate()
+    return GeneralStat(cafes.to_sim_result())
+
+def test_time_series_without_windows():
+    stat = simulated_stat()
+    series = stat.time_series()
+    num_slices, num_species = stat.sim_result.concentration_tsn.shape[:2]
+    assert series['time'].shape == (num_slices,)
+    assert series['mean'].shape == (num_slices, num_species)
+    assert series['amount in window'].shape == (num_slices, num_species, 0)
+
+def test_time_series_amount_in_window():
+    stat = simulated_stat()
+    domain_len = stat.sim_result.inputs['domainLen']
+    series = stat.time_series(windows=[(domain_len / 2, domain_len)], chunk_size=2)
+    # a window over the whole domain holds the total amount
+    np.testing.assert_allclose(series['amount in window'][..., 0], series['amount'])
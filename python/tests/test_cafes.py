@@ -0,0 +1,39 @@
+import numpy as np
+
+from benchmark import make_inputs
+from cafes import Cafes, list_checkpoints, load_checkpoint_history
+
+def test_checkpointed_run_records_same_slices(tmp_path):
+    inputs = make_inputs(100, 4, 1, sim_time=1.)
+    reference = Cafes(inputs, output_interval=.05)
+    reference.init()
+    assert not reference.simulate()
+    expected = reference.to_sim_result()
+
+    cafes = Cafes(inputs, output_interval=.05, checkpoint_dir=str(tmp_path),
+                  checkpoint_interval=.3)
+    cafes.init()
+    assert not cafes.simulate()
+    history = load_checkpoint_history(str(tmp_path))
+
+    # checkpoints at .3, .6, .9 and the end, and every boundary slice recorded once
+    assert len(list_checkpoints(str(tmp_path))) == 4
+    np.testing.assert_array_equal(history.time_t, expected.time_t)
+    # the split runs truncate a step at every checkpoint, so only agree to the tolerance
+    np.testing.assert_allclose(history.concentration_tsn, expected.concentration_tsn,
+                               atol=1e-2 * expected.concentration_tsn.max())
+    np.testing.assert_allclose(history.cH_tn, expected.cH_tn, atol=1e-2 * expected.cH_tn.max())
+
+def test_fork_keeps_event_records():
+    inputs = make_inputs(100, 4, 1, sim_time=1.)
+    cafes = Cafes(inputs, events=[dict(type='peak_position', species=3, value=12.2e-3,
+                                       terminal=False, name='peak')])
+    cafes.init()
+    cafes.simulate()
+    assert [record['name'] for record in cafes.event_records] == ['peak']
+
+    fork = cafes.fork(current=2 * inputs['current'])
+    assert [record['time'] for record in fork.event_records] == \
+           [record['time'] for record in cafes.event_records]
+    fork.event_records[0]['concentration_sn'][:] = 0.
+    assert cafes.event_records[0]['concentration_sn'].any()
@@ -0,0 +1,33 @@
+import math
+
+import numpy as np
+
+from benchmark import make_inputs
+from cafes_input import initial_concentrations
+
+def js_profile(inputs, specie, x_n):
+    """ initial concentration of a specie as computed by the Cafes constructor in Cafes.js """
+    erf = np.vectorize(math.erf)
+    scale = .5 * inputs['interfaceWidth']
+    loc, width = specie['injectionLoc'], specie['injectionWidth']
+    if specie['injectionType'] == 'Left Plateau':
+        return (1. - erf((x_n - loc) / scale)) * specie['initConcentration'] / 2
+    if specie['injectionType'] == 'Right Plateau':
+        return (1. + erf((x_n - loc) / scale)) * specie['initConcentration'] / 2
+    if specie['injectionType'] == 'Peak':
+        c_raw_n = erf((x_n - loc + width / 2) / scale) - erf((x_n - loc - width / 2) / scale)
+        dx = inputs['domainLen'] / inputs['numGrids']
+        return c_raw_n * specie['injectionAmount'] / (dx * inputs['area'] * c_raw_n.sum())
+    return np.full_like(x_n, specie['initConcentration'])
+
+def test_initial_concentrations_match_cafes_js():
+    inputs = make_inputs(400, 4, 1)
+    # plateaus with a width set still ignore it
+    for specie in inputs['species'][:2]:
+        specie['injectionWidth'] = 2e-3
+    dx = inputs['domainLen'] / inputs['numGrids']
+    x_n = np.arange(inputs['numGrids']) * dx
+    c_mat_sn = initial_concentrations(inputs, x_n.astype(np.float32))
+    for specie, c_n in zip(inputs['species'], c_mat_sn):
+        expected_n = js_profile(inputs, specie, x_n)
+        np.testing.assert_allclose(c_n, expected_n, rtol=1e-5, atol=1e-5 * expected_n.max())
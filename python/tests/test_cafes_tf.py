@@ -0,0 +1,39 @@
+import numpy as np
+import tensorflow as tf
+from scipy.special import erf
+
+from cafes_input import cell_widths
+from cafes_tf import remap_conservative
+
+def refined_grid(x_n, amplitude=.1):
+    """ grid with the spacing of x_n near the ends, refined and coarsened in between """
+    x_start, x_stop = x_n[10], x_n[-11]
+    inner_n = (x_n > x_start) & (x_n < x_stop)
+    x_new_n = x_n.astype(np.float64)
+    x_new_n[inner_n] += amplitude * np.sin(2 * np.pi * (x_n[inner_n] - x_start) /
+                                           (x_stop - x_start))
+    return x_new_n.astype(np.float32)
+
+def remap(x_new_n, x_n, c_mat_sn):
+    return remap_conservative(tf.constant(x_new_n), tf.constant(x_n),
+                              tf.constant(c_mat_sn)).numpy()
+
+def test_remap_conservative_keeps_constant_field():
+    x_n = np.linspace(0., 1., 200, dtype=np.float32)
+    c_mat_sn = np.stack([np.full(200, 200.), np.full(200, 1e-3)]).astype(np.float32)
+    np.testing.assert_array_equal(remap(refined_grid(x_n), x_n, c_mat_sn), c_mat_sn)
+
+def test_remap_conservative_preserves_mass_and_bounds():
+    x_n = np.linspace(0., 1., 200, dtype=np.float32)
+    c_mat_sn = np.stack([
+        50. * (1. + erf((x_n - .4) / .02)),
+        35. * np.exp(-((x_n - .6) / .03)**2),
+    ]).astype(np.float32)
+    x_new_n = refined_grid(x_n)
+    c_new_sn = remap(x_new_n, x_n, c_mat_sn)
+
+    mass_s = (c_mat_sn * cell_widths(x_n)).sum(axis=-1, dtype=np.float64)
+    mass_new_s = (c_new_sn * cell_widths(x_new_n)).sum(axis=-1, dtype=np.float64)
+    np.testing.assert_allclose(mass_new_s, mass_s, rtol=1e-5)
+    assert np.all(c_new_sn.min(axis=-1) >= c_mat_sn.min(axis=-1))
+    assert np.all(c_new_sn.max(axis=-1) <= c_mat_sn.max(axis=-1))
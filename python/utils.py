@@ -1,9 +1,17 @@
 import base64
 import json
 import os
+import posixpath
+import struct
+import tempfile
+import zipfile
+import zlib
 
 import numpy as np
 
+RESULT_FILES = ('concentration_tsn.bin', 'cH_tn.bin', 'efield_tn.bin', 'time_t.bin')
+CHUNKED_FORMAT = 'cafes-chunked'
+
 class SimResult:
     """ class abstraction of simulation results """
 
@@ -31,6 +39,83 @@ class SimResult:
         self.efield_tn = efield_tn
         self.time_t = time_t
 
+    def num_steps(self):
+        """ number of stored time slices """
+        return len(self.time_t)
+
+    def time_slice(self, start, stop):
+        """
+        Args:
+            start:  index of the first time slice
+            stop:   index past the last time slice
+
+        Returns:
+            a SimResult viewing the time slices in [start, stop) without copying
+        """
+        return SimResult(
+            inputs=self.inputs,
+            grid_n=self.grid_n,
+            concentration_tsn=self.concentration_tsn[start:stop],
+            cH_tn=self.cH_tn[start:stop],
+            efield_tn=self.efield_tn[start:stop],
+            time_t=self.time_t[start:stop],
+        )
+
+    def iter_time_chunks(self, chunk_size=256):
+        """
+        Args:
+            chunk_size: number of time slices per chunk
+
+        Yields:
+            (start index, SimResult view of chunk_size time slices starting at that index)
+        """
+        for start in range(0, self.num_steps(), chunk_size):
+            yield start, self.time_slice(start, start + chunk_size)
+
+    @staticmethod
+    def from_file(path, cache_dir=None):
+        """
+        Args:
+            path:       either the result.zip exported by the frontend, or a directory that
+                        stores the uncompressed result files
+            cache_dir:  directory to decompress DEFLATE compressed zip members into,
+                        defaults to the zip path without the .zip extension
+
+        Returns:
+            a lazily loaded SimResult, see SimResult.from_directory
+        """
+        if os.path.isdir(path):
+            if os.path.isfile(os.path.join(path, 'meta.json')):
+                return ChunkedResultReader(path).to_sim_result()
+            # the zip stores all files under a single folder
+            if not os.path.isfile(os.path.join(path, 'inputs.json')):
+                path = next(os.path.join(path, sub) for sub in os.listdir(path)
+                            if os.path.isfile(os.path.join(path, sub, 'inputs.json')))
+            return SimResult.from_directory(path)
+
+        with zipfile.ZipFile(path) as zf:
+            input_info = next(info for info in zf.infolist()
+                              if os.path.basename(info.filename) == 'inputs.json')
+            prefix = os.path.dirname(input_info.filename)
+            inputs = json.loads(zf.read(input_info))
+            arrays = {}
+            for name in RESULT_FILES:
+                info = zf.getinfo(posixpath.join(prefix, name) if prefix else name)
+                if info.compress_type == zipfile.ZIP_STORED:
+                    # uncompressed members are mapped in place
+                    arrays[name] = (path, _zip_member_offset(path, info), info.file_size)
+                    continue
+                # compressed members are streamed to disk once, same layout as unzipping
+                cache_dir = cache_dir or os.path.splitext(path)[0]
+                cache_file = os.path.join(cache_dir, *info.filename.split('/'))
+                if not os.path.isfile(cache_file) or \
+                        os.path.getsize(cache_file) != info.file_size:
+                    zf.extract(info, cache_dir)
+                    zf.extract(input_info, cache_dir)
+                arrays[name] = (cache_file, 0, info.file_size)
+
+        return SimResult._from_binaries(inputs, arrays)
+
     @staticmethod
     def from_directory(directory):
         """
@@ -39,32 +124,317 @@ class SimResult:
 
         Returns:
             a parsed SimResult object containing all the simulation result data as well
-            as experimental setup
+            as experimental setup, with the time slices memory mapped from disk so that
+            only the slices being accessed are read into memory
         """
         input_file = os.path.join(directory, "inputs.json")
-        concentration_tsn_file = os.path.join(directory, "concentration_tsn.bin")
-        cH_tn_file = os.path.join(directory, "cH_tn.bin")
-        efield_tn_file = os.path.join(directory, "efield_tn.bin")
-        time_t_file = os.path.join(directory, "time_t.bin")
 
         with open(input_file, 'r') as f:
             inputs = json.load(f)
 
+        arrays = {}
+        for name in RESULT_FILES:
+            filename = os.path.join(directory, name)
+            arrays[name] = (filename, 0, os.path.getsize(filename))
+
+        return SimResult._from_binaries(inputs, arrays)
+
+    @staticmethod
+    def _from_binaries(inputs, arrays):
+        """
+        Args:
+            inputs: all simulation inputs
+            arrays: mapping from result file name to (file path, byte offset, byte size)
+        """
         num_grids = inputs["numGrids"]
         num_species = len(inputs["species"])
 
-        concentration_tsn = np.fromfile(
-            concentration_tsn_file, dtype=np.float32).reshape(-1, num_species, num_grids)
-        cH_tn = np.fromfile(cH_tn_file, dtype=np.float32).reshape(-1, num_grids)
-        efield_tn = np.fromfile(efield_tn_file, dtype=np.float32).reshape(-1, num_grids)
-        time_t = np.fromfile(time_t_file, dtype=np.float32)
+        def memmap(name, *shape):
+            filename, offset, size = arrays[name]
+            # copy-on-write, so in place modifications never reach the file
+            return np.memmap(filename, dtype=np.float32, mode='c', offset=offset,
+                             shape=(size // 4,)).reshape(-1, *shape)
 
         return SimResult(
             inputs=inputs,
             grid_n=np.linspace(0, inputs['domainLen'], inputs['numGrids'], endpoint=False),
-            concentration_tsn=concentration_tsn,
-            cH_tn=cH_tn,
-            efield_tn=efield_tn,
-            time_t=time_t
+            concentration_tsn=memmap("concentration_tsn.bin", num_species, num_grids),
+            cH_tn=memmap("cH_tn.bin", num_grids),
+            efield_tn=memmap("efield_tn.bin", num_grids),
+            time_t=memmap("time_t.bin"),
+        )
+
+def _zip_member_offset(path, info):
+    """ byte offset of the (uncompressed) data of a zip member """
+    with open(path, 'rb') as f:
+        f.seek(info.header_offset)
+        header = f.read(30)
+    # local file header: fixed 30 bytes followed by the file name and extra field
+    name_len, extra_len = struct.unpack('<HH', header[26:30])
+    return info.header_offset + 30 + name_len + extra_len
+
+def encode_chunk(values_tn):
+    """
+    lossless compression of a [t, n] float32 chunk: delta of the bit patterns along time,
+    byte shuffle (all the i-th bytes of the values stored together) and zlib
+    """
+    bits_tn = np.ascontiguousarray(values_tn, dtype=np.float32).view(np.uint32)
+    delta_tn = np.diff(bits_tn, axis=0, prepend=np.zeros_like(bits_tn[:1]))
+    shuffled = delta_tn.view(np.uint8).reshape(-1, 4).T
+    return zlib.compress(shuffled.tobytes())
+
+def decode_chunk(data, num_grids):
+    """ inverse of encode_chunk """
+    shuffled = np.frombuffer(zlib.decompress(data), dtype=np.uint8).reshape(4, -1)
+    delta_tn = np.ascontiguousarray(shuffled.T).view(np.uint32).reshape(-1, num_grids)
+    # uint32 arithmetic wraps around, so the cumulative sum inverts the delta exactly
+    return np.cumsum(delta_tn, axis=0, dtype=np.uint32).view(np.float32)
+
+class ChunkedResultWriter:
+    """ appendable writer of the chunked, compressed result store
+
+    Layout of the store directory:
+        meta.json               inputs, shapes and the time ranges of all chunks
+        time_t.bin              float32 time of every stored slice (the time index)
+        <array>/<chunk>.z       encode_chunk compressed [t, n] time chunks, where array is
+                                one of concentration_<species index>, cH and efield
+
+    Only complete chunks (and the last partial one on close) are visible to readers, the
+    metadata is replaced atomically after every chunk.
+    """
+    def __init__(self, directory, inputs, chunk_size=64):
+        """
+        Args:
+            directory:  directory of the store, created if not existing
+            inputs:     all simulation inputs
+            chunk_size: number of time slices per chunk
+        """
+        self.directory = directory
+        self.inputs = inputs
+        self.chunk_size = chunk_size
+        self.num_species = len(inputs['species'])
+        self.num_grids = inputs['numGrids']
+        self.chunks = []
+        self.buffer = []
+        self.array_names = [f'concentration_{idx}' for idx in range(self.num_species)] + \
+                           ['cH', 'efield']
+        for name in self.array_names:
+            os.makedirs(os.path.join(directory, name), exist_ok=True)
+        open(os.path.join(directory, 'time_t.bin'), 'wb').close()
+        self._write_meta()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def append(self, time, concentration_sn, cH_n, efield_n):
+        """ append a single time slice """
+        self.buffer.append((time, np.asarray(concentration_sn, dtype=np.float32),
+                            np.asarray(cH_n, dtype=np.float32),
+                            np.asarray(efield_n, dtype=np.float32)))
+        if len(self.buffer) >= self.chunk_size:
+            self.flush()
+
+    def append_result(self, sim_result):
+        """ append all time slices of a SimResult, one chunk at a time """
+        for _, chunk in sim_result.iter_time_chunks(self.chunk_size):
+            for idx in range(chunk.num_steps()):
+                self.append(chunk.time_t[idx], chunk.concentration_tsn[idx],
+                            chunk.cH_tn[idx], chunk.efield_tn[idx])
+
+    def flush(self):
+        """ write the buffered time slices as a new chunk """
+        if not self.buffer:
+            return
+        time_t, concentration_tsn, cH_tn, efield_tn = \
+            [np.stack(values) for values in zip(*self.buffer)]
+        chunk_idx = len(self.chunks)
+        columns = [concentration_tsn[:, idx] for idx in range(self.num_species)] + \
+                  [cH_tn, efield_tn]
+        for name, values_tn in zip(self.array_names, columns):
+            with open(os.path.join(self.directory, name, f'{chunk_idx:06d}.z'), 'wb') as f:
+                f.write(encode_chunk(values_tn))
+        with open(os.path.join(self.directory, 'time_t.bin'), 'ab') as f:
+            f.write(time_t.astype(np.float32).tobytes())
+        start = self.chunks[-1]['stop'] if self.chunks else 0
+        self.chunks.append({'start': start, 'stop': start + len(time_t),
+                            't_start': float(time_t[0]), 't_stop': float(time_t[-1])})
+        self.buffer = []
+        self._write_meta()
+
+    def close(self):
+        self.flush()
+
+    def _write_meta(self):
+        meta = {
+            'format': CHUNKED_FORMAT,
+            'version': 1,
+            'codec': 'uint32-delta+shuffle+zlib',
+            'chunk_size': self.chunk_size,
+            'num_species': self.num_species,
+            'num_grids': self.num_grids,
+            'arrays': self.array_names,
+            'chunks': self.chunks,
+            'inputs': self.inputs,
+        }
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.json')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(meta, f)
+        os.replace(tmp_path, os.path.join(self.directory, 'meta.json'))
+
+class ChunkedArray:
+    """ read only [t, ...] array of a chunked store that only decompresses the chunks of
+    the time slices being indexed (np.asarray reads all of them) """
+
+    def __init__(self, reader, names):
+        """
+        Args:
+            reader: ChunkedResultReader of the store
+            names:  array name for a [t, n] array, or a list of array names that are
+                    stacked into a [t, len(names), n] array
+        """
+        self.reader = reader
+        self.names = names
+        self.shape = (reader.num_steps(),) + \
+                     (() if isinstance(names, str) else (len(names),)) + (reader.num_grids,)
+        self.dtype = np.dtype(np.float32)
+        self.ndim = len(self.shape)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def read(self, start, stop):
+        """ decompressed time slices in [start, stop) """
+        if isinstance(self.names, str):
+            return self.reader.read(self.names, start, stop)
+        return np.stack([self.reader.read(name, start, stop) for name in self.names], axis=1)
+
+    def __getitem__(self, key):
+        key = key if isinstance(key, tuple) else (key,)
+        if not isinstance(self.names, str) and len(key) > 1 and \
+                isinstance(key[1], (int, np.integer)):
+            # a single species only needs its own chunks
+            return ChunkedArray(self.reader, self.names[key[1]])[(key[0],) + key[2:]]
+        if isinstance(key[0], slice) and key[0].step in (None, 1):
+            start, stop, _ = key[0].indices(len(self))
+            return self.read(start, max(start, stop))[(slice(None),) + key[1:]]
+        idx_t = np.arange(len(self))[key[0]]
+        if idx_t.size == 0:
+            return self.read(0, 0)[(idx_t,) + key[1:]]
+        start = int(idx_t.min())
+        return self.read(start, int(idx_t.max()) + 1)[(idx_t - start,) + key[1:]]
+
+    def __array__(self, dtype=None, copy=None):
+        values = self.read(0, len(self))
+        return values if dtype is None else values.astype(dtype)
+
+class ChunkedResultReader:
+    """ random access reader of the store written by ChunkedResultWriter """
+
+    def __init__(self, directory):
+        """
+        Args:
+            directory:  directory of the store
+        """
+        self.directory = directory
+        with open(os.path.join(directory, 'meta.json'), 'r') as f:
+            self.meta = json.load(f)
+        if self.meta.get('format') != CHUNKED_FORMAT:
+            raise ValueError(f'{directory} is not a chunked result store')
+        self.inputs = self.meta['inputs']
+        self.chunks = self.meta['chunks']
+        self.num_grids = self.meta['num_grids']
+        num_stored = self.chunks[-1]['stop'] if self.chunks else 0
+        # the time index may be ahead of the metadata while a chunk is being written
+        self.time_t = np.fromfile(os.path.join(directory, 'time_t.bin'),
+                                  dtype=np.float32, count=num_stored)
+
+    def num_steps(self):
+        """ number of stored time slices """
+        return len(self.time_t)
+
+    def time_index(self, t):
+        """ index of the last stored time slice at or before time t """
+        return max(int(np.searchsorted(self.time_t, t, side='right')) - 1, 0)
+
+    def read(self, name, start, stop):
+        """
+        Args:
+            name:   array name, i.e. concentration_<species index>, cH or efield
+            start:  index of the first time slice
+            stop:   index past the last time slice
+
+        Returns:
+            [t, n] array of the time slices in [start, stop), only decompressing the
+            chunks overlapping with the range
+        """
+        start, stop, _ = slice(start, stop).indices(self.num_steps())
+        parts = []
+        for chunk_idx, chunk in enumerate(self.chunks):
+            if chunk['stop'] <= start or chunk['start'] >= stop:
+                continue
+            with open(os.path.join(self.directory, name, f'{chunk_idx:06d}.z'), 'rb') as f:
+                values_tn = decode_chunk(f.read(), self.num_grids)
+            parts.append(values_tn[max(start - chunk['start'], 0):stop - chunk['start']])
+        if not parts:
+            return np.zeros((0, self.num_grids), dtype=np.float32)
+        return np.concatenate(parts)
+
+    def read_species(self, species, start, stop):
+        """
+        Args:
+            species:    species index or name
+
+        Returns:
+            [t, n] concentration of a single species in [start, stop)
+        """
+        if isinstance(species, str):
+            species = [specie['name'] for specie in self.inputs['species']].index(species)
+        return self.read(f'concentration_{species}', start, stop)
+
+    def time_slice(self, start, stop):
+        """
+        Returns:
+            a SimResult holding the time slices in [start, stop)
+        """
+        start, stop, _ = slice(start, stop).indices(self.num_steps())
+        return SimResult(
+            inputs=self.inputs,
+            grid_n=np.linspace(0, self.inputs['domainLen'], self.num_grids, endpoint=False),
+            concentration_tsn=np.stack([self.read(f'concentration_{idx}', start, stop)
+                                        for idx in range(self.meta['num_species'])], axis=1),
+            cH_tn=self.read('cH', start, stop),
+            efield_tn=self.read('efield', start, stop),
+            time_t=self.time_t[start:stop],
         )
 
+    def to_sim_result(self):
+        """
+        Returns:
+            a lazily loaded SimResult of all stored time slices, which only decompresses
+            the chunks of the time slices being accessed (e.g. by iter_time_chunks)
+        """
+        num_species = self.meta['num_species']
+        return SimResult(
+            inputs=self.inputs,
+            grid_n=np.linspace(0, self.inputs['domainLen'], self.num_grids, endpoint=False),
+            concentration_tsn=ChunkedArray(
+                self, [f'concentration_{idx}' for idx in range(num_species)]),
+            cH_tn=ChunkedArray(self, 'cH'),
+            efield_tn=ChunkedArray(self, 'efield'),
+            time_t=self.time_t,
+        )
+
+def convert_to_chunked(path, directory, chunk_size=64):
+    """ convert a result.zip (or its extracted directory) into the chunked store
+
+    Args:
+        path:       result.zip exported by the frontend or its extracted directory
+        directory:  directory of the chunked store to create
+        chunk_size: number of time slices per chunk
+    """
+    sim_result = SimResult.from_file(path)
+    with ChunkedResultWriter(directory, sim_result.inputs, chunk_size) as writer:
+        writer.append_result(sim_result)
@@ -10,10 +10,12 @@ import Slider from '@material-ui/core/Slider';
 // material icons
 import AddCircleRoundedIcon from '@material-ui/icons/AddCircleRounded';
 import AssessmentIcon from '@material-ui/icons/Assessment';
+import BookmarkIcon from '@material-ui/icons/Bookmark';
 import DeleteIcon from '@material-ui/icons/Delete';
 import PauseIcon from '@material-ui/icons/Pause';
 import PlayArrowIcon from '@material-ui/icons/PlayArrow';
 import PublishIcon from '@material-ui/icons/Publish';
+import RestoreIcon from '@material-ui/icons/Restore';
 import SaveAltIcon from '@material-ui/icons/SaveAlt';
 import SaveIcon from '@material-ui/icons/Save';
 import MaterialTable from "material-table";
@@ -231,6 +233,8 @@ class SimUI extends React.Component {
       injectionValid: JSON.parse(localStorage.getItem("injectionValid") || false),
       // download status
       downloading: false,
+      // latest checkpoint of the worker, kept across resets so that runs can be forked
+      checkpoint: undefined,
     }
     this.worker = new Worker('./worker.js', { type: 'module' });
     this.worker.onmessage = (e) => this.workerHandler(e);
@@ -274,6 +278,10 @@ class SimUI extends React.Component {
       case 'init':
         console.log('TF is using ' + e.data.backend + ' backend.');
         break;
+      case 'checkpoint':
+        // latest checkpoint, posted back by restoreHandler to resume or fork from it
+        this.setState({checkpoint: e.data.checkpoint});
+        break;
       case 'data':
         const { result, input } = e.data;
         const simResult = { input: input, output: result };
@@ -296,9 +304,7 @@ class SimUI extends React.Component {
     );
   }
 
-  resetHandler() {
-    this.setState({running: false, initialized: false, genReport: false, simResult: undefined});
-
+  parseInput() {
     const input = new CafesInput(
       this.state.simTime, this.state.animateRate,
       this.state.numGrids, this.state.tolerance, this.state.interfaceWidth,
@@ -306,13 +312,33 @@ class SimUI extends React.Component {
       this.state.species);
 
     try {
-      const parsedInput = input.parse();
-      this.worker.postMessage({msg: 'reset', input: parsedInput});
+      return input.parse();
     }
     catch (err) {
       console.error("Input", input, "cannot be parsed");
       console.error(err);
     }
+    return undefined;
+  }
+
+  resetHandler() {
+    this.setState({running: false, initialized: false, genReport: false, simResult: undefined});
+
+    const parsedInput = this.parseInput();
+    if (parsedInput) {
+      this.worker.postMessage({msg: 'reset', input: parsedInput});
+    }
+  }
+
+  restoreHandler() {
+    this.setState({running: false, genReport: false, simResult: undefined});
+
+    // the current inputs resume the checkpointed run, or fork it if they were changed since
+    const parsedInput = this.parseInput();
+    if (parsedInput) {
+      this.worker.postMessage(
+        {msg: 'restore', checkpoint: this.state.checkpoint, input: parsedInput});
+    }
   }
 
   validateInjection() {
@@ -831,6 +857,32 @@ class SimUI extends React.Component {
               </Button>
             </Grid>
           }
+          {!this.state.running &&
+            <Grid item key="checkpointBtn">
+              <Button
+                variant="contained"
+                endIcon={<BookmarkIcon/>}
+                size="small"
+                disabled={ !this.state.initialized }
+                onClick={() => this.worker.postMessage({msg: 'checkpoint'})}
+              >
+                Checkpoint
+              </Button>
+            </Grid>
+          }
+          {!this.state.running &&
+            <Grid item key="restoreBtn">
+              <Button
+                variant="contained"
+                endIcon={<RestoreIcon/>}
+                size="small"
+                disabled={ !this.inputValid() || !this.state.checkpoint }
+                onClick={() => this.restoreHandler()}
+              >
+                Restore
+              </Button>
+            </Grid>
+          }
           {!this.state.running &&
             <Grid item key="saveConfig">
               <Button
@@ -845,6 +897,7 @@ class SimUI extends React.Component {
                     config: undefined,
                     frames: undefined,
                     running: undefined,
+                    checkpoint: undefined,
                   }, null, 2);
                   const blob = new Blob([content], {type: 'application/json'});
                   saveAs(blob, 'config.json');
@@ -164,9 +164,8 @@ export class Cafes {
     this.l_mat_sd = tf.stack(input.species.map((specie) => specie.coeffList));
   }
 
-  async init() {
-    // initialize pH
-    const [cH_n, efield_n] = await this.model_init.executeAsync({
+  async calcEquilibrium() {
+    return this.model_init.executeAsync({
       c_mat_sn: this.concentration_sn,
       l_mat_sd: this.l_mat_sd,
       val_mat_sd: this.val_mat_sd,
@@ -175,6 +174,11 @@ export class Cafes {
       current: this.current,
       dx: this.dx,
     }, ['Identity:0', 'Identity_1:0']);
+  }
+
+  async init() {
+    // initialize pH
+    const [cH_n, efield_n] = await this.calcEquilibrium();
     this.cH_n = cH_n;
     // saved temporal slices
     this.concentration_tsn = [await this.concentration_sn.data()];
@@ -185,6 +189,49 @@ export class Cafes {
     efield_n.dispose();
   }
 
+  /*
+   * the state the simulation continues from, with the input it was run with
+   **/
+  async checkpoint() {
+    return {
+      input: this.input,
+      t: this.t,
+      dt: (await this.dt.data())[0],
+      cH_n: await this.cH_n.data(),
+      concentration_sn: await this.concentration_sn.data(),
+    };
+  }
+
+  /*
+   * continue from a checkpoint instead of init(), the saved temporal slices start at the
+   * checkpoint time
+   **/
+  async restore(checkpoint) {
+    const numSpecies = this.input.species.length;
+    const numGrids = this.input.numGrids;
+    if (checkpoint.concentration_sn.length !== numSpecies * numGrids ||
+        checkpoint.cH_n.length !== numGrids) {
+      throw new Error('Checkpoint does not match the simulation shape');
+    }
+    this.concentration_sn.dispose();
+    this.dt.dispose();
+    if (this.cH_n) { this.cH_n.dispose(); }
+    this.concentration_sn = tf.tensor2d(checkpoint.concentration_sn, [numSpecies, numGrids]);
+    this.dt = tf.scalar(checkpoint.dt, 'float32');
+    this.t = checkpoint.t;
+    // the electric field is not part of the state, recompute it for the first slice
+    const [cH_n, efield_n] = await this.calcEquilibrium();
+    cH_n.dispose();
+    this.cH_n = tf.tensor1d(checkpoint.cH_n);
+    // saved temporal slices
+    this.concentration_tsn = [await this.concentration_sn.data()];
+    this.cH_tn = [await this.cH_n.data()];
+    this.efield_tn = [await efield_n.data()];
+    this.time_t = [this.t];
+    // disposal
+    efield_n.dispose();
+  }
+
   async simulateStep() {
     if (this.t >= this.input.simTime) {
       return false;
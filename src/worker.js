@@ -8,6 +8,9 @@ let ready = false;
 let updated = true;
 let cafes_sim = undefined;
 let cafes_init = undefined;
+// post a checkpoint every checkpointInterval seconds of simulated time, if set
+let checkpointInterval = undefined;
+let nextCheckpoint = undefined;
 
 const initBackend = async () => {
   tf.enableProdMode();
@@ -43,11 +46,36 @@ async function reset(input) {
   await requestUpdate();
 }
 
+async function restore(checkpoint, input) {
+  running = false;
+  if (cafes) { cafes.reset(); }
+  // a different input than the checkpoint one (e.g. another current) forks the run
+  cafes = new Cafes(input || checkpoint.input, cafes_sim, cafes_init);
+  await cafes.restore(checkpoint);
+  await requestUpdate();
+}
+
+async function checkpoint() {
+  if (!cafes) { return; }
+  const checkpoint = await cafes.checkpoint();
+  postMessage({msg: 'checkpoint', checkpoint: checkpoint},
+              [checkpoint.cH_n.buffer, checkpoint.concentration_sn.buffer]);
+}
+
 async function simulate() {
   let shouldContinue = running;
+  if (checkpointInterval) {
+    nextCheckpoint = (Math.floor(cafes.getCurrentTime() / checkpointInterval) + 1) *
+                     checkpointInterval;
+  }
   while (shouldContinue) {
     for (let i = 0; i < cafes.input.animateRate && shouldContinue; ++i) {
       shouldContinue = (await cafes.simulateStep()) && running;
+      if (checkpointInterval && cafes.getCurrentTime() >= nextCheckpoint) {
+        await checkpoint();
+        nextCheckpoint = (Math.floor(cafes.getCurrentTime() / checkpointInterval) + 1) *
+                         checkpointInterval;
+      }
       // avoid blocking message handler
       if (tf.getBackend() !== 'webgl') { await new Promise(r => setTimeout(r, 0)); }
     }
@@ -97,8 +125,18 @@ onmessage = function(e) {
     case 'start':
       updated = true;
       running = true;
+      checkpointInterval = e.data.checkpointInterval;
       simulate();
       break;
+    case 'checkpoint':
+      // the state changes between steps, while running use the checkpointInterval of 'start'
+      if (!running) { checkpoint(); }
+      break;
+    case 'restore':
+      restore(e.data.checkpoint, e.data.input).catch((err) => {
+        console.warn("Checkpoint invalid: ", err);
+      });
+      break;
     case 'pause':
       running = false;
       break;